@@ -9,7 +9,7 @@
 # with their own set of command line arguments and subcommand help text -- aside from
 # the shared arguments and shared help text defined in iggtools.common.argparser.
 #
-from iggtools.subcommands import aws_batch_init, aws_batch_submit, init, build_pangenome, import_uhgg, annotate_genes, build_marker_genes, collate_repgenome_markers, midas_run_species, midas_run_genes, midas_run_snps, midas_merge_species, midas_merge_snps, midas_merge_genes, build_bowtie2_indexes, build_gene_features # pylint: disable=unused-import
+from iggtools.subcommands import aws_batch_init, aws_batch_submit, init, build_pangenome, import_uhgg, annotate_genes, build_marker_genes, collate_repgenome_markers, midas_run_species, midas_run_genes, midas_run_snps, midas_merge_species, midas_merge_snps, midas_merge_genes, build_bowtie2_indexes, build_gene_features, build_site_annotations # pylint: disable=unused-import
 from iggtools.common.argparser import parse_args
 
 
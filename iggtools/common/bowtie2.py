@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 import os
+from itertools import islice, chain
 import numpy as np
-from iggtools.common.utils import tsprint, command, split, OutputStream
+from pysam import AlignmentFile  # pylint: disable=no-name-in-module
+from iggtools.common.utils import tsprint, command, OutputStream, concat_files
 
 
 def bowtie2_index_exists(bt2_db_dir, bt2_db_name):
@@ -26,10 +28,7 @@ def build_bowtie2_db(bt2_db_dir, bt2_db_name, downloaded_files, num_cores):
         with OutputStream(f"{bt2_db_prefix}.species") as stream:
             stream.write("\n".join(map(str, downloaded_files.keys())))
 
-        command(f"rm -f {bt2_db_dir}/{bt2_db_name}.fa", quiet=False)
-        command(f"touch {bt2_db_dir}/{bt2_db_name}.fa")
-        for files in split(downloaded_files.values(), 20):  # keep "cat" commands short
-            command("cat " + " ".join(files) + f" >> {bt2_db_dir}/{bt2_db_name}.fa")
+        concat_files(downloaded_files.values(), f"{bt2_db_dir}/{bt2_db_name}.fa")
 
         try:
             command(f"bowtie2-build --threads {num_cores} {bt2_db_prefix}.fa {bt2_db_prefix} > {bt2_db_dir}/bt2-db-build-{bt2_db_name}.log")
@@ -90,10 +89,10 @@ def samtools_index(bamfile_path, debug, num_cores):
 
 def _keep_read(aln, aln_mapid, aln_readq, aln_mapq, aln_cov):
     # Check the quality of one read alignnment from BAM file
-    align_len = len(aln.query_alignment_sequence)
+    align_len = aln.query_alignment_length
     query_len = aln.query_length
     # min pid
-    if 100 * (align_len - dict(aln.tags)['NM']) / float(align_len) < aln_mapid:
+    if 100 * (align_len - aln.get_tag('NM')) / float(align_len) < aln_mapid:
         return False
     # min read quality
     if np.mean(aln.query_qualities) < aln_readq:
@@ -105,3 +104,147 @@ def _keep_read(aln, aln_mapid, aln_readq, aln_mapq, aln_cov):
     if align_len / float(query_len) < aln_cov:
         return False
     return True
+
+
+# CIGAR operations: M, =, X pair a query base with a reference base;
+# I, S (and M, =, X) consume the query;  D, N (and M, =, X) consume the reference.
+CIGAR_MATCH_OPS = (0, 7, 8)
+CIGAR_QUERY_OPS = (0, 1, 4, 7, 8)
+CIGAR_REF_OPS = (0, 2, 3, 7, 8)
+
+# ASCII nucleotide to row index of the ACGT counts;  4 for anything else, e.g. N
+ACGT_INDEX = np.full(256, 4, dtype=np.int64)
+for _i, _nt in enumerate(b"ACGT"):
+    ACGT_INDEX[_nt] = _i
+
+
+def _aligned_bases(aln):
+    # Query and reference positions of the aligned (matched) pairs, like get_aligned_pairs(matches_only=True)
+    qblocks, rblocks = [], []
+    qpos, rpos = 0, aln.reference_start
+    for op, length in aln.cigartuples:
+        if op in CIGAR_MATCH_OPS:
+            qblocks.append(np.arange(qpos, qpos + length))
+            rblocks.append(np.arange(rpos, rpos + length))
+        if op in CIGAR_QUERY_OPS:
+            qpos += length
+        if op in CIGAR_REF_OPS:
+            rpos += length
+    if not qblocks:
+        return None, None
+    return np.concatenate(qblocks), np.concatenate(rblocks)
+
+
+def scan_contig_chunk(bamfile, contig_id, contig_start, contig_end, keep_read, quality_threshold):
+    """ Walk the reads of [contig_start, contig_end) once: decide keep/drop once per read and
+    return the (4, chunk_length) ACGT counts, same as count_coverage, together with aligned_reads
+    and mapped_reads for the reads starting within the chunk. """
+
+    chunk_length = contig_end - contig_start
+    aligned_reads = 0
+    mapped_reads = 0
+    counted = []
+
+    for aln in bamfile.fetch(contig_id, contig_start, contig_end):
+        # Reads cut by a chunk boundary are counted by the chunk where they start,
+        # therefore the sum over all the chunks of a contig equals bamfile.count(contig_id).
+        owned = contig_start <= aln.reference_start < contig_end
+        aligned_reads += owned
+        if not keep_read(aln):
+            continue
+        mapped_reads += owned
+
+        if aln.query_sequence is None:
+            continue
+        qpos, rpos = _aligned_bases(aln)
+        if qpos is None:
+            continue
+        in_chunk = (rpos >= contig_start) & (rpos < contig_end)
+        if quality_threshold:
+            if aln.query_qualities is None:
+                continue
+            quals = np.frombuffer(aln.query_qualities, dtype=np.uint8)
+            in_chunk &= quals[qpos] >= quality_threshold
+        bases = ACGT_INDEX[np.frombuffer(aln.query_sequence.encode(), dtype=np.uint8)[qpos[in_chunk]]]
+        is_acgt = bases < 4
+        counted.append(bases[is_acgt] * chunk_length + (rpos[in_chunk][is_acgt] - contig_start))
+
+    flat_indices = np.concatenate(counted) if counted else np.zeros(0, dtype=np.int64)
+    acgt = np.bincount(flat_indices, minlength=4*chunk_length).reshape(4, chunk_length)
+    return acgt, aligned_reads, mapped_reads
+
+
+def scan_gene(bamfile, gene_id, gene_length, keep_read):
+    """ Walk the reads of one gene once for aligned_reads, mapped_reads and gene_depth """
+    aligned_reads = 0
+    mapped_reads = 0
+    gene_depth = 0
+    for aln in bamfile.fetch(gene_id):
+        aligned_reads += 1
+        if keep_read(aln):
+            mapped_reads += 1
+        # gene depth is computed over all the aligned reads, as before
+        gene_depth += aln.query_alignment_length / gene_length
+    return aligned_reads, mapped_reads, gene_depth
+
+
+def scan_references(bamfile, first_rid, last_rid, keep_read):
+    """ Walk the reads of the references [first_rid, last_rid) of the sorted BAM in one sequential pass.
+    Return the aligned_reads, mapped_reads and aligned bases of each reference, as arrays indexed by rid - first_rid. """
+    aligned_reads = [0] * (last_rid - first_rid)
+    mapped_reads = [0] * (last_rid - first_rid)
+    aligned_bases = [0] * (last_rid - first_rid)
+
+    # One index lookup finds the first read of the range;  from its BGZF virtual offset on, the reads are read in file order
+    head = None
+    for rid in range(first_rid, last_rid):
+        head = next(bamfile.fetch(bamfile.get_reference_name(rid)), None)
+        if head is not None:
+            break
+    if head is not None:
+        bamfile.seek(bamfile.tell())
+        for aln in chain([head], bamfile.fetch(until_eof=True)):
+            rid = aln.reference_id
+            if rid < 0 or rid >= last_rid:
+                break
+            aligned_reads[rid - first_rid] += 1
+            if keep_read(aln):
+                mapped_reads[rid - first_rid] += 1
+            aligned_bases[rid - first_rid] += aln.query_alignment_length
+
+    return np.array(aligned_reads, dtype=np.int64), np.array(mapped_reads, dtype=np.int64), np.array(aligned_bases, dtype=np.int64)
+
+
+# Reads sampled from the head of a BAM to estimate the aligned length of its reads
+SAMPLED_READS = 10000
+
+
+def bam_mapped_reads(bamfile):
+    """ Mapped reads and length of every reference, read off the BAM index like samtools idxstats """
+    lengths = dict(zip(bamfile.references, bamfile.lengths))
+    return {stats.contig: (stats.mapped, lengths[stats.contig]) for stats in bamfile.get_index_statistics()}
+
+
+def mean_aligned_length(bamfile):
+    """ Mean query_alignment_length of the first SAMPLED_READS mapped reads """
+    lengths = [aln.query_alignment_length for aln in islice(bamfile.fetch(until_eof=True), SAMPLED_READS) if not aln.is_unmapped]
+    return sum(lengths) / len(lengths) if lengths else 0.0
+
+
+# AlignmentFile handles of this process, keyed by (pid, BAM path):  a handle inherited
+# through fork shares its file offset with the parent, so it is never reused by the child.
+bamfile_handles = {}
+
+
+def open_bamfile_handles(*bamfile_paths):
+    """ Pool initializer:  open the BAMs once per worker process, header and index included """
+    for bamfile_path in bamfile_paths:
+        cached_bamfile(bamfile_path)
+
+
+def cached_bamfile(bamfile_path):
+    """ The AlignmentFile of bamfile_path for this process, shared by every chunk the process works on """
+    key = (os.getpid(), bamfile_path)
+    if key not in bamfile_handles:
+        bamfile_handles[key] = AlignmentFile(bamfile_path)
+    return bamfile_handles[key]
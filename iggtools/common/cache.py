@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+#
+# Host-wide cache of the reference files MIDAS_IGGDB downloads from s3.
+#
+# Entries are keyed by the ETag and size of the s3 object, so a file that changed in s3 is a miss
+# even when its path did not, and identical objects under different paths share one copy.
+# An s3 path validated less than ttl seconds ago is served from its entry without asking s3 again,
+# so warm runs make no remote calls.
+# Cached files are hard linked into each midas_iggdb dir, so every run on the host reads the same
+# inode and evicting an entry never pulls a file out from under a running sample.
+#
+#   {cache_dir}/manifest.json          {entry: {"s3_path", "size", "last_used", "validated"}}
+#   {cache_dir}/manifest.lock          held around every read-modify-write of the manifest
+#   {cache_dir}/objects/{entry}        uncompressed content, renamed into place once complete
+#   {cache_dir}/objects/{entry}.lock   held while one process downloads or links the entry
+#   {cache_dir}/tmp/                   in-flight downloads, on the same filesystem as objects/
+#
+import os
+import json
+import time
+import fcntl
+import shutil
+from contextlib import contextmanager
+from iggtools.common.utils import tsprint, command, backtick, retry, download_reference, uncompressed
+
+
+# Environment variables that turn the cache on for every MIDAS_IGGDB on the host
+CACHE_DIR_ENV = "IGGTOOLS_CACHE_DIR"
+CACHE_BYTES_ENV = "IGGTOOLS_CACHE_BYTES"
+CACHE_TTL_ENV = "IGGTOOLS_CACHE_TTL"
+DEFAULT_CACHE_BYTES = 256 * 1024 ** 3
+DEFAULT_CACHE_TTL = 24 * 3600
+
+
+@retry
+def s3_object_version(s3_path):
+    """ Return the (ETag, size) of the s3 object """
+    assert s3_path.startswith("s3://"), f"s3_object_version::{s3_path} is not an s3 path"
+    bucket, key = s3_path[len("s3://"):].split("/", 1)
+    head = json.loads(backtick(["aws", "s3api", "head-object", "--bucket", bucket, "--key", key]))
+    return head["ETag"].strip('"'), int(head["ContentLength"])
+
+
+@contextmanager
+def _flock(lock_file, blocking=True):
+    """ Exclusive cross-process lock;  yields False instead of waiting if blocking=False and the lock is taken """
+    with open(lock_file, "a") as stream:
+        try:
+            fcntl.flock(stream, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(stream, fcntl.LOCK_UN)
+
+
+def _link_into_place(cached_file, dest_file):
+    """ Hard link cached_file to dest_file, or copy it when they live on different filesystems """
+    if os.path.exists(dest_file) and os.path.samefile(cached_file, dest_file):
+        return
+    temp_file = f"{dest_file}.{os.getpid()}.tmp"
+    try:
+        os.link(cached_file, temp_file)
+    except OSError:
+        shutil.copyfile(cached_file, temp_file)
+    os.replace(temp_file, dest_file)
+
+
+class ReferenceCache:
+    '''
+    Content-addressed, size bounded cache shared by all processes on a host.
+
+        cache = ReferenceCache("/mnt/cache/iggtools", max_bytes=100 * 1024 ** 3)
+        local_file = cache.fetch("s3://microbiome-igg/2.0/genomes.tsv.lz4", "midas_iggdb/genomes.tsv")
+
+    When a new entry pushes the cache over max_bytes, the least recently used entries are evicted,
+    skipping any entry another process is downloading or linking at the moment.  The ETag and size of
+    an s3 path are looked up again only once its entry was validated more than ttl seconds ago.
+    '''
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_BYTES, ttl=DEFAULT_CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.tmp_dir = os.path.join(cache_dir, "tmp")
+        self.manifest_file = os.path.join(cache_dir, "manifest.json")
+        self.manifest_lock = os.path.join(cache_dir, "manifest.lock")
+        for dirname in [self.objects_dir, self.tmp_dir]:
+            if not os.path.isdir(dirname):
+                command(f"mkdir -p {dirname}", quiet=True)
+
+
+    def fetch(self, s3_path, dest_file):
+        """ Make dest_file the uncompressed content of s3_path, downloading it only if no process on the host has """
+        recent = self._recently_validated(s3_path)
+        if recent and self._link_entry(recent[0], s3_path, dest_file, recent[1], download=False):
+            return dest_file
+        etag, size = s3_object_version(s3_path)
+        filename, _ = uncompressed(os.path.basename(s3_path))
+        self._link_entry(f"{etag}.{size}.{filename}", s3_path, dest_file, time.time(), download=True)
+        return dest_file
+
+
+    def _recently_validated(self, s3_path):
+        """ Return the (entry, validated) of s3_path if it was validated against s3 less than ttl seconds ago """
+        with _flock(self.manifest_lock):
+            manifest = self._read_manifest()
+        entries = [(info.get("validated", 0), entry) for entry, info in manifest.items() if info["s3_path"] == s3_path]
+        if not entries:
+            return None
+        validated, entry = max(entries)
+        if time.time() - validated >= self.ttl:
+            return None
+        return entry, validated
+
+
+    def _link_entry(self, entry, s3_path, dest_file, validated, download):
+        """ Link the cached entry to dest_file, downloading s3_path into it first if allowed;  return False if
+        the entry is missing and download is False, e.g. evicted since the manifest was read """
+        cached_file = os.path.join(self.objects_dir, entry)
+        with _flock(f"{cached_file}.lock"):
+            inserted = not os.path.exists(cached_file)
+            if inserted and not download:
+                return False
+            if inserted:
+                download_dir = os.path.join(self.tmp_dir, f"{entry}.{os.getpid()}")
+                try:
+                    os.rename(download_reference(s3_path, download_dir), cached_file)
+                finally:
+                    command(f"rm -rf {download_dir}", quiet=True, check=False)
+            else:
+                tsprint(f"Reuse cached {cached_file} for {s3_path}.")
+            _link_into_place(cached_file, dest_file)
+            with _flock(self.manifest_lock):
+                manifest = self._read_manifest()
+                manifest[entry] = {"s3_path": s3_path, "size": os.path.getsize(cached_file), "last_used": time.time(), "validated": validated}
+                if inserted:
+                    self._evict(manifest, keep=entry)
+                self._write_manifest(manifest)
+        return True
+
+
+    def _evict(self, manifest, keep):
+        """ Drop least recently used entries until the cache fits in max_bytes;  caller holds the manifest lock """
+        total_bytes = sum(info["size"] for info in manifest.values())
+        for entry, info in sorted(manifest.items(), key=lambda item: item[1]["last_used"]):
+            if total_bytes <= self.max_bytes:
+                break
+            if entry == keep:
+                continue
+            cached_file = os.path.join(self.objects_dir, entry)
+            with _flock(f"{cached_file}.lock", blocking=False) as locked:
+                if not locked:
+                    continue
+                tsprint(f"Evict {info['s3_path']} from cache {self.cache_dir}.")
+                if os.path.exists(cached_file):
+                    os.remove(cached_file)
+            del manifest[entry]
+            total_bytes -= info["size"]
+
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_file):
+            return {}
+        with open(self.manifest_file) as stream:
+            return json.load(stream)
+
+
+    def _write_manifest(self, manifest):
+        temp_file = f"{self.manifest_file}.{os.getpid()}.tmp"
+        with open(temp_file, "w") as stream:
+            json.dump(manifest, stream)
+        os.replace(temp_file, self.manifest_file)
+
+
+def cache_from_environ():
+    """ Return the ReferenceCache configured by IGGTOOLS_CACHE_DIR, IGGTOOLS_CACHE_BYTES and IGGTOOLS_CACHE_TTL, or None if unset """
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return None
+    return ReferenceCache(cache_dir, int(os.environ.get(CACHE_BYTES_ENV, DEFAULT_CACHE_BYTES)), float(os.environ.get(CACHE_TTL_ENV, DEFAULT_CACHE_TTL)))
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+#
+# Indexed access to uncompressed FASTA files, through samtools style .fai sidecars.
+#
+# Each line of {fasta}.fai describes one sequence, in FASTA order:
+#
+#   seq_id  length  offset  linebases  linewidth
+#
+# with offset the byte offset of its first base, and linebases/linewidth the bases and bytes of
+# each of its full lines.  The sidecars are built next to the genomes at database build time and
+# fetched with them;  a FASTA that comes without one is indexed on first use, without holding any sequence.
+#
+# Sequential reads of a whole FASTA, e.g. compressed or on S3, go through read_fasta instead,
+# which splits large byte blocks into records with bytes methods rather than line by line.
+#
+import os
+import mmap
+import numpy as np
+
+
+FAI_SUFFIX = ".fai"
+
+# Bytes read from the stream at a time by read_fasta
+FASTA_BLOCK_SIZE = 4 * 1024 * 1024
+# Dropped from the sequence lines, same as Bio.SeqIO
+FASTA_WHITESPACE = b" \t\r\n"
+
+
+def fasta_index_path(fasta_path):
+    return f"{fasta_path}{FAI_SUFFIX}"
+
+
+def build_fasta_index(fasta_path, fai_path=None):
+    """ Write the .fai of fasta_path in one pass over its lines;  seq_id is the first word of the header, same as Bio.SeqIO """
+    fai_path = fai_path if fai_path else fasta_index_path(fasta_path)
+
+    entries = []
+    entry = None
+    offset = 0
+    with open(fasta_path, "rb") as stream:
+        for line in stream:
+            if line.startswith(b">"):
+                seq_id = line[1:].split(None, 1)[0].decode() if line[1:].strip() else ""
+                # [seq_id, length, offset, linebases, linewidth, last line seen]
+                entry = [seq_id, 0, offset + len(line), 0, 0, False]
+                entries.append(entry)
+            elif entry is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if bases > 0:
+                    if entry[3] == 0:
+                        entry[3], entry[4] = bases, len(line)
+                    # Only the last line of a sequence may be shorter
+                    assert not entry[5] and bases <= entry[3], f"build_fasta_index::lines of {entry[0]} have uneven length in {fasta_path}"
+                    entry[5] = bases < entry[3] or len(line) < entry[4]
+                    entry[1] += bases
+                else:
+                    # Blank lines may only trail the sequence
+                    entry[5] = True
+            offset += len(line)
+
+    # Written aside and renamed, as concurrent runs may index the same genome of a shared database
+    temp_path = f"{fai_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as stream:
+        for seq_id, length, seq_offset, linebases, linewidth, _ in entries:
+            stream.write(f"{seq_id}\t{length}\t{seq_offset}\t{linebases}\t{linewidth}\n")
+    os.replace(temp_path, fai_path)
+    return fai_path
+
+
+def read_fasta_index(fasta_path):
+    """ Return {seq_id: (length, offset, linebases, linewidth)} in FASTA order, indexing fasta_path first if needed """
+    fai_path = fasta_index_path(fasta_path)
+    if not os.path.exists(fai_path) or os.path.getmtime(fai_path) < os.path.getmtime(fasta_path):
+        build_fasta_index(fasta_path, fai_path)
+
+    index = {}
+    with open(fai_path) as stream:
+        for line in stream:
+            seq_id, length, offset, linebases, linewidth = line.rstrip("\n").split("\t")[:5]
+            index[seq_id] = (int(length), int(offset), int(linebases), int(linewidth))
+    return index
+
+
+def _fasta_records(stream):
+    """ Raw bytes of each record of a binary FASTA stream, header line included, without the leading '>' """
+    pending = None
+    while True:
+        block = stream.read(FASTA_BLOCK_SIZE)
+        if not block:
+            break
+        if pending is None:
+            # Anything before the first header is not part of any record
+            first = block.find(b">")
+            if first < 0:
+                continue
+            pending, block = b"", block[first+1:]
+        records = (pending + block).split(b"\n>")
+        pending = records.pop()
+        yield from records
+    if pending is not None:
+        yield pending
+
+
+def read_fasta(stream, lengths_only=False):
+    """ Yield (seq_id, sequence) of each record of a FASTA opened with InputStream(path, binary=True);
+    (seq_id, length) with lengths_only, which skips decoding the sequence.  seq_id is the first word of the header, same as Bio.SeqIO """
+    for record in _fasta_records(stream):
+        header_end = record.find(b"\n")
+        if header_end < 0:
+            header_end = len(record)
+        header = record[:header_end].split(None, 1)
+        seq_id = header[0].decode() if header else ""
+        body = record[header_end+1:]
+        if lengths_only:
+            yield seq_id, len(body.translate(None, FASTA_WHITESPACE))
+        else:
+            yield seq_id, body.translate(None, FASTA_WHITESPACE).decode()
+
+
+class IndexedFasta:
+    '''
+    Random access to the sequences of an uncompressed FASTA.
+
+        fasta = IndexedFasta("/path/to/genome.fna")
+        fasta.lengths                                   # {seq_id: length}, in FASTA order
+        ref_bases = fasta.fetch(seq_id, 0, 50000)       # ASCII codes, as a uint8 array
+
+    fetch takes a 0-based half-open interval.  The file is memory-mapped on the first fetch of each
+    process, so all the processes reading the same genome share its pages in the page cache.
+    '''
+
+    def __init__(self, path, index=None):
+        self.path = path
+        self.index = index if index is not None else read_fasta_index(path)
+        self.lengths = {seq_id: entry[0] for seq_id, entry in self.index.items()}
+        self.file = None
+        self.buf = None
+
+    def __getstate__(self):
+        # The mapping stays with the process that opened it
+        state = dict(self.__dict__)
+        state["file"] = None
+        state["buf"] = None
+        return state
+
+    def fetch(self, seq_id, start, end):
+        """ ASCII codes of the bases [start, end) of seq_id """
+        length, offset, linebases, linewidth = self.index[seq_id]
+        assert 0 <= start <= end <= length, f"IndexedFasta::[{start}, {end}) is out of {seq_id} of length {length}"
+        if start == end:
+            return np.zeros(0, dtype=np.uint8)
+        if self.buf is None:
+            self.file = open(self.path, "rb")
+            self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        first_byte = offset + (start // linebases) * linewidth + start % linebases
+        last_byte = offset + ((end - 1) // linebases) * linewidth + (end - 1) % linebases + 1
+        raw = np.frombuffer(self.buf, dtype=np.uint8, count=last_byte-first_byte, offset=first_byte)
+        if last_byte - first_byte == end - start:
+            # Within one line:  a zero-copy view of the mapping
+            return raw
+        return raw[(raw != ord("\n")) & (raw != ord("\r"))]
+
+    def close(self):
+        if self.buf is not None:
+            try:
+                self.buf.close()
+            except BufferError:
+                # Some array views are still alive;  the mapping is released when they are garbage collected.
+                pass
+            self.file.close()
+        self.file = None
+        self.buf = None
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+#
+# Columnar binary pileup:  an alternative to the per-sample {species_id}.snps.tsv.lz4 text pileup.
+#
+# The file is a sequence of blocks, each holding the covered sites of one chunk of one contig,
+# followed by a JSON block index and a fixed size trailer.  All numbers are little-endian and every
+# section starts at a multiple of 8 bytes, so the reader can memory-map the file and hand out the
+# columns of a block as zero-copy NumPy views.
+#
+#   header          MAGIC
+#   block ...       uint32 n_sites, uint32 len(contig_id), contig_id, pad
+#                   uint32 ref_pos[n_sites]                (1-based, ascending)
+#                   uint32 counts[n_sites][4]              (A, C, G, T)
+#                   uint8  ref_allele[n_sites], pad
+#   index           JSON [[contig_id, first_pos, last_pos, block_offset, n_sites], ...]
+#   trailer         uint64 index_offset, uint64 index_length, MAGIC
+#
+import os
+import mmap
+import json
+import struct
+from collections import defaultdict
+import numpy as np
+
+
+MAGIC = b"IGGPILE1"
+BLOCK_HEADER = struct.Struct("<II")
+TRAILER = struct.Struct("<QQ8s")
+
+
+def _padding(length):
+    return b"\0" * (-length % 8)
+
+
+def pileup_block(contig_id, ref_pos, ref_allele, acgt):
+    """ Serialize one block of sites:  ref_pos (n,), ref_allele (n,) ASCII codes and acgt (n, 4) counts """
+    n_sites = len(ref_pos)
+    assert acgt.shape == (n_sites, 4) and len(ref_allele) == n_sites, f"pileup_block::shape mismatch for {contig_id}"
+    cid = contig_id.encode()
+    parts = [BLOCK_HEADER.pack(n_sites, len(cid)), cid, _padding(BLOCK_HEADER.size + len(cid))]
+    positions = np.ascontiguousarray(ref_pos, dtype="<u4").tobytes()
+    parts += [positions, _padding(len(positions))]
+    parts.append(np.ascontiguousarray(acgt, dtype="<u4").tobytes())
+    parts += [np.ascontiguousarray(ref_allele, dtype=np.uint8).tobytes(), _padding(n_sites)]
+    return b"".join(parts)
+
+
+def _parse_block(buf, offset):
+    """ Return (contig_id, ref_pos, acgt, ref_allele, next_offset) for the block at offset of buf """
+    n_sites, cid_len = BLOCK_HEADER.unpack_from(buf, offset)
+    offset += BLOCK_HEADER.size
+    contig_id = bytes(buf[offset:offset+cid_len]).decode()
+    offset += cid_len + len(_padding(BLOCK_HEADER.size + cid_len))
+    ref_pos = np.frombuffer(buf, dtype="<u4", count=n_sites, offset=offset)
+    offset += 4 * n_sites + len(_padding(4 * n_sites))
+    acgt = np.frombuffer(buf, dtype="<u4", count=4*n_sites, offset=offset).reshape(n_sites, 4)
+    offset += 16 * n_sites
+    ref_allele = np.frombuffer(buf, dtype=np.uint8, count=n_sites, offset=offset)
+    offset += n_sites + len(_padding(n_sites))
+    return contig_id, ref_pos, acgt, ref_allele, offset
+
+
+class BinaryPileupWriter:
+    '''
+    Write the serialized blocks one at a time, in the order they should appear in the file.
+
+        with BinaryPileupWriter("/path/to/species_id.snps.bin") as writer:
+            writer.add(pileup_block(contig_id, ref_pos, ref_allele, acgt))
+
+    The index and trailer are written by close(), which the context calls on a clean exit.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.stream = open(path, "wb")
+        self.stream.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.index = []
+
+    def __enter__(self):
+        return self
+
+    def add(self, block):
+        """ Append one serialized block """
+        contig_id, ref_pos, _, _, block_end = _parse_block(block, 0)
+        assert block_end == len(block), f"BinaryPileupWriter::corrupted block for {contig_id}"
+        if len(ref_pos) > 0:
+            self.index.append([contig_id, int(ref_pos[0]), int(ref_pos[-1]), self.offset, len(ref_pos)])
+            self.stream.write(block)
+            self.offset += len(block)
+
+    def close(self):
+        index_bytes = json.dumps(self.index).encode()
+        self.stream.write(index_bytes)
+        self.stream.write(TRAILER.pack(self.offset, len(index_bytes), MAGIC))
+        self.stream.close()
+
+    def __exit__(self, etype, evalue, etraceback):
+        if etype is None:
+            self.close()
+        else:
+            self.stream.close()
+        return False
+
+
+class BinaryPileup:
+    '''
+    Memory-mapped reader of the columnar binary pileup.
+
+        with BinaryPileup("/path/to/species_id.snps.bin") as pileup:
+            ref_pos, ref_allele, acgt = pileup.fetch(contig_id, 1, 50000)
+
+    fetch takes a 1-based closed interval, same as ref_pos.  The returned arrays are views into
+    the mapped file and must not be used after the context exits.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.buf = None
+        self.blocks = defaultdict(list)
+
+    def __enter__(self):
+        self.file = open(self.path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        assert size >= len(MAGIC) + TRAILER.size, f"BinaryPileup::truncated file {self.path}"
+        self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, index_length, magic = TRAILER.unpack_from(self.buf, size - TRAILER.size)
+        assert magic == MAGIC and self.buf[:len(MAGIC)] == MAGIC, f"BinaryPileup::{self.path} is not a binary pileup"
+        for contig_id, first_pos, last_pos, offset, n_sites in json.loads(self.buf[index_offset:index_offset+index_length]):
+            self.blocks[contig_id].append((first_pos, last_pos, offset, n_sites))
+        return self
+
+    def __exit__(self, etype, evalue, etraceback):
+        # Drop our own references to the buffer, so that close() does not trip over exported views.
+        self.blocks = defaultdict(list)
+        try:
+            self.buf.close()
+        except BufferError:
+            # Some array views are still alive;  the mapping is released when they are garbage collected.
+            pass
+        self.file.close()
+        return False
+
+    def contigs(self):
+        """ The contig ids of the file, in the order their blocks were written """
+        first_offset = {contig_id: min(offset for _, _, offset, _ in blocks) for contig_id, blocks in self.blocks.items()}
+        return sorted(first_offset, key=first_offset.get)
+
+    def fetch(self, contig_id, start, end):
+        """ Return the ref_pos, ref_allele and (n, 4) acgt arrays of the covered sites of contig_id within [start, end] """
+        ref_pos, ref_allele, acgt = [], [], []
+        for first_pos, last_pos, offset, _ in self.blocks.get(contig_id, []):
+            if last_pos < start or first_pos > end:
+                continue
+            _, b_pos, b_acgt, b_allele, _ = _parse_block(self.buf, offset)
+            lo, hi = np.searchsorted(b_pos, [start, end + 1])
+            ref_pos.append(b_pos[lo:hi])
+            ref_allele.append(b_allele[lo:hi])
+            acgt.append(b_acgt[lo:hi])
+        if len(ref_pos) == 1:
+            return ref_pos[0], ref_allele[0], acgt[0]
+        if not ref_pos:
+            return np.zeros(0, dtype="<u4"), np.zeros(0, dtype=np.uint8), np.zeros((0, 4), dtype="<u4")
+        return np.concatenate(ref_pos), np.concatenate(ref_allele), np.concatenate(acgt)
+
+    def rows(self, contig_id, start, end):
+        """ Same sites as fetch, as snps_pileup_schema tuples """
+        ref_pos, ref_allele, acgt = self.fetch(contig_id, start, end)
+        return _rows(contig_id, ref_pos, ref_allele, acgt)
+
+    def all_rows(self):
+        """ Every site in the file as snps_pileup_schema tuples, in the order the blocks were written """
+        offsets = sorted(offset for blocks in self.blocks.values() for _, _, offset, _ in blocks)
+        for offset in offsets:
+            contig_id, ref_pos, acgt, ref_allele, _ = _parse_block(self.buf, offset)
+            yield from _rows(contig_id, ref_pos, ref_allele, acgt)
+
+
+def _rows(contig_id, ref_pos, ref_allele, acgt):
+    depth = acgt.sum(axis=1, dtype=np.int64)
+    for pos, allele, d, (a, c, g, t) in zip(ref_pos.tolist(), ref_allele.tobytes().decode(), depth.tolist(), acgt.tolist()):
+        yield (contig_id, pos, allele, d, a, c, g, t)
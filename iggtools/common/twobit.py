@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+#
+# Packed reference genome:  the sequences of a FASTA at 2 bits per base, plus a mask of the runs of
+# any other character, e.g. N.  Written next to the genome as {fasta}.2bit (this layout, not UCSC's)
+# at database build time and fetched with it;  a genome that comes without one is packed on first use.
+#
+# All numbers are little-endian and every section starts at a multiple of 8 bytes, so the reader
+# memory-maps the file and decodes bases straight out of the page cache, shared by all processes.
+#
+#   header          MAGIC
+#   sequence ...    uint8  packed[(length + 3) // 4], pad     (base i in bits 2*(i%4) of byte i//4;  A, C, G, T = 0, 1, 2, 3)
+#                   uint32 run_starts[n_runs]                 (0-based, ascending)
+#                   uint32 run_ends[n_runs], pad              (exclusive)
+#                   uint8  run_bases[n_runs], pad             (the ASCII character of each run)
+#   index           JSON [[seq_id, length, offset, n_runs], ...]
+#   trailer         uint64 index_offset, uint64 index_length, MAGIC
+#
+import os
+import mmap
+import json
+import struct
+import numpy as np
+from iggtools.common.fasta import IndexedFasta
+
+
+MAGIC = b"IGG2BIT1"
+TRAILER = struct.Struct("<QQ8s")
+PACKED_SUFFIX = ".2bit"
+
+# ASCII nucleotide to 2-bit code;  4 for anything else, which goes to the mask
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _i, _nt in enumerate(b"ACGT"):
+    BASE_CODES[_nt] = _i
+CODE_BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+def _padding(length):
+    return b"\0" * (-length % 8)
+
+
+def packed_genome_path(fasta_path):
+    return f"{fasta_path}{PACKED_SUFFIX}"
+
+
+def pack_sequence(seq):
+    """ Serialize one sequence, given as an array of ASCII codes;  return (bytes, n_runs) """
+    codes = BASE_CODES[seq]
+    masked = codes == 4
+    # Runs of the same masked character
+    boundaries = np.flatnonzero(np.diff(np.concatenate(([False], masked, [False])).astype(np.int8)) != 0)
+    run_starts, run_ends = boundaries[0::2], boundaries[1::2]
+    if len(run_starts):
+        splits = np.flatnonzero(seq[1:] != seq[:-1]) + 1
+        splits = splits[masked[splits] & masked[splits - 1]]
+        run_starts = np.sort(np.concatenate((run_starts, splits)))
+        run_ends = np.sort(np.concatenate((run_ends, splits)))
+    codes[masked] = 0
+
+    padded = np.zeros(-len(codes) % 4 + len(codes), dtype=np.uint8)
+    padded[:len(codes)] = codes
+    packed = (padded[0::4] | (padded[1::4] << 2) | (padded[2::4] << 4) | (padded[3::4] << 6)).tobytes()
+
+    parts = [packed, _padding(len(packed))]
+    runs = np.ascontiguousarray(run_starts, dtype="<u4").tobytes() + np.ascontiguousarray(run_ends, dtype="<u4").tobytes()
+    parts += [runs, _padding(len(runs))]
+    parts += [seq[run_starts].astype(np.uint8).tobytes(), _padding(len(run_starts))]
+    return b"".join(parts), len(run_starts)
+
+
+def pack_genome(fasta_path, packed_path=None):
+    """ Write the packed genome of fasta_path, one sequence at a time """
+    packed_path = packed_path if packed_path else packed_genome_path(fasta_path)
+    fasta = IndexedFasta(fasta_path)
+
+    # Written aside and renamed, as concurrent runs may pack the same genome of a shared database
+    temp_path = f"{packed_path}.{os.getpid()}.tmp"
+    index = []
+    with open(temp_path, "wb") as stream:
+        stream.write(MAGIC)
+        offset = len(MAGIC)
+        for seq_id, length in fasta.lengths.items():
+            block, n_runs = pack_sequence(fasta.fetch(seq_id, 0, length))
+            index.append([seq_id, length, offset, n_runs])
+            stream.write(block)
+            offset += len(block)
+        index_bytes = json.dumps(index).encode()
+        stream.write(index_bytes)
+        stream.write(TRAILER.pack(offset, len(index_bytes), MAGIC))
+    fasta.close()
+    os.replace(temp_path, packed_path)
+    return packed_path
+
+
+def packed_genome_file(fasta_path):
+    """ Path of the packed genome of fasta_path, packing it first if needed """
+    packed_path = packed_genome_path(fasta_path)
+    if not os.path.exists(packed_path) or os.path.getmtime(packed_path) < os.path.getmtime(fasta_path):
+        pack_genome(fasta_path, packed_path)
+    return packed_path
+
+
+class PackedGenome:
+    '''
+    Random access to the bases of a packed genome.
+
+        genome = PackedGenome("/path/to/genome.fna.2bit")
+        genome.lengths                                  # {seq_id: length}, in FASTA order
+        ref_bases = genome.fetch(seq_id, 0, 50000)      # ASCII codes, as a uint8 array
+        codes = genome.codes(seq_id, positions)         # 0, 1, 2, 3 for A, C, G, T;  4 for anything else
+
+    Positions are 0-based.  The file is memory-mapped on the first lookup of each process.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.buf = None
+        with open(path, "rb") as stream:
+            size = os.fstat(stream.fileno()).st_size
+            assert size >= len(MAGIC) + TRAILER.size, f"PackedGenome::truncated file {path}"
+            stream.seek(size - TRAILER.size)
+            index_offset, index_length, magic = TRAILER.unpack(stream.read(TRAILER.size))
+            assert magic == MAGIC, f"PackedGenome::{path} is not a packed genome"
+            stream.seek(index_offset)
+            self.index = {seq_id: (length, offset, n_runs) for seq_id, length, offset, n_runs in json.loads(stream.read(index_length))}
+        self.lengths = {seq_id: entry[0] for seq_id, entry in self.index.items()}
+
+    def __getstate__(self):
+        # The mapping stays with the process that opened it
+        state = dict(self.__dict__)
+        state["file"] = None
+        state["buf"] = None
+        return state
+
+    def _lookup(self, seq_id, positions):
+        """ Unmasked 2-bit codes of positions, plus the index of the mask run holding each of them, or -1 """
+        length, offset, n_runs = self.index[seq_id]
+        positions = np.asarray(positions, dtype=np.int64)
+        assert positions.size == 0 or (positions.min() >= 0 and positions.max() < length), f"PackedGenome::positions out of {seq_id} of length {length}"
+        if self.buf is None:
+            self.file = open(self.path, "rb")
+            self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        packed_length = (length + 3) // 4
+        packed = np.frombuffer(self.buf, dtype=np.uint8, count=packed_length, offset=offset)
+        codes = (packed[positions >> 2] >> ((positions & 3) << 1).astype(np.uint8)) & 3
+
+        runs = np.full(positions.shape, -1, dtype=np.int64)
+        if n_runs:
+            runs_offset = offset + packed_length + len(_padding(packed_length))
+            run_starts = np.frombuffer(self.buf, dtype="<u4", count=n_runs, offset=runs_offset)
+            run_ends = np.frombuffer(self.buf, dtype="<u4", count=n_runs, offset=runs_offset + 4 * n_runs)
+            candidates = np.searchsorted(run_starts, positions, side="right") - 1
+            in_run = candidates >= 0
+            in_run[in_run] = positions[in_run] < run_ends[candidates[in_run]]
+            runs[in_run] = candidates[in_run]
+        return codes, runs
+
+    def _run_bases(self, seq_id):
+        length, offset, n_runs = self.index[seq_id]
+        packed_length = (length + 3) // 4
+        bases_offset = offset + packed_length + len(_padding(packed_length)) + 8 * n_runs + len(_padding(8 * n_runs))
+        return np.frombuffer(self.buf, dtype=np.uint8, count=n_runs, offset=bases_offset)
+
+    def codes(self, seq_id, positions):
+        """ 2-bit codes of the bases at positions, 4 for the masked ones;  same as ACGT_INDEX of the ASCII bases """
+        codes, runs = self._lookup(seq_id, positions)
+        codes = codes.astype(np.int64)
+        codes[runs >= 0] = 4
+        return codes
+
+    def fetch(self, seq_id, start, end):
+        """ ASCII codes of the bases [start, end) of seq_id """
+        codes, runs = self._lookup(seq_id, np.arange(start, end))
+        bases = CODE_BASES[codes]
+        masked = runs >= 0
+        if masked.any():
+            bases[masked] = self._run_bases(seq_id)[runs[masked]]
+        return bases
+
+    def close(self):
+        if self.buf is not None:
+            self.buf.close()
+            self.file.close()
+        self.file = None
+        self.buf = None
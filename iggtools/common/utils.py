@@ -9,9 +9,18 @@ import multiprocessing
 from multiprocessing.pool import ThreadPool
 import random
 import traceback
+import heapq
+import queue
 import io
+import gzip
+import shutil
+import bz2
 from fnmatch import fnmatch
-from functools import wraps
+from functools import wraps, partial
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
 
 # Thread-safe and timestamped prints.
 tslock = multiprocessing.RLock()
@@ -26,6 +35,15 @@ COMPRESSORS = {
     ".gz": "gzip -dc"
 }
 
+# Read and write buffer of the in-process (de)compression path of InputStream and OutputStream
+NATIVE_BUFFER_SIZE = 1024 * 1024
+
+# Uncompressed size of the independent frames written by OutputStream(path, threads=N)
+PARALLEL_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Chunks planned by cost are at most this many times finer, or coarser, than chunk_size
+CHUNK_COST_RATIO_LIMIT = 8
+
 
 def timestamp(t):
     # We do not use "{:.3f}".format(time.time()) because its result may be
@@ -94,16 +112,32 @@ class InputStream:
     Formats lz4, bz2, gz and plain text are supported.
 
     Wildcards in path are also supported, but must expand to precisely 1 matching file.
+
+    To read just a slice of a local file, pass byte_range=(offset, length).  The slice must
+    decompress on its own, e.g. be a run of whole lz4 frames as listed by a sidecar index.
+
+        with InputStream("/path/to/file.lz4", byte_range=(1024, 4096)) as stream:
+            ...
+
+    Local files without filters are decompressed in-process by the gzip, bz2 and lz4.frame
+    modules, which saves a fork/exec and a pipe copy per file.  Without the lz4 python module,
+    or with in_process=False, lz4 files go through the subprocess pipeline as before.
     '''
 
-    def __init__(self, path, through=None, filters=None, check_path=True, binary=False):
+    def __init__(self, path, through=None, filters=None, check_path=True, binary=False, byte_range=None, in_process=True):
         if through != None:
             assert filters == None
             filters = through
         if check_path:
             path = smart_glob(path, expected=1)[0]
+        self.in_process = in_process and not filters and native_codec_available(path)
+        self.byte_range = byte_range
         cat = 'set -o pipefail; '
-        if path.startswith("s3://"):
+        if byte_range:
+            assert not path.startswith("s3://"), f"InputStream::byte_range is only supported for local files, not {path}"
+            offset, length = byte_range
+            cat += f"dd if={path} iflag=skip_bytes,count_bytes skip={offset} count={length} bs=1M status=none"
+        elif path.startswith("s3://"):
             cat += f"aws s3 --quiet cp {path} -"
         else:
             cat += f"cat {path}"
@@ -127,6 +161,13 @@ class InputStream:
         self.ignore_called_process_errors = True
 
     def __enter__(self):
+        if self.in_process:
+            self.subproc = None
+            self.stream = native_reader(self.path, self.byte_range)
+            if not self.binary:
+                self.stream = text_mode(self.stream)
+            self.stream.ignore_errors = self.ignore_errors
+            return self.stream
         self.subproc = command(self.cat, popen=True, stdout=subprocess.PIPE)
         self.subproc.__enter__()
         self.stream = self.subproc.stdout if self.binary else text_mode(self.subproc.stdout)  # Note the subject of the WITH statement is the subprocess STDOUT
@@ -134,6 +175,9 @@ class InputStream:
         return self.stream
 
     def __exit__(self, etype, evalue, etraceback):
+        if self.in_process:
+            native_close(self.stream, self.path, evalue, self.ignore_called_process_errors)
+            return False
         result = self.subproc.__exit__(etype, evalue, etraceback)  # pylint: disable=assignment-from-no-return
         if not self.ignore_called_process_errors:
             returncode = self.subproc.returncode
@@ -151,12 +195,22 @@ class InputStream:
 class OutputStream:
     '''
     Same idea as InputStream, but for output.  Handles compression etc transparently.
+    Local files without filters are compressed in-process unless in_process=False.
+
+    With threads=N > 1, a compressed local file is cut into blocks that are compressed on N
+    threads as independent lz4 frames, gzip members or bz2 streams, and written in order.
+    Standard decompressors read the result as one file.
+
+        with OutputStream("/path/to/matrix.tsv.lz4", threads=8) as stream:
+            ...
     '''
 
-    def __init__(self, path, through=None, filters=None, binary=False):
+    def __init__(self, path, through=None, filters=None, binary=False, in_process=True, threads=1):
         if through != None:
             assert filters == None
             filters = through
+        self.in_process = in_process and not filters and native_codec_available(path)
+        self.threads = threads
         if path.startswith("s3://"):
             cat = f"aws s3 --quiet cp - {path}"
         else:
@@ -181,6 +235,13 @@ class OutputStream:
         self.ignore_called_process_errors = True
 
     def __enter__(self):
+        if self.in_process:
+            self.subproc = None
+            self.stream = native_writer(self.path, self.threads)
+            if not self.binary:
+                self.stream = text_mode(self.stream)
+            self.stream.ignore_errors = self.ignore_errors
+            return self.stream
         self.subproc = command(self.cat, popen=True, stdin=subprocess.PIPE)
         self.subproc.__enter__()
         self.stream = self.subproc.stdin if self.binary else text_mode(self.subproc.stdin)  # Note the subject of the WITH statement is the subprocess STDIN
@@ -188,6 +249,9 @@ class OutputStream:
         return self.stream
 
     def __exit__(self, etype, evalue, etraceback):
+        if self.in_process:
+            native_close(self.stream, self.path, evalue, self.ignore_called_process_errors)
+            return False
         self.stream.flush()
         result = self.subproc.__exit__(etype, evalue, etraceback)  # pylint: disable=assignment-from-no-return
         if not self.ignore_called_process_errors:
@@ -203,6 +267,178 @@ class OutputStream:
         return result
 
 
+def native_codec_available(path):
+    """ True if path is a local file whose compression format can be handled in-process """
+    if path.startswith("s3://"):
+        return False
+    if path.endswith(".lz4"):
+        return lz4_frame is not None
+    return True
+
+
+def _native_codec(path, fileobj, mode):
+    if path.endswith(".lz4"):
+        return lz4_frame.LZ4FrameFile(fileobj, mode)
+    if path.endswith(".bz2"):
+        return bz2.BZ2File(fileobj, mode)
+    if path.endswith(".gz"):
+        return gzip.GzipFile(fileobj=fileobj, mode=mode, compresslevel=6)
+    return None
+
+
+class _NativeStream(io.BufferedIOBase):
+    """ Buffered (de)compressing file object that also closes the underlying file.  Like the
+    subprocess pipelines, a corrupt or truncated input reads as end of data, and the error is
+    raised on close instead, where InputStream.ignore_errors can suppress it. """
+
+    def __init__(self, codec, fileobj):
+        super().__init__()
+        self.codec = codec
+        self.fileobj = fileobj
+        self.error = None
+
+    def readable(self):
+        return self.codec.readable()
+
+    def writable(self):
+        return self.codec.writable()
+
+    def _decode(self, operation, arg, eof):
+        if self.error:
+            return eof
+        try:
+            return operation(arg)
+        except (EOFError, OSError, RuntimeError) as decode_error:
+            self.error = decode_error
+            return eof
+
+    def read(self, size=-1):
+        return self._decode(self.codec.read, size, b"")
+
+    def read1(self, size=-1):
+        return self._decode(self.codec.read1, size, b"")
+
+    def readinto(self, b):
+        return self._decode(self.codec.readinto, b, 0)
+
+    def write(self, b):
+        return self.codec.write(b)
+
+    def flush(self):
+        if not self.codec.closed and self.codec.writable():
+            self.codec.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.codec.close()
+        finally:
+            self.fileobj.close()
+            super().close()
+        if self.error:
+            raise self.error
+
+
+def native_reader(path, byte_range=None):
+    """ Open local path for buffered binary reading, decompressing in-process """
+    fileobj = open(path, "rb", buffering=NATIVE_BUFFER_SIZE)
+    if byte_range:
+        offset, length = byte_range
+        fileobj.seek(offset)
+        data = fileobj.read(length)
+        fileobj.close()
+        fileobj = io.BytesIO(data)
+    codec = _native_codec(path, fileobj, "rb")
+    if codec is None:
+        return fileobj
+    return io.BufferedReader(_NativeStream(codec, fileobj), buffer_size=NATIVE_BUFFER_SIZE)
+
+
+class _ParallelCompressor(io.BufferedIOBase):
+    """ Compress blocks of PARALLEL_BLOCK_SIZE bytes as independent frames on a thread pool, and write them in order """
+
+    def __init__(self, path, threads):
+        super().__init__()
+        self.compress = _block_compressor(path)
+        self.fileobj = open(path, "wb", buffering=NATIVE_BUFFER_SIZE)
+        self.pool = ThreadPool(threads)
+        # Bound the memory held by blocks in flight
+        self.max_pending = 2 * threads
+        self.pending = []
+        self.block = bytearray()
+        self.blocks_written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.block += b
+        while len(self.block) >= PARALLEL_BLOCK_SIZE:
+            self._submit(bytes(self.block[:PARALLEL_BLOCK_SIZE]))
+            del self.block[:PARALLEL_BLOCK_SIZE]
+        return len(b)
+
+    def _submit(self, data):
+        self.pending.append(self.pool.apply_async(self.compress, (data,)))
+        self._drain(self.max_pending)
+
+    def _drain(self, max_pending=0):
+        while len(self.pending) > max_pending:
+            self.fileobj.write(self.pending.pop(0).get())
+            self.blocks_written += 1
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            # An empty input still needs one frame to be a valid compressed file
+            if self.block or self.blocks_written + len(self.pending) == 0:
+                self._submit(bytes(self.block))
+                self.block = bytearray()
+            self._drain()
+        finally:
+            self.pool.terminate()
+            self.fileobj.close()
+            super().close()
+
+
+def _block_compressor(path):
+    if path.endswith(".lz4"):
+        return lz4_frame.compress
+    if path.endswith(".bz2"):
+        return bz2.compress
+    assert path.endswith(".gz"), f"_block_compressor::{path} is not a compressed file"
+    # Same level as gzip -c
+    return partial(gzip.compress, compresslevel=6)
+
+
+def native_writer(path, threads=1):
+    """ Open local path for buffered binary writing, compressing in-process, on threads if more than one """
+    if threads > 1 and path.endswith((".lz4", ".bz2", ".gz")):
+        return _ParallelCompressor(path, threads)
+    fileobj = open(path, "wb", buffering=NATIVE_BUFFER_SIZE)
+    codec = _native_codec(path, fileobj, "wb")
+    if codec is None:
+        return fileobj
+    return io.BufferedWriter(_NativeStream(codec, fileobj), buffer_size=NATIVE_BUFFER_SIZE)
+
+
+def native_close(stream, path, evalue, ignore_errors):
+    """ Close an in-process stream with the same error semantics as the subprocess pipelines """
+    try:
+        stream.close()
+    except Exception as close_error:  # pylint: disable=broad-except
+        if ignore_errors:
+            return
+        msg = f"Error {close_error!r} closing in-process stream of {path}."
+        if evalue:
+            # Only a warning as we don't want to silence the other exception.
+            tsprint(f"WARNING: {msg}")
+        else:
+            raise
+
+
 def text_mode(stream):
     # Thank you https://stackoverflow.com/questions/31188333/text-mode-adapter-for-binary-or-text-mode-file
     if isinstance(stream, io.TextIOBase):
@@ -531,6 +767,175 @@ def multiprocessing_map(func, items, num_procs=num_physical_cores):
     return _multi_map(func, items, num_procs, multiprocessing.Pool)
 
 
+class OrderedChunks:
+    '''
+    Reassemble chunk results that arrive in any order, e.g. from multiprocessing_dag.
+
+        collector = OrderedChunks(number_of_chunks, emit)
+        for chunk_id, result in results:
+            if collector.add(chunk_id, result):
+                ...  # every chunk has been emitted
+
+    emit(chunk_id, result) is called once per chunk, in chunk order, as soon as all earlier chunks
+    have arrived;  only the results that arrive ahead of their turn are held in memory.
+    '''
+
+    def __init__(self, number_of_chunks, emit):
+        self.number_of_chunks = number_of_chunks
+        self.emit = emit
+        self.early = {}
+        self.next_chunk = 0
+
+    def add(self, chunk_id, result):
+        """ Return True once every chunk has been emitted """
+        assert self.next_chunk <= chunk_id < self.number_of_chunks and chunk_id not in self.early, f"OrderedChunks::unexpected chunk {chunk_id}"
+        self.early[chunk_id] = result
+        while self.next_chunk in self.early:
+            self.emit(self.next_chunk, self.early.pop(self.next_chunk))
+            self.next_chunk += 1
+        return self.next_chunk == self.number_of_chunks
+
+
+class TaskGraph:
+    '''
+    Tasks with prerequisites and resource weights, for multiprocessing_dag.
+
+        graph = TaskGraph()
+        graph.add(("100", 0), process_chunk, ("100", 0), group="100")
+        graph.add(("100", 1), process_chunk, ("100", 1), group="100")
+        graph.add(("100", -1), merge_chunks, partial(merge_args, "100"), depends_on=[("100", 0), ("100", 1)], group="100")
+
+    func is called with the single argument args, like multiprocessing_map does.  If args is callable,
+    it is called in the parent once the task is ready, so a dependent task can be handed the results
+    of its prerequisites.  Weight 0 tasks, e.g. closing the files the parent writes, run in the parent.
+    cost is the estimated run time of the task, in any unit shared by the graph, and group names the tasks,
+    e.g. the chunks of one species, whose results the parent collects in order;  see multiprocessing_dag.
+    '''
+
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, task_id, func, args, depends_on=(), weight=1, cost=0, group=None):
+        assert task_id not in self.tasks, f"TaskGraph::duplicated task {task_id}"
+        assert all(dep in self.tasks for dep in depends_on), f"TaskGraph::{task_id} depends on a task not added yet"
+        self.tasks[task_id] = (func, args, list(depends_on), weight, cost, group)
+
+    def __len__(self):
+        return len(self.tasks)
+
+
+def _task_done(finished, task_id, succeeded, result):
+    finished.put((task_id, succeeded, result))
+
+
+# use this *only* if the tasks are CPU bound;  yields (task_id, result) as they complete
+def multiprocessing_dag(graph, num_procs=num_physical_cores, initializer=None, initargs=()):
+    """ Run the tasks of graph on num_procs processes.  A task is dispatched only after all its prerequisites
+    have finished and their results have been consumed, so no worker ever sits waiting on another task.
+    Ready tasks go out largest cost first, so the longest tasks do not trail at the end of the run, where the
+    cost of a grouped task is the total cost of its group:  the groups are ranked by cost, but the tasks of one
+    group go out in the order they were added, so the parent only holds the few results of a group that finish
+    ahead of their turn.  Ready tasks are dispatched as long as the weights of the running tasks add up to at
+    most num_procs;  a task heavier than num_procs runs alone.  initializer(*initargs) runs once in each worker
+    process, e.g. to open the files every task of the worker reads. """
+    group_cost = {}
+    group_rank = {}
+    for rank, (task_id, (_, _, _, _, cost, group)) in enumerate(graph.tasks.items()):
+        key = ("task", task_id) if group is None else ("group", group)
+        group_cost[key] = group_cost.get(key, 0) + cost
+        group_rank.setdefault(key, rank)
+    priority = {}
+    for rank, (task_id, (_, _, _, weight, _, group)) in enumerate(graph.tasks.items()):
+        key = ("task", task_id) if group is None else ("group", group)
+        # Parent tasks first, since they cost no worker
+        priority[task_id] = (weight > 0, -group_cost[key], group_rank[key], rank)
+    waiting_on = {task_id: len(task[2]) for task_id, task in graph.tasks.items()}
+    dependents = {task_id: [] for task_id in graph.tasks}
+    for task_id, task in graph.tasks.items():
+        for dep in task[2]:
+            dependents[dep].append(task_id)
+    ready = [(priority[task_id], task_id) for task_id, count in waiting_on.items() if count == 0]
+    heapq.heapify(ready)
+
+    finished = queue.Queue()
+    running = {}
+    p = multiprocessing.Pool(num_procs, initializer, initargs)
+    try:
+        remaining = len(graph)
+        while remaining:
+            # Dispatch by priority until the next ready task does not fit
+            while ready:
+                task_id = ready[0][1]
+                func, args, _, weight, _, _ = graph.tasks[task_id]
+                weight = min(weight, num_procs)
+                if weight > 0 and running and sum(running.values()) + weight > num_procs:
+                    break
+                heapq.heappop(ready)
+                if callable(args):
+                    args = args()
+                if weight == 0:
+                    finished.put((task_id, True, func(args)))
+                    break
+                running[task_id] = weight
+                p.apply_async(func, (args,),
+                              callback=partial(_task_done, finished, task_id, True),
+                              error_callback=partial(_task_done, finished, task_id, False))
+
+            assert running or not finished.empty(), f"multiprocessing_dag::{remaining} tasks can never become ready"
+            task_id, succeeded, result = finished.get()
+            if not succeeded:
+                raise result
+            running.pop(task_id, None)
+            remaining -= 1
+            yield task_id, result
+
+            for dependent in dependents[task_id]:
+                waiting_on[dependent] -= 1
+                if waiting_on[dependent] == 0:
+                    heapq.heappush(ready, (priority[dependent], dependent))
+        p.close()
+        p.join()
+    finally:
+        p.terminate()
+
+
+def chunk_size_by_cost(chunk_size, site_cost, mean_site_cost):
+    """ Number of sites, each costing site_cost, that cost about as much as chunk_size sites of mean_site_cost """
+    if site_cost <= 0 or mean_site_cost <= 0:
+        return chunk_size
+    ratio = min(max(mean_site_cost / site_cost, 1 / CHUNK_COST_RATIO_LIMIT), CHUNK_COST_RATIO_LIMIT)
+    return max(1, int(chunk_size * ratio))
+
+
+def pack_contig_chunks(contigs, chunk_size, mean_site_cost=1.0):
+    """ Plan the chunks of the (contig_id, contig_length, site_cost) contigs, in the given order.
+    A contig longer than its chunk_size_by_cost is split into chunks of its own;  consecutive shorter contigs are
+    packed into one chunk while it costs at most chunk_size sites of mean_site_cost.  Yield each chunk as a list of
+    (contig_id, start, end, cost) slices, with 0-based start and exclusive end. """
+    chunk_cost = chunk_size * mean_site_cost
+    packed, packed_cost, packed_sites = [], 0, 0
+    for contig_id, contig_length, site_cost in contigs:
+        contig_chunk_size = chunk_size_by_cost(chunk_size, site_cost, mean_site_cost)
+        if contig_length > contig_chunk_size:
+            # Chunks keep the order of the contigs
+            if packed:
+                yield packed
+                packed, packed_cost, packed_sites = [], 0, 0
+            for start in range(0, contig_length, contig_chunk_size):
+                end = min(start + contig_chunk_size, contig_length)
+                yield [(contig_id, start, end, (end - start) * site_cost)]
+            continue
+        cost = contig_length * site_cost
+        if packed and (packed_cost + cost > chunk_cost or packed_sites + contig_length > chunk_size * CHUNK_COST_RATIO_LIMIT):
+            yield packed
+            packed, packed_cost, packed_sites = [], 0, 0
+        packed.append((contig_id, 0, contig_length, cost))
+        packed_cost += cost
+        packed_sites += contig_length
+    if packed:
+        yield packed
+
+
 # use this if func is not CPU bound
 def multithreading_map(func, items, num_threads=None):
     if not num_threads:
@@ -647,9 +1052,81 @@ def download_reference(ref_path, local_dir="."):
     return local_path
 
 
-def cat_files(files_of_chunks, one_file, number_of_chunks=20):
-    for temp_files in split(files_of_chunks, number_of_chunks):
-        command("cat " + " ".join(temp_files) + f" >> {one_file}", quiet=True)
+def compressed_frame(path, data):
+    """ Return data (str or bytes) compressed as one standalone frame in the format of path, e.g. for a header """
+    if isinstance(data, str):
+        data = data.encode()
+    if path.endswith(".lz4"):
+        if lz4_frame:
+            return lz4_frame.compress(data)
+        return subprocess.run(["lz4", "-c"], input=data, stdout=subprocess.PIPE, check=True).stdout
+    if path.endswith(".bz2"):
+        return bz2.compress(data)
+    if path.endswith(".gz"):
+        return gzip.compress(data, compresslevel=6)
+    return data
+
+
+def decompressed_frame(path, data):
+    """ Inverse of compressed_frame:  return the text held by data, compressed in the format of path.
+    data may also be a run of whole frames, e.g. a byte range of a file listed by a sidecar index. """
+    if path.endswith(".lz4"):
+        if lz4_frame:
+            frames = []
+            while data:
+                decompressor = lz4_frame.LZ4FrameDecompressor()
+                frames.append(decompressor.decompress(data))
+                data = decompressor.unused_data
+            data = b"".join(frames)
+        else:
+            data = subprocess.run(["lz4", "-dc"], input=data, stdout=subprocess.PIPE, check=True).stdout
+    elif path.endswith(".bz2"):
+        data = bz2.decompress(data)
+    elif path.endswith(".gz"):
+        data = gzip.decompress(data)
+    return data.decode()
+
+
+def concat_files(files_of_chunks, one_file, header=None, append=False):
+    """ Concatenate files into one_file in kernel space with os.sendfile, optionally after a header.
+    Concatenated lz4 frames, gzip members and bz2 streams decompress as one, so compressed chunks are
+    copied as they are, and the header is compressed as its own frame to match one_file. """
+    with open(one_file, "ab" if append else "wb") as out:
+        if header is not None:
+            out.write(compressed_frame(one_file, header))
+            out.flush()
+        out_fd = out.fileno()
+        for chunk_file in files_of_chunks:
+            with open(chunk_file, "rb") as chunk:
+                _sendfile(chunk, out, out_fd, os.fstat(chunk.fileno()).st_size)
+
+
+def _sendfile(chunk, out, out_fd, count):
+    in_fd = chunk.fileno()
+    offset = 0
+    try:
+        while offset < count:
+            sent = os.sendfile(out_fd, in_fd, offset, count - offset)
+            if sent == 0:
+                break
+            offset += sent
+    except OSError:
+        # Platforms without file to file sendfile:  copy the rest in user space
+        if offset > 0:
+            # sendfile wrote straight to out_fd, bypassing the file object's position
+            out.seek(0, os.SEEK_END)
+        chunk.seek(offset)
+        shutil.copyfileobj(chunk, out, NATIVE_BUFFER_SIZE)
+        out.flush()
+
+
+def remove_files(list_of_files):
+    """ Delete files without spawning rm;  missing files are fine """
+    for filename in list_of_files:
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
 
 # -------------- testing testing testing ---------------------
 
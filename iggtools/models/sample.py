@@ -26,14 +26,14 @@ def get_single_layout(sample_name, dbtype=""):
             # snps workflow output
             "snps_summary":           f"{sample_name}/snps/snps_summary.tsv",
             "snps_pileup":            f"{sample_name}/snps/{species_id}.snps.tsv.lz4",
+            "snps_pileup_index":      f"{sample_name}/snps/{species_id}.snps.index.tsv",
             "snps_repgenomes_bam":    f"{sample_name}/temp/snps/repgenomes.bam",
-            "chunk_pileup":           f"{sample_name}/temp/snps/{species_id}/snps_{chunk_id}.tsv.lz4",
+            "snps_pileup_bin":        f"{sample_name}/snps/{species_id}.snps.bin",
 
             # genes workflow output
             "genes_summary":          f"{sample_name}/genes/genes_summary.tsv",
             "genes_coverage":         f"{sample_name}/genes/{species_id}.genes.tsv.lz4",
-            "genes_pangenomes_bam":   f"{sample_name}/temp/genes/pangenomes.bam",
-            "chunk_coverage":         f"{sample_name}/temp/genes/{species_id}/genes_{chunk_id}.tsv.lz4"
+            "genes_pangenomes_bam":   f"{sample_name}/temp/genes/pangenomes.bam"
         }
     return per_species
 
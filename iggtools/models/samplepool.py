@@ -28,9 +28,6 @@ def get_pool_layout(dbtype=""):
             "snps_info":             f"snps/{species_id}/{species_id}.snps_info.tsv",
             "snps_freq":             f"snps/{species_id}/{species_id}.snps_freqs.tsv",
             "snps_depth":            f"snps/{species_id}/{species_id}.snps_depth.tsv",
-            "snps_info_by_chunk":    f"temp/{dbtype}/{species_id}/cid.{chunk_id}_snps_info.tsv",
-            "snps_freq_by_chunk":    f"temp/{dbtype}/{species_id}/cid.{chunk_id}_snps_freqs.tsv",
-            "snps_depth_by_chunk":   f"temp/{dbtype}/{species_id}/cid.{chunk_id}_snps_depth.tsv",
 
             # genes
             "genes_summary":         f"genes/genes_summary.tsv",
@@ -3,12 +3,15 @@
 import os
 from collections import defaultdict
 from iggtools.params.outputs import genomes as TABLE_OF_CONTENTS
-from iggtools.common.utils import select_from_tsv, sorted_dict, InputStream, download_reference, multithreading_map, command, num_physical_cores
+from iggtools.common.utils import tsprint, select_from_tsv, sorted_dict, InputStream, download_reference, multithreading_map, command, num_physical_cores
 from iggtools.params import outputs, inputs
+from iggtools.common.cache import ReferenceCache, cache_from_environ, DEFAULT_CACHE_BYTES, DEFAULT_CACHE_TTL
 from iggtools.params.inputs import igg
 
 
 MARKER_FILE_EXTS = ["fa", "fa.bwt", "fa.header", "fa.sa", "fa.sequence", "map"]
+# Sidecars annotate_genes builds next to each prokka genome, by filetype
+GENOME_SIDECAR_EXTS = {"genome_index": "fna.fai", "packed_genome": "fna.2bit"}
 
 def get_uhgg_layout(species_id, component="", genome_id=""):
     return {
@@ -24,7 +27,7 @@ def get_uhgg_layout(species_id, component="", genome_id=""):
         # marker_genes/phyeco/temp/{SPECIES_ID}/{GENOME_ID}/{GENOME_ID}.{hmmsearch, markers.fa, markers.map}
         "marker_genes":               f"marker_genes/{inputs.marker_set}/temp/{species_id}/{genome_id}/{genome_id}.{component}",
 
-        # gene_annotations/{SPECIES_ID}/{GENOME_ID}/{GENOME_ID}.{fna, faa, gff, log}
+        # gene_annotations/{SPECIES_ID}/{GENOME_ID}/{GENOME_ID}.{fna, fna.fai, fna.2bit, faa, gff, log, genes, sites.npz}
         "annotation_file":            f"gene_annotations/{species_id}/{genome_id}/{genome_id}.{component}",
 
         "imported_genome_file":       f"cleaned_imports/{species_id}/{genome_id}/{genome_id}.{component}",
@@ -47,10 +50,12 @@ def raw_genome_file(genome_id, representative_id):
 
 class MIDAS_IGGDB: # pylint: disable=too-few-public-methods
 
-    def __init__(self, midas_iggdb_dir=".", num_cores=num_physical_cores):
+    def __init__(self, midas_iggdb_dir=".", num_cores=num_physical_cores, cache_dir=None, cache_bytes=DEFAULT_CACHE_BYTES, cache_ttl=DEFAULT_CACHE_TTL):
         self.midas_iggdb_dir = midas_iggdb_dir
         self.num_cores = num_cores
-        self.local_toc = _fetch_file_from_s3((outputs.genomes, self.get_target_layout("genomes_toc", "", "", "", False)))
+        # Share downloads host-wide when a cache dir is given, or configured by IGGTOOLS_CACHE_DIR
+        self.cache = ReferenceCache(cache_dir, cache_bytes, cache_ttl) if cache_dir else cache_from_environ()
+        self.local_toc = _fetch_file_from_s3((outputs.genomes, self.get_target_layout("genomes_toc", "", "", "", False), self.cache))
         self.uhgg = UHGG(self.local_toc)
         self.igg = igg
 
@@ -70,7 +75,7 @@ class MIDAS_IGGDB: # pylint: disable=too-few-public-methods
             for ext in MARKER_FILE_EXTS:
                 s3_file = self.get_target_layout("marker_db", remote=True, component=ext)
                 dest_file = self.get_target_layout("marker_db", remote=False, component=ext)
-                fetched_files[ext] = _fetch_file_from_s3((s3_file, dest_file))
+                fetched_files[ext] = _fetch_file_from_s3((s3_file, dest_file, self.cache))
             return fetched_files
 
         # Download per species files
@@ -100,12 +105,19 @@ class MIDAS_IGGDB: # pylint: disable=too-few-public-methods
                 if filetype == "gene_seq":
                     s3_file = self.get_target_layout("annotation_file", True, "ffn", species_id, self.uhgg.representatives[species_id])
                     dest_file = self.get_target_layout("annotation_file", False, "ffn", species_id, self.uhgg.representatives[species_id])
+                if filetype == "site_annotations":
+                    s3_file = self.get_target_layout("annotation_file", True, "sites.npz", species_id, self.uhgg.representatives[species_id])
+                    dest_file = self.get_target_layout("annotation_file", False, "sites.npz", species_id, self.uhgg.representatives[species_id])
                 if filetype == "prokka_genome":
                     s3_file = self.get_target_layout("annotation_file", True, "fna", species_id, self.uhgg.representatives[species_id])
                     dest_file = self.get_target_layout("annotation_file", False, "fna", species_id, self.uhgg.representatives[species_id])
-                args_list.append((s3_file, dest_file))
+                if filetype in GENOME_SIDECAR_EXTS:
+                    s3_file = self.get_target_layout("annotation_file", True, GENOME_SIDECAR_EXTS[filetype], species_id, self.uhgg.representatives[species_id])
+                    dest_file = self.get_target_layout("annotation_file", False, GENOME_SIDECAR_EXTS[filetype], species_id, self.uhgg.representatives[species_id])
+                args_list.append((s3_file, dest_file, self.cache))
 
-            _fetched_files = multithreading_map(_fetch_file_from_s3, args_list, num_threads=self.num_cores)
+            fetch_file = _fetch_sidecar_from_s3 if filetype in GENOME_SIDECAR_EXTS else _fetch_file_from_s3
+            _fetched_files = multithreading_map(fetch_file, args_list, num_threads=self.num_cores)
             for species_index, species_id in enumerate(list_of_species_ids):
                 fetched_files[species_id] = _fetched_files[species_index]
             return fetched_files
@@ -117,21 +129,40 @@ class MIDAS_IGGDB: # pylint: disable=too-few-public-methods
         else:
             s3_file = os.path.join(self.igg, f"{filetype}.lz4")
             dest_file = os.path.join(self.midas_iggdb_dir, filetype)
-        return _fetch_file_from_s3((s3_file, dest_file))
+        return _fetch_file_from_s3((s3_file, dest_file, self.cache))
 
 
 def _fetch_file_from_s3(packed_args):
-    s3_path, dest_file = packed_args
+    s3_path, dest_file, cache = packed_args
 
     local_dir = os.path.dirname(dest_file)
     if not os.path.isdir(local_dir):
         command(f"mkdir -p {local_dir}")
 
+    if cache:
+        # Validated against the s3 ETag, so a stale dest_file is replaced
+        return cache.fetch(s3_path, dest_file)
     if os.path.exists(dest_file):
         return dest_file
     return download_reference(s3_path, local_dir)
 
 
+def _fetch_sidecar_from_s3(packed_args):
+    """ Fetch the sidecar of a prokka genome fetched beforehand;  return None if the database has none,
+    which leaves the sidecar to be built on first use """
+    s3_path, dest_file, _ = packed_args
+    try:
+        sidecar_file = _fetch_file_from_s3(packed_args)
+    except:
+        tsprint(f"No {s3_path} in the database;  it will be built on first use.")
+        return None
+    # Downloaded or linked from the cache, the sidecar must not look older than its genome, or it would be rebuilt
+    genome_file = dest_file.rsplit(".", 1)[0]
+    if os.path.exists(genome_file) and os.path.getmtime(sidecar_file) < os.path.getmtime(genome_file):
+        os.utime(sidecar_file)
+    return sidecar_file
+
+
 class UHGG:  # pylint: disable=too-few-public-methods
 
     def __init__(self, table_of_contents_tsv=TABLE_OF_CONTENTS):
@@ -111,6 +111,16 @@ snps_pileup_schema = {
 }
 
 
+# Sidecar index of snps_pileup: each row is one lz4 frame holding the sites of contig_id within [contig_start, contig_end]
+snps_pileup_index_schema = {
+    "contig_id": str,
+    "contig_start": int,
+    "contig_end": int,
+    "byte_offset": int,
+    "byte_length": int,
+}
+
+
 snps_info_schema = {
     "site_id": str,
     "major_allele": str,
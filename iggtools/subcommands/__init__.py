@@ -3,4 +3,4 @@ __all__ = ["aws_batch_init", "aws_batch_submit", "init", "build_pangenome", "imp
             "annotate_genes", "build_marker_genes", "collate_repgenome_markers", \
             "midas_run_species", "midas_run_genes", "midas_run_snps", \
             "midas_merge_species", "midas_merge_snps", "midas_merge_genes", \
-            "build_bowtie2_indexes", "build_gene_features", "example_subcommand"]
+            "build_bowtie2_indexes", "build_gene_features", "build_site_annotations", "example_subcommand"]
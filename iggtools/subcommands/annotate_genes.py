@@ -4,6 +4,8 @@ from multiprocessing import Semaphore
 from iggtools.common.argparser import add_subcommand, SUPPRESS
 from iggtools.common.utils import tsprint, retry, command, multithreading_map, find_files, upload, pythonpath, upload_star, download_reference
 from iggtools.models.uhgg import UHGG
+from iggtools.common.fasta import build_fasta_index
+from iggtools.common.twobit import pack_genome
 from iggtools.params import outputs
 
 
@@ -51,6 +53,11 @@ def annotate_genome(genome_id, species_id):
     for o in output_files:
         command(f"mv {subdir}/{o} .")
 
+    # The .fai sidecar lets the SNPs steps read contig lengths and sequence ranges without parsing the genome,
+    # and the packed genome serves their base and codon lookups at 2 bits per base
+    output_files.append(os.path.basename(build_fasta_index(f"{genome_id}.fna")))
+    output_files.append(os.path.basename(pack_genome(f"{genome_id}.fna")))
+
     return output_files
 
 
@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 import os
 import sys
-import Bio.SeqIO
 from iggtools.common.argparser import add_subcommand, SUPPRESS
 from iggtools.common.utils import tsprint, InputStream, retry, command, multithreading_map, find_files, upload, pythonpath, upload_star, num_physical_cores, download_reference
 from iggtools.models.uhgg import UHGG
 from iggtools.params import inputs, outputs
+from iggtools.common.fasta import read_fasta
 
 
 CONCURRENT_MARKER_GENES_IDENTIFY = num_physical_cores
@@ -56,9 +56,9 @@ def hmmsearch(genome_id, species_id, marker_genes_hmm, num_threads=1):
 def fetch_genes(annotated_genes):
     """" Lookup of seq_id to sequence for PATRIC genes """
     gene_seqs = {}
-    with InputStream(annotated_genes) as genes:
-        for rec in Bio.SeqIO.parse(genes, 'fasta'):
-            gene_seqs[rec.id] = str(rec.seq).upper()
+    with InputStream(annotated_genes, binary=True) as genes:
+        for gene_id, gene_seq in read_fasta(genes):
+            gene_seqs[gene_id] = gene_seq.upper()
     return gene_seqs
 
 
@@ -3,11 +3,11 @@ import os
 import sys
 from collections import defaultdict
 from multiprocessing import Semaphore
-import Bio.SeqIO
 from iggtools.common.argparser import add_subcommand, SUPPRESS
-from iggtools.common.utils import tsprint, InputStream, OutputStream, retry, command, split, multiprocessing_map, multithreading_hashmap, multithreading_map, num_vcpu, select_from_tsv, transpose, find_files, upload, upload_star, flatten, pythonpath
+from iggtools.common.utils import tsprint, InputStream, OutputStream, retry, command, multiprocessing_map, multithreading_hashmap, multithreading_map, num_vcpu, select_from_tsv, transpose, concat_files, find_files, upload, upload_star, flatten, pythonpath
 from iggtools.models.uhgg import UHGG
 from iggtools.params import outputs
+from iggtools.common.fasta import read_fasta
 
 
 CLUSTERING_PERCENTS = [99, 95, 90, 85, 80, 75]
@@ -30,7 +30,7 @@ def annotations_file(species_id, genome_id, component_extension):
 
 # 1. Occasional failures in aws s3 cp require a retry.
 # 2. In future, for really large numbers of genomes, we may prefer a separate wave of retries for all first-attempt failures.
-# 3. The Bio.SeqIO.parse() code is CPU-bound and thus it's best to run this function in a separate process for every genome.
+# 3. The FASTA parsing is CPU-bound and thus it's best to run this function in a separate process for every genome.
 @retry
 def clean_genes(packed_ids):
     species_id, genome_id = packed_ids
@@ -40,10 +40,9 @@ def clean_genes(packed_ids):
 
     with open(output_genes, 'w') as o_genes, \
          open(output_info, 'w') as o_info, \
-         InputStream(input_annotations, check_path=False) as genes:  # check_path=False because for flat directory structure it's slow
-        for rec in Bio.SeqIO.parse(genes, 'fasta'):
-            gene_id = rec.id
-            gene_seq = str(rec.seq).upper()
+         InputStream(input_annotations, check_path=False, binary=True) as genes:  # check_path=False because for flat directory structure it's slow
+        for gene_id, gene_seq in read_fasta(genes):
+            gene_seq = gene_seq.upper()
             gene_len = len(gene_seq)
             if gene_len == 0 or gene_id == '' or gene_id == '|':
                 # Documentation for why we ignore these gene_ids should be added to
@@ -256,12 +255,9 @@ def build_pangenome_slave(args):
 
     cleaned = multiprocessing_map(clean_genes, ((species_id, genome_id) for genome_id in species_genomes_ids))
 
-    command("rm -f genes.ffn genes.len")
-
-    for temp_files in split(cleaned, 20):  # keep "cat" commands short
-        ffn_files, len_files = transpose(temp_files)
-        command("cat " + " ".join(ffn_files) + " >> genes.ffn")
-        command("cat " + " ".join(len_files) + " >> genes.len")
+    ffn_files, len_files = transpose(cleaned)
+    concat_files(ffn_files, "genes.ffn")
+    concat_files(len_files, "genes.len")
 
     # The initial clustering to max_percent takes longest.
     max_percent, lower_percents = CLUSTERING_PERCENTS[0], CLUSTERING_PERCENTS[1:]
@@ -0,0 +1,164 @@
+import os
+import sys
+from multiprocessing import Semaphore
+import numpy as np
+from iggtools.common.argparser import add_subcommand, SUPPRESS
+from iggtools.common.utils import tsprint, retry, command, multithreading_map, find_files, upload, pythonpath, download_reference
+from iggtools.models.uhgg import UHGG
+from iggtools.params import outputs
+from iggtools.subcommands.import_uhgg import decode_genomes_arg
+from iggtools.common.twobit import PackedGenome, packed_genome_file
+from iggtools.subcommands.midas_merge_snps import read_gene_features, generate_boundaries, site_annotation_arrays
+
+
+# Up to this many concurrent per-genome site track builds.
+CONCURRENT_GENOME_BUILDS = Semaphore(48)
+
+
+def annotations_file(genome_id, species_id, filename):
+    # s3://microbiome-igg/2.0/gene_annotations/{SPECIES_ID}/{GENOME_ID}/{GENOME_ID}.sites.npz.lz4
+    return f"{outputs.annotations}/{species_id}/{genome_id}/{filename}"
+
+
+@retry
+def find_files_with_retry(f):
+    return find_files(f)
+
+
+def build_site_track(genes_file, genome_file, track_file):
+    """ Annotate every site of the genome once:  gene index, codon position, degeneracy and the four amino acids """
+    features = read_gene_features(genes_file)
+    genome = PackedGenome(packed_genome_file(genome_file))
+    gene_boundaries = generate_boundaries(features, genome)
+
+    contig_ids = []
+    contig_offsets = [0]
+    gene_ids = []
+    gene_types = []
+    columns = {"gene_index": [], "codon_position": [], "degeneracy": [], "amino_acids": []}
+    for contig_id, contig_len in genome.lengths.items():
+        curr_contig = gene_boundaries.get(contig_id)
+        gene_index, codon_position, degeneracy, amino_acids = site_annotation_arrays(curr_contig, np.arange(1, contig_len + 1))
+        if curr_contig is not None:
+            # Per contig gene indices into the per genome gene arrays
+            gene_index[gene_index >= 0] += len(gene_ids)
+            gene_ids.extend(curr_contig["gene_ids"].tolist())
+            gene_types.extend(curr_contig["gene_types"].tolist())
+        contig_ids.append(contig_id)
+        contig_offsets.append(contig_offsets[-1] + contig_len)
+        columns["gene_index"].append(gene_index.astype(np.int32))
+        columns["codon_position"].append(codon_position)
+        columns["degeneracy"].append(degeneracy)
+        columns["amino_acids"].append(amino_acids)
+
+    with open(track_file, "wb") as stream:
+        np.savez(stream,
+                 contig_ids=np.array(contig_ids, dtype=str),
+                 contig_offsets=np.array(contig_offsets, dtype=np.int64),
+                 gene_ids=np.array(gene_ids, dtype=str),
+                 gene_types=np.array(gene_types, dtype=str),
+                 **{key: np.concatenate(column) for key, column in columns.items()})
+    return True
+
+
+def build_site_annotations(args):
+    if args.zzz_slave_toc:
+        build_site_annotations_slave(args)
+    else:
+        build_site_annotations_master(args)
+
+
+def build_site_annotations_master(args):
+
+    # Fetch table of contents from s3.
+    # This will be read separately by the slave subcommand of each genome, so we make a local copy.
+    local_toc = download_reference(outputs.genomes)
+    db = UHGG(local_toc)
+    species_for_genome = db.genomes
+
+
+    def genome_work(genome_id):
+        assert genome_id in species_for_genome, f"Genome {genome_id} is not in the database."
+        species_id = species_for_genome[genome_id]
+
+        # The site track is the only output of a genome's build, uploaded once it is complete.
+        # Therefore, if this file exists in s3, there is no need to rebuild the genome's site track.
+        dest_file = annotations_file(genome_id, species_id, f"{genome_id}.sites.npz.lz4")
+        msg = f"Building site annotations for genome {genome_id} from species {species_id}."
+        if find_files_with_retry(dest_file):
+            if not args.force:
+                tsprint(f"Destination {dest_file} for genome {genome_id} site annotations already exists.  Specify --force to overwrite.")
+                return
+            msg = msg.replace("Building", "Rebuilding")
+
+
+        with CONCURRENT_GENOME_BUILDS:
+            tsprint(msg)
+            slave_log = "build_site_annotations.log"
+            slave_subdir = f"{species_id}__{genome_id}"
+            if not args.debug:
+                command(f"rm -rf {slave_subdir}")
+            if not os.path.isdir(slave_subdir):
+                command(f"mkdir {slave_subdir}")
+
+            # Recursive call via subcommand, one per genome.  Use subdir, redirect logs.
+            slave_cmd = f"cd {slave_subdir}; PYTHONPATH={pythonpath()} {sys.executable} -m iggtools build_site_annotations --genome {genome_id} --zzz_slave_mode --zzz_slave_toc {os.path.abspath(local_toc)} {'--debug' if args.debug else ''} &>> {slave_log}"
+            with open(f"{slave_subdir}/{slave_log}", "w") as slog:
+                slog.write(msg + "\n")
+                slog.write(slave_cmd + "\n")
+            try:
+                command(slave_cmd)
+            finally:
+                # Cleanup should not raise exceptions of its own, so as not to interfere with any
+                # prior exceptions that may be more informative.  Hence check=False.
+                upload(f"{slave_subdir}/{slave_log}", annotations_file(genome_id, species_id, slave_log + ".lz4"), check=False)
+                if not args.debug:
+                    command(f"rm -rf {slave_subdir}", check=False)
+
+    genome_id_list = decode_genomes_arg(args, species_for_genome)
+    multithreading_map(genome_work, genome_id_list, num_threads=48)
+
+
+def build_site_annotations_slave(args):
+    """
+    https://github.com/czbiohub/iggtools/wiki
+    """
+
+    violation = "Please do not call build_site_annotations_slave directly.  Violation"
+    assert args.zzz_slave_mode, f"{violation}:  Missing --zzz_slave_mode arg."
+    assert os.path.isfile(args.zzz_slave_toc), f"{violation}: File does not exist: {args.zzz_slave_toc}"
+
+    db = UHGG(args.zzz_slave_toc)
+    species_for_genome = db.genomes
+
+    genome_id = args.genomes
+    species_id = species_for_genome[genome_id]
+
+    # Prokka genome, plus the gene features from build_gene_features
+    genes_file = download_reference(annotations_file(genome_id, species_id, f"{genome_id}.genes.lz4"))
+    genome_file = download_reference(annotations_file(genome_id, species_id, f"{genome_id}.fna.lz4"))
+
+    out_file = f"{genome_id}.sites.npz"
+    dest_file = annotations_file(genome_id, species_id, f"{out_file}.lz4")
+
+    assert build_site_track(genes_file, genome_file, out_file)
+    upload(out_file, dest_file)
+
+
+def register_args(main_func):
+    subparser = add_subcommand('build_site_annotations', main_func, help='precompute per-site gene, codon and degeneracy annotations of representative genomes')
+    subparser.add_argument('--genomes',
+                           dest='genomes',
+                           required=False,
+                           help="genome[,genome...] whose site tracks to build;  alternatively, slice in format idx:modulus, e.g. 1:30, meaning build the site tracks of genomes whose ids are 1 mod 30; or, the special keyword 'all' meaning all genomes")
+    subparser.add_argument('--zzz_slave_toc',
+                           dest='zzz_slave_toc',
+                           required=False,
+                           help=SUPPRESS) # "reserved to pass table of contents from master to slave"
+    return main_func
+
+
+@register_args
+def main(args):
+    tsprint(f"Executing iggtools subcommand {args.subcommand} with args {vars(args)}.")
+    build_site_annotations(args)
@@ -1,6 +1,6 @@
 import os
 from iggtools.common.argparser import add_subcommand
-from iggtools.common.utils import tsprint, InputStream, OutputStream, select_from_tsv, retry, command, multithreading_map, find_files, upload, num_physical_cores, split, upload_star
+from iggtools.common.utils import tsprint, InputStream, OutputStream, select_from_tsv, retry, command, multithreading_map, find_files, upload, num_physical_cores, upload_star, concat_files
 from iggtools.models.uhgg import MIDAS_IGGDB, MARKER_FILE_EXTS, get_uhgg_layout
 from iggtools.params.schemas import MARKER_INFO_SCHEMA, PAN_GENE_INFO_SCHEMA
 
@@ -101,12 +101,10 @@ def collate_repgenome_markers(args):
 
     # Collate to phyeco.fa and phyeco.map
     collated_genes_fa = midas_iggdb.get_target_layout("marker_db", remote=False, component="fa")
-    for marker_fa_files in split(marker_genes_fasta.values(), 20):
-        command("cat " + " ".join(marker_fa_files) + f" >> {collated_genes_fa}")
+    concat_files(marker_genes_fasta.values(), collated_genes_fa, append=True)
 
     collaged_genes_map = midas_iggdb.get_target_layout("marker_db", remote=False, component="map")
-    for marker_map_files in split(marker_genes_maps.values(), 20):
-        command("cat " + " ".join(marker_map_files) + f" >> {collaged_genes_map}")
+    concat_files(marker_genes_maps.values(), collaged_genes_map, append=True)
 
     # Build hs-blastn index for the collated phyeco sequences
     cmd_index = f"hs-blastn index {collated_genes_fa} &>> {collate_log}"
@@ -1,11 +1,11 @@
 import os
 import sys
 from hashlib import md5
-import Bio.SeqIO
 from iggtools.common.argparser import add_subcommand, SUPPRESS
 from iggtools.common.utils import tsprint, InputStream, retry, command, multithreading_map, find_files, upload, pythonpath
 from iggtools.models.uhgg import UHGG, imported_genome_file, raw_genome_file
 from iggtools.params import inputs, outputs
+from iggtools.common.fasta import read_fasta
 
 
 CONCURRENT_GENOME_IMPORTS = 20
@@ -18,7 +18,7 @@ def unified_genome_id(genome_id):
 
 # 1. Occasional failures in aws s3 cp require a retry.
 # 2. In future, for really large numbers of genomes, we may prefer a separate wave of retries for all first-attempt failures.
-# 3. The Bio.SeqIO.parse() code is CPU-bound and thus it's best to run this function in a separate process for every genome.
+# 3. The FASTA parsing is CPU-bound and thus it's best to run this function in a separate process for every genome.
 @retry
 def clean_genome(genome_id, representative_id):
     #get_get_uhgg_layout(representative_id, "fna.lz4", genome_id)["raw_genome_file"]
@@ -26,9 +26,9 @@ def clean_genome(genome_id, representative_id):
     output_genome = f"{genome_id}.fna"
 
     with open(output_genome, 'w') as o_genome, \
-         InputStream(raw_genome, check_path=False) as genome:
-        for sn, rec in enumerate(Bio.SeqIO.parse(genome, 'fasta')):
-            contig_seq = str(rec.seq).upper()
+         InputStream(raw_genome, check_path=False, binary=True) as genome:
+        for sn, (_, contig_seq) in enumerate(read_fasta(genome)):
+            contig_seq = contig_seq.upper()
             contig_len = len(contig_seq)
             ugid = unified_genome_id(genome_id)
             contig_hash = md5(contig_seq.encode('utf-8')).hexdigest()[-6:]
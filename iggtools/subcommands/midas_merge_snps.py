@@ -1,18 +1,21 @@
 
+import os
+import io
 import json
 from collections import defaultdict
 from operator import itemgetter
-import multiprocessing
-from math import ceil
-from bisect import bisect
-import Bio.SeqIO
+from functools import lru_cache, partial
+import heapq
+import numpy as np
 
 from iggtools.models.samplepool import SamplePool
-from iggtools.common.utils import tsprint, num_physical_cores, command, InputStream, OutputStream, multiprocessing_map, multithreading_map, select_from_tsv
+from iggtools.common.utils import tsprint, num_physical_cores, pack_contig_chunks, InputStream, OutputStream, multiprocessing_map, multiprocessing_hashmap, TaskGraph, multiprocessing_dag, multithreading_map, select_from_tsv, OrderedChunks, compressed_frame, decompressed_frame
 from iggtools.models.uhgg import MIDAS_IGGDB
-from iggtools.params.schemas import snps_pileup_schema, snps_info_schema, format_data, genes_feature_schema
-from iggtools.subcommands.midas_run_snps import cat_files, scan_contigs
+from iggtools.params.schemas import snps_pileup_schema, snps_pileup_index_schema, snps_info_schema, format_data, genes_feature_schema
 from iggtools.common.argparser import add_subcommand
+from iggtools.common.pileup import BinaryPileup
+from iggtools.common.fasta import read_fasta_index, read_fasta
+from iggtools.common.twobit import PackedGenome, packed_genome_file
 
 
 DEFAULT_SAMPLE_COUNTS = 2
@@ -30,6 +33,11 @@ DEFAULT_SNP_POOLED_METHOD = "prevalence"
 DEFAULT_SNP_MAF = 0.05
 DEFAULT_SNP_TYPE = "mono, bi"
 
+DEFAULT_MERGE_ENGINE = "chunk"
+DEFAULT_STREAM_MAX_SAMPLES = 256
+
+SNP_TYPES = ["mono", "bi", "tri", "quad"]
+
 
 def register_args(main_func):
     subparser = add_subcommand('midas_merge_snps', main_func, help='pooled-samples SNPs calling')
@@ -47,7 +55,24 @@ def register_args(main_func):
                            type=int,
                            metavar="INT",
                            default=DEFAULT_CHUNK_SIZE,
-                           help=f"Number of genomic sites for the temporary chunk file  ({DEFAULT_CHUNK_SIZE})")
+                           help=f"Number of genomic sites per chunk at the mean cost over species;  species covered by more samples get smaller chunks ({DEFAULT_CHUNK_SIZE})")
+    subparser.add_argument('--merge_engine',
+                           dest='merge_engine',
+                           type=str,
+                           default=DEFAULT_MERGE_ENGINE,
+                           choices=['chunk', 'stream'],
+                           help=f"chunk: each chunk of sites reads its slice from every sample;  stream: each sample pileup is read once and k-way merged by site ({DEFAULT_MERGE_ENGINE})")
+    subparser.add_argument('--stream_max_samples',
+                           dest='stream_max_samples',
+                           type=int,
+                           metavar="INT",
+                           default=DEFAULT_STREAM_MAX_SAMPLES,
+                           help=f"The stream engine holds one open reader per sample pileup in every worker;  when a species has more samples than this, the chunk engine is used instead, to stay within the open files limit ({DEFAULT_STREAM_MAX_SAMPLES})")
+
+    subparser.add_argument('--prebuilt_site_annotations',
+                           action='store_true',
+                           default=False,
+                           help=f"Look up site annotations in the per-genome track prebuilt by build_site_annotations, instead of translating codons at run time.")
 
     subparser.add_argument('--midas_iggdb',
                            dest='midas_iggdb',
@@ -145,31 +170,27 @@ def register_args(main_func):
     return main_func
 
 
-def acgt_string(A, C, G, T):
-    return ','.join(map(str, (A, C, G, T)))
-
-
-def translate(codon):
-    """ Translate individual codon """
-    codontable = {
-        'ATA':'I', 'ATC':'I', 'ATT':'I', 'ATG':'M',
-        'ACA':'T', 'ACC':'T', 'ACG':'T', 'ACT':'T',
-        'AAC':'N', 'AAT':'N', 'AAA':'K', 'AAG':'K',
-        'AGC':'S', 'AGT':'S', 'AGA':'R', 'AGG':'R',
-        'CTA':'L', 'CTC':'L', 'CTG':'L', 'CTT':'L',
-        'CCA':'P', 'CCC':'P', 'CCG':'P', 'CCT':'P',
-        'CAC':'H', 'CAT':'H', 'CAA':'Q', 'CAG':'Q',
-        'CGA':'R', 'CGC':'R', 'CGG':'R', 'CGT':'R',
-        'GTA':'V', 'GTC':'V', 'GTG':'V', 'GTT':'V',
-        'GCA':'A', 'GCC':'A', 'GCG':'A', 'GCT':'A',
-        'GAC':'D', 'GAT':'D', 'GAA':'E', 'GAG':'E',
-        'GGA':'G', 'GGC':'G', 'GGG':'G', 'GGT':'G',
-        'TCA':'S', 'TCC':'S', 'TCG':'S', 'TCT':'S',
-        'TTC':'F', 'TTT':'F', 'TTA':'L', 'TTG':'L',
-        'TAC':'Y', 'TAT':'Y', 'TAA':'_', 'TAG':'_',
-        'TGC':'C', 'TGT':'C', 'TGA':'_', 'TGG':'W',
-    }
-    return codontable[str(codon)]
+CODON_TABLE = {
+    'ATA':'I', 'ATC':'I', 'ATT':'I', 'ATG':'M',
+    'ACA':'T', 'ACC':'T', 'ACG':'T', 'ACT':'T',
+    'AAC':'N', 'AAT':'N', 'AAA':'K', 'AAG':'K',
+    'AGC':'S', 'AGT':'S', 'AGA':'R', 'AGG':'R',
+    'CTA':'L', 'CTC':'L', 'CTG':'L', 'CTT':'L',
+    'CCA':'P', 'CCC':'P', 'CCG':'P', 'CCT':'P',
+    'CAC':'H', 'CAT':'H', 'CAA':'Q', 'CAG':'Q',
+    'CGA':'R', 'CGC':'R', 'CGG':'R', 'CGT':'R',
+    'GTA':'V', 'GTC':'V', 'GTG':'V', 'GTT':'V',
+    'GCA':'A', 'GCC':'A', 'GCG':'A', 'GCT':'A',
+    'GAC':'D', 'GAT':'D', 'GAA':'E', 'GAG':'E',
+    'GGA':'G', 'GGC':'G', 'GGG':'G', 'GGT':'G',
+    'TCA':'S', 'TCC':'S', 'TCG':'S', 'TCT':'S',
+    'TTC':'F', 'TTT':'F', 'TTA':'L', 'TTG':'L',
+    'TAC':'Y', 'TAT':'Y', 'TAA':'_', 'TAG':'_',
+    'TGC':'C', 'TGT':'C', 'TGA':'_', 'TGG':'W',
+}
+
+# Amino acid (ASCII) of the codon with ACGT_INDEX codes b0, b1, b2 at index 16*b0 + 4*b1 + b2
+AMINO_ACIDS = np.array([ord(CODON_TABLE[b0 + b1 + b2]) for b0 in "ACGT" for b1 in "ACGT" for b2 in "ACGT"], dtype=np.uint8)
 
 
 def complement(base):
@@ -192,35 +213,16 @@ def get_gen_seq(genome_seq, start, end, strand):
     return seq
 
 
-def index_replace(codon, allele, pos, strand):
-    """ Replace character at index i in string x with y"""
-    bases = list(codon)
-    bases[pos] = allele if strand == '+' else complement(allele)
-    return ''.join(bases)
-
-
-def fetch_ref_codon(ref_pos, curr_gene, curr_seq):
-    """ Fetch codon within gene for given site """
-    # position of site in gene
-    within_gene_position = ref_pos - curr_gene['start'] if curr_gene['strand'] == '+' else curr_gene['end'] - ref_pos
-    # position of site in codon
-    within_codon_position = within_gene_position % 3
-    # gene sequence (oriented start to stop)
-    ref_codon = curr_seq[within_codon_position-within_codon_position:within_codon_position-within_codon_position+3]
-    return ref_codon, within_codon_position
-
-
 def read_gene_sequence(fasta_file):
     """ Scan the genome file to get contig_id and contig_seq as ref_seq """
     contigs = {}
-    with InputStream(fasta_file) as file:
-        for rec in Bio.SeqIO.parse(file, 'fasta'):
-            contigs[rec.id] = {
-                "gene_id": rec.id,
-                "gene_len": len(rec.seq),
-                "gene_seq": str(rec.seq),
+    with InputStream(fasta_file, binary=True) as file:
+        for gene_id, gene_seq in read_fasta(file):
+            contigs[gene_id] = {
+                "gene_id": gene_id,
+                "gene_len": len(gene_seq),
+                "gene_seq": gene_seq,
             }
-    ## need to pay attention to reverse strand, probably by using scan_contigs()
     return contigs
 
 
@@ -246,435 +248,691 @@ def check_feature_counts(features, gene_seqs):
     return sorted(genes) == sorted(list(gene_seqs.keys()))
 
 
-def check_gene_sequences(contig_file, features, gene_seqs, species_id):
-    """ Check if the prokka gene sequences is same with extracting from genome"""
-    contig_seqs = scan_contigs(contig_file, species_id)
+def check_gene_sequences(genome, features, gene_seqs):
+    """ Check if the prokka gene sequences is same with extracting from the packed genome """
     flags = dict()
-    for ref_id, c in contig_seqs.items():
-        f = features[ref_id]
-        for gid, gdict in f.items():
-            flags[gid] = gene_seqs[gid]["gene_seq"] == get_gen_seq(c["contig_seq"], gdict['start'], gdict['end'], gdict['strand'])
+    for ref_id in genome.lengths:
+        for gid, gdict in features[ref_id].items():
+            genome_seq = genome.fetch(ref_id, gdict['start'] - 1, gdict['end']).tobytes().decode()
+            flags[gid] = gene_seqs[gid]["gene_seq"] == (rev_comp(genome_seq) if gdict['strand'] == "-" else genome_seq)
     return all(list(flags.values()))
 
 
-def binary_search_site(list_of_boundaries, ref_pos):
-    """ Binary search the boundaries, if return odd than within-ranges otherwise between-ranges """
-    flag = bisect(list_of_boundaries, ref_pos)
-    if flag % 2: # even: intergenic
-        return None
-    index = int((flag + 1) / 2)
-    ## Return the index of the ranges (1-based)
-    return index
-
-
-def generate_boundaries(features):
-    """ Given list of gene ranges, generate the desired, half-open boundaries by binary search """
-    gene_boundaries = defaultdict(dict)
-    for contig_id in features.keys():
-        feature_per_contig = features[contig_id]
-        # Sort features by starting position
-        feature_per_contig_sorted = dict(sorted(feature_per_contig.items(), key=feature_per_contig.get("start"), reverse=False))
-        feature_ranges = {gf['gene_id']: (gf['start'], gf['end']) for gf in feature_per_contig_sorted.values()} ## +1 double check
-        # TODO: double check non-overlapping ranges before flatten
-        feature_ranges_flat = tuple(_ for rt in tuple(feature_ranges.values()) for _ in rt)
-        # Convert ranges into half-open intervals.
-        boundaries = tuple(gr + 1 if idx%2 == 1 else gr for idx, gr in enumerate(feature_ranges_flat))
-        gene_boundaries[contig_id] = {"genes": list(feature_ranges.keys()), "boundaries": boundaries} #, "ranges": feature_ranges}
-        ## REMOVE ranges later after debugging mode
+def generate_boundaries(features, genome):
+    """ Per contig, the genes sorted by start position, as arrays for the batch search of annotate_sites.
+    Their codons are read off the packed genome, instead of holding the gene sequences. """
+    gene_boundaries = dict()
+    for contig_id, feature_per_contig in features.items():
+        genes = sorted(feature_per_contig.values(), key=itemgetter("start"))
+        starts = np.array([gf["start"] for gf in genes], dtype=np.int64)
+        ends = np.array([gf["end"] for gf in genes], dtype=np.int64)
+        gene_boundaries[contig_id] = {
+            "contig_id": contig_id,
+            "genome": genome,
+            "gene_ids": np.array([gf["gene_id"] for gf in genes], dtype=object),
+            "gene_types": np.array([gf["gene_type"] for gf in genes], dtype=object),
+            "starts": starts,
+            "ends": ends,
+            "minus_strand": np.array([gf["strand"] == "-" for gf in genes], dtype=bool),
+            "gene_lengths": ends - starts + 1,
+        }
     return gene_boundaries
 
 
-def compute_degenracy(ref_codon, within_codon_position, strand):
-    """ Compute degenracy """
-    amino_acids = []
-    for allele in ['A', 'C', 'G', 'T']: # + strand
-        codon = index_replace(ref_codon, allele, within_codon_position, strand) # +/- strand
-        amino_acid = translate(codon)
-        amino_acids.append(amino_acid)
-    unique_aa = set(amino_acids)
-    degeneracy = 4 - len(unique_aa) + 1
-    site_type = f"{degeneracy}D"
-    amino_acids = ','.join(amino_acids)
-    return site_type, amino_acids
-
-
-def annotate_site(ref_id, ref_pos, curr_contig, curr_feature, gene_seqs):
-    """ Annotate one genomic site, search against all genes for given species """
-    # Binary search the range of the given genomic site position
-    index = binary_search_site(curr_contig["boundaries"], ref_pos)
-    if index is None:
-        locus_type = "IGR" # even: intergenic
-        return (locus_type,)
-
-    curr_gene_id = curr_contig["genes"][index-1]
-    curr_gene = curr_feature[curr_gene_id]
-    locus_type = curr_gene["gene_type"]
-
-    if locus_type != "CDS":
-        return locus_type, curr_gene_id
-
-    curr_seq = gene_seqs[curr_gene_id]["gene_seq"]
-    assert len(curr_seq) % 3 == 0, f"gene must by divisible by 3 to id codons"
-    ref_codon, within_codon_position = fetch_ref_codon(ref_pos, curr_gene, curr_seq)
-    assert all(_ in ['A', 'T', 'C', 'G'] for _ in ref_codon), f"codon {ref_codon} for {ref_id}-{ref_pos} contain weird characters"
-
-    site_type, amino_acids = compute_degenracy(ref_codon, within_codon_position, curr_gene['strand'])
-    return locus_type, curr_gene_id, site_type, amino_acids
-
+def site_annotation_arrays(curr_contig, ref_pos):
+    """ Numeric annotation of the sites at the 1-based positions ref_pos of one contig, all at once:
+    index of the gene each site falls in (-1 for intergenic), position within the codon (-1 outside CDS),
+    degeneracy (0 outside CDS), and the (n, 4) amino acids coded by the codon with A, C, G, T at the site """
+
+    number_of_sites = len(ref_pos)
+    gene_index = np.full(number_of_sites, -1, dtype=np.int64)
+    codon_position = np.full(number_of_sites, -1, dtype=np.int8)
+    degeneracy = np.zeros(number_of_sites, dtype=np.int8)
+    site_amino_acids = np.zeros((number_of_sites, 4), dtype=np.uint8)
+    if curr_contig is None or number_of_sites == 0:
+        ## short contigs may not carry any gene
+        return gene_index, codon_position, degeneracy, site_amino_acids
+
+    # Binary search the gene starting last at or before each site, and check the site is within it
+    candidates = np.searchsorted(curr_contig["starts"], ref_pos, side="right") - 1
+    in_gene = candidates >= 0
+    in_gene[in_gene] = ref_pos[in_gene] <= curr_contig["ends"][candidates[in_gene]]
+    gene_index[in_gene] = candidates[in_gene]
+
+    in_cds = in_gene.copy()
+    in_cds[in_gene] = curr_contig["gene_types"][gene_index[in_gene]] == "CDS"
+    if not in_cds.any():
+        return gene_index, codon_position, degeneracy, site_amino_acids
+
+    genes = gene_index[in_cds]
+    assert np.all(curr_contig["gene_lengths"][genes] % 3 == 0), f"gene must by divisible by 3 to id codons"
+    minus_strand = curr_contig["minus_strand"][genes]
+
+    # position of site in gene, and in codon
+    within_gene_position = np.where(minus_strand, curr_contig["ends"][genes] - ref_pos[in_cds], ref_pos[in_cds] - curr_contig["starts"][genes])
+    within_codon_position = within_gene_position % 3
 
-def call_alleles(tuple_of_alleles, site_depth, snp_maf):
-    """ Compute the pooled allele frequencies and call SNPs """
+    # The codon bases, oriented from start to stop:  looked up in the packed genome, complemented on the minus strand
+    oriented = (within_gene_position - within_codon_position)[:, None] + np.arange(3)
+    genome_pos = np.where(minus_strand[:, None], curr_contig["ends"][genes][:, None] - 1 - oriented, curr_contig["starts"][genes][:, None] - 1 + oriented)
+    ref_codons = curr_contig["genome"].codes(curr_contig["contig_id"], genome_pos.ravel()).reshape(-1, 3)
+    ref_codons = np.where(minus_strand[:, None] & (ref_codons < 4), 3 - ref_codons, ref_codons)
+    assert np.all(ref_codons < 4), f"codons of {curr_contig['gene_ids'][genes[np.any(ref_codons >= 4, axis=1)][0]]} contain weird characters"
+
+    # Translate the codons with each of A, C, G, T at the site, complemented on the minus strand
+    sites = np.arange(len(genes))
+    cds_amino_acids = np.empty((len(genes), 4), dtype=np.uint8)
+    for allele in range(4):
+        codons = ref_codons.copy()
+        codons[sites, within_codon_position] = np.where(minus_strand, 3 - allele, allele)
+        cds_amino_acids[:, allele] = AMINO_ACIDS[16 * codons[:, 0] + 4 * codons[:, 1] + codons[:, 2]]
+
+    # Compute degeneracy
+    sorted_amino_acids = np.sort(cds_amino_acids, axis=1)
+    unique_aa = 1 + np.count_nonzero(sorted_amino_acids[:, 1:] != sorted_amino_acids[:, :-1], axis=1)
+
+    codon_position[in_cds] = within_codon_position
+    degeneracy[in_cds] = 4 - unique_aa + 1
+    site_amino_acids[in_cds] = cds_amino_acids
+    return gene_index, codon_position, degeneracy, site_amino_acids
+
+
+def annotate_sites(curr_contig, ref_pos):
+    """ Annotate the sites at the 1-based positions ref_pos of one contig, all at once:
+    return the locus_type, gene_id, site_type and amino_acids of each site """
+
+    number_of_sites = len(ref_pos)
+    locus_types = np.full(number_of_sites, "IGR", dtype=object)
+    gene_ids = np.full(number_of_sites, None, dtype=object)
+    site_types = np.full(number_of_sites, None, dtype=object)
+    amino_acids = np.full(number_of_sites, None, dtype=object)
+    if curr_contig is None or number_of_sites == 0:
+        return locus_types, gene_ids, site_types, amino_acids
+
+    if "site_track" in curr_contig:
+        # Prebuilt by build_site_annotations:  look the sites up by position
+        offsets = ref_pos - 1
+        gene_index = curr_contig["gene_index"][offsets]
+        degeneracy = curr_contig["degeneracy"][offsets]
+        site_amino_acids = curr_contig["amino_acids"][offsets]
+    else:
+        gene_index, _, degeneracy, site_amino_acids = site_annotation_arrays(curr_contig, ref_pos)
+
+    in_gene = gene_index >= 0
+    locus_types[in_gene] = curr_contig["gene_types"][gene_index[in_gene]]
+    gene_ids[in_gene] = curr_contig["gene_ids"][gene_index[in_gene]]
+
+    in_cds = degeneracy > 0
+    site_types[in_cds] = [f"{d}D" for d in degeneracy[in_cds].tolist()]
+    four_amino_acids = np.ascontiguousarray(site_amino_acids[in_cds]).tobytes().decode()
+    amino_acids[in_cds] = [",".join(four_amino_acids[i:i+4]) for i in range(0, len(four_amino_acids), 4)]
+    return locus_types, gene_ids, site_types, amino_acids
+
+
+def load_site_annotations(site_annotation_file):
+    """ Per contig views into the site annotation track of a representative genome, as built by build_site_annotations """
+    track = np.load(site_annotation_file, allow_pickle=False)
+    contig_offsets = track["contig_offsets"]
+    gene_ids = track["gene_ids"].astype(object)
+    gene_types = track["gene_types"].astype(object)
+    columns = {key: track[key] for key in ("gene_index", "codon_position", "degeneracy", "amino_acids")}
+
+    site_annotations = dict()
+    for ci, contig_id in enumerate(track["contig_ids"].tolist()):
+        contig_start, contig_end = contig_offsets[ci], contig_offsets[ci+1]
+        site_annotations[contig_id] = {"site_track": True, "gene_ids": gene_ids, "gene_types": gene_types}
+        for key, column in columns.items():
+            site_annotations[contig_id][key] = column[contig_start:contig_end]
+    return site_annotations
+
+
+def call_alleles(pooled_counts, site_depth, snp_maf):
+    """ Compute the pooled allele frequencies and call SNPs, for all the (sites, 4) pooled_counts at once """
 
     # Only when you have seen all the revelant samples, you can call SNPs
     # keep alleles passing the min allele frequency
-    alleles_above_cutoff = tuple(al for al in tuple_of_alleles if al[1] / site_depth >= snp_maf)
+    above_cutoff = pooled_counts / site_depth[:, None] >= snp_maf
 
-    # classify SNPs type
-    number_alleles = len(alleles_above_cutoff)
-    snp_type = ["mono", "bi", "tri", "quad"][number_alleles - 1]
+    # classify SNPs type by the number of alleles above the cutoff: 1 mono, 2 bi, 3 tri, 4 quad
+    number_alleles = above_cutoff.sum(axis=1)
 
     # In the event of a tie -- biallelic site with 50/50 freq split -- the allele declared major is
-    # the one that comes later in the "ACGT" lexicographic order.
-    alleles_above_cutoff = sorted(alleles_above_cutoff, key=itemgetter(1), reverse=True)[:2]
-    major_allele = alleles_above_cutoff[0][0]
-    minor_allele = alleles_above_cutoff[-1][0] # for fixed sites, same as major allele
+    # the one that comes earlier in the "ACGT" lexicographic order, as the sort is stable.
+    ranked = np.argsort(-np.where(above_cutoff, pooled_counts, -1), axis=1, kind="stable")
+    major_index = ranked[:, 0]
+    minor_index = np.where(number_alleles > 1, ranked[:, 1], major_index) # for fixed sites, same as major allele
 
-    return (major_allele, minor_allele, snp_type)
+    return major_index, minor_index, number_alleles
 
 
-def design_chunks(contigs_files, gene_features_files, gene_seqs_files, chunk_size):
-    """ Chunks_of_continuous_genomic_sites and each chunk is indexed by (species_id, chunk_id) """
+def design_chunks(contigs_files, annotation_files, chunk_size):
+    """ Chunks_of_continuous_genomic_sites and each chunk is indexed by (species_id, chunk_id).
+    Return the TaskGraph of the chunks, plus one task per species that closes its files after its last chunk.
+    Chunks are cut by estimated cost, so that species covered by many samples are split finer than chunk_size sites,
+    and consecutive short contigs are packed into one chunk. """
 
-    # dict of semaphore and acquire before
-    global semaphore_for_species
+    global number_of_chunks_for_species
     global species_sliced_pileup_path
     global species_samples_dict
 
     global pool_of_samples
     global dict_of_species
+    global global_args
 
-    semaphore_for_species = dict()
-    species_sliced_pileup_path = defaultdict(dict)
+    number_of_chunks_for_species = dict()
+    species_sliced_pileup_path = dict()
     species_samples_dict = defaultdict(dict)
 
-    argument_list = []
+    # Mean cost of a site over all the species, weighted by genome length
+    site_costs = {species.id: pooled_site_cost(species) for species in dict_of_species.values()}
+    genome_lengths = {species.id: species.samples[0].profile[species.id]["genome_length"] for species in dict_of_species.values()}
+    total_length = sum(genome_lengths.values())
+    mean_site_cost = sum(site_costs[species_id] * genome_lengths[species_id] for species_id in site_costs) / total_length if total_length else 1.0
+
+    # Contig lengths come off the .fai of each genome, indexed concurrently across species;  no sequence is read here
+    genome_indexes = species_genome_indexes(contigs_files, global_args.num_cores)
+
+    graph = TaskGraph()
     for species in dict_of_species.values():
         species_id = species.id
-        contigs = scan_contigs(contigs_files[species_id], species_id)
+        contigs = genome_indexes[species_id]
 
         samples_depth = species.samples_depth
-        samples_snps_pileup = [sample.get_target_layout("snps_pileup", species_id) for sample in list(species.samples)]
+        samples_snps_pileup = [sample_pileup_path(sample, species_id) for sample in list(species.samples)]
+        samples_snps_index = [sample_pileup_index_path(sample, species_id) for sample in list(species.samples)]
 
         species_samples_dict["samples_depth"][species_id] = samples_depth
         species_samples_dict["samples_snps_pileup"][species_id] = samples_snps_pileup
+        species_samples_dict["samples_snps_index"][species_id] = samples_snps_index
 
         total_samples_count = len(species.samples)
 
-        chunk_id = 0
-        for contig_id, contig in contigs.items():
-            contig_length = contig["contig_len"]
+        contigs_to_chunk = [(contig_id, contig_len, site_costs[species_id]) for contig_id, (contig_len, _, _, _) in contigs.items()]
 
+        chunk_id = 0
+        for contig_slices in pack_contig_chunks(contigs_to_chunk, chunk_size, mean_site_cost):
             # pileup is 1-based index
-            if contig_length <= chunk_size:
-                my_args = (species_id, chunk_id, contig_id, 1, contig_length, total_samples_count, gene_features_files[species_id], gene_seqs_files[species_id]) ##cz
-                argument_list.append(my_args)
-
-                snps_info_fp = pool_of_samples.get_target_layout("snps_info_by_chunk", species_id, chunk_id)
-                snps_freq_fp = pool_of_samples.get_target_layout("snps_freq_by_chunk", species_id, chunk_id)
-                snps_depth_fp = pool_of_samples.get_target_layout("snps_depth_by_chunk", species_id, chunk_id)
-                species_sliced_pileup_path[species_id][chunk_id] = (snps_info_fp, snps_freq_fp, snps_depth_fp)
-                chunk_id += 1
-            else:
-                number_of_chunks = ceil(contig_length/chunk_size) - 1
-                for ni, ci in enumerate(range(0, contig_length, chunk_size)):
-                    if ni == number_of_chunks:
-                        my_args = (species_id, chunk_id, contig_id, ci+1, contig_length, total_samples_count, gene_features_files[species_id], gene_seqs_files[species_id]) ##cz
-                    else:
-                        my_args = (species_id, chunk_id, contig_id, ci+1, ci+chunk_size, total_samples_count, gene_features_files[species_id], gene_seqs_files[species_id]) ##cz
-                    argument_list.append(my_args)
-
-                    snps_info_fp = pool_of_samples.get_target_layout("snps_info_by_chunk", species_id, chunk_id)
-                    snps_freq_fp = pool_of_samples.get_target_layout("snps_freq_by_chunk", species_id, chunk_id)
-                    snps_depth_fp = pool_of_samples.get_target_layout("snps_depth_by_chunk", species_id, chunk_id)
-                    species_sliced_pileup_path[species_id][chunk_id] = (snps_info_fp, snps_freq_fp, snps_depth_fp)
-                    chunk_id += 1
+            contig_ranges = [(contig_id, ci+1, contig_end) for contig_id, ci, contig_end, _ in contig_slices]
+            my_args = (species_id, chunk_id, contig_ranges, total_samples_count, annotation_files[species_id])
+            graph.add((species_id, chunk_id), process_chunk_of_sites, my_args, cost=sum(cost for _, _, _, cost in contig_slices), group=species_id)
+            chunk_id += 1
         tsprint(f"design_chunks::{species_id}::finish chunksnum.{chunk_id}")
 
-        # Submit the merge jobs
-        argument_list.append((species_id, -1))
+        # The chunks' results are appended to these files by the parent, in chunk order
         snps_info_fp = pool_of_samples.get_target_layout("snps_info", species_id)
         snps_freq_fp = pool_of_samples.get_target_layout("snps_freq", species_id)
         snps_depth_fp = pool_of_samples.get_target_layout("snps_depth", species_id)
-        species_sliced_pileup_path[-1][species_id] = (snps_info_fp, snps_freq_fp, snps_depth_fp)
+        species_sliced_pileup_path[species_id] = (snps_info_fp, snps_freq_fp, snps_depth_fp)
+        number_of_chunks_for_species[species_id] = chunk_id
 
-        # Create a semaphore with number_of_chunks for current species
-        semaphore_for_species[species_id] = multiprocessing.Semaphore(chunk_id)
-        for _ in range(chunk_id):
-            semaphore_for_species[species_id].acquire()
+        # The parent holds the open species files, so this task runs there (weight 0) once all chunks are written
+        graph.add((species_id, -1), finish_species_pooled_snps, species_id, depends_on=[(species_id, ci) for ci in range(chunk_id)], weight=0, group=species_id)
 
-    return argument_list
+    return graph
 
 
-def merge_chunks_by_species(species_id):
+def pooled_site_cost(species):
+    """ Estimated cost of pooling one site of species:  one output row, plus the pileup row of each sample that covers it """
+    return 1 + sum(sample.profile[species.id]["fraction_covered"] for sample in species.samples)
+
+
+def collect_chunks_of_sites(task_results):
+    """ Append the pooled SNPs of each chunk to the species files in chunk order, as they arrive from the workers """
+
+    global number_of_chunks_for_species
+    global species_pileup_writers
+
+    species_pileup_writers = dict()
+    collectors = {species_id: OrderedChunks(number_of_chunks, partial(append_chunk_pooled_snps, species_id)) \
+                  for species_id, number_of_chunks in number_of_chunks_for_species.items()}
+
+    proc_flags = []
+    for (species_id, chunk_id), result in task_results:
+        if chunk_id == -1:
+            proc_flags.append(result)
+            continue
+        collectors[species_id].add(chunk_id, result)
+    return proc_flags
+
+
+def append_chunk_pooled_snps(species_id, chunk_id, pooled_snps_blocks):
+    """ Append one chunk's snps_info, snps_freqs and snps_depth blocks;  write the headers with the first chunk """
 
-    global global_args
     global species_sliced_pileup_path
+    global species_pileup_writers
     global dict_of_species
 
-    snps_info_fp, snps_freq_fp, snps_depth_fp = species_sliced_pileup_path[-1][species_id]
-    sliced_pileup_files = list(species_sliced_pileup_path[species_id].values())
-    snps_info_files = [fi[0] for fi in sliced_pileup_files]
-    snps_freq_files = [fi[1] for fi in sliced_pileup_files]
-    snps_depth_files = [fi[2] for fi in sliced_pileup_files]
-    samples_names = dict_of_species[species_id].fetch_samples_names()
+    if chunk_id == 0:
+        samples_names = dict_of_species[species_id].fetch_samples_names()
+        headers = ["\t".join(list(snps_info_schema.keys())) + "\n", "site_id\t" + "\t".join(samples_names) + "\n", "site_id\t" + "\t".join(samples_names) + "\n"]
+        species_pileup_writers[species_id] = [open(out_fp, "wb") for out_fp in species_sliced_pileup_path[species_id]]
+        for stream, out_fp, header in zip(species_pileup_writers[species_id], species_sliced_pileup_path[species_id], headers):
+            stream.write(compressed_frame(out_fp, header))
 
-    # Add header for the merged-chunks
-    with OutputStream(snps_info_fp) as out_info:
-        out_info.write("\t".join(list(snps_info_schema.keys())) + "\n")
-    cat_files(snps_info_files, snps_info_fp, 20)
+    for stream, block in zip(species_pileup_writers[species_id], pooled_snps_blocks):
+        stream.write(block)
 
-    with OutputStream(snps_freq_fp) as out_freq:
-        out_freq.write("site_id\t" + "\t".join(samples_names) + "\n")
-    cat_files(snps_freq_files, snps_freq_fp, 10)
 
-    with OutputStream(snps_depth_fp) as out_depth:
-        out_depth.write("site_id\t" + "\t".join(samples_names) + "\n")
-    cat_files(snps_depth_files, snps_depth_fp, 10)
+def finish_species_pooled_snps(species_id):
+    """ Close the snps_info, snps_freqs and snps_depth files of species_id """
+    global species_pileup_writers
+    for stream in species_pileup_writers.pop(species_id):
+        stream.close()
+    tsprint(f"  CZ::finish_species_pooled_snps::{species_id}::finish")
+    return "worked"
+
+
+def sample_pileup_path(sample, species_id):
+    """ Prefer the columnar binary pileup when midas_run_snps wrote one """
+    binary_pileup = sample.get_target_layout("snps_pileup_bin", species_id)
+    if os.path.exists(binary_pileup):
+        return binary_pileup
+    return sample.get_target_layout("snps_pileup", species_id)
+
 
-    if not global_args.debug:
-        for s_file in snps_info_files + snps_freq_files + snps_depth_files:
-            command(f"rm -rf {s_file}", quiet=True)
+def sample_pileup_index_path(sample, species_id):
+    """ Sidecar index of the lz4 TSV pileup, absent for pileups written before the index existed """
+    index_path = sample.get_target_layout("snps_pileup_index", species_id)
+    return index_path if os.path.exists(index_path) else None
 
-    return True
+
+@lru_cache(maxsize=None)
+def load_pileup_index(index_path):
+    """ Read the sidecar index into contig_id => list of (contig_start, contig_end, byte_offset, byte_length) """
+    pileup_index = defaultdict(list)
+    with InputStream(index_path) as stream:
+        for contig_id, contig_start, contig_end, byte_offset, byte_length in select_from_tsv(stream, selected_columns=snps_pileup_index_schema, result_structure=tuple):
+            pileup_index[contig_id].append((contig_start, contig_end, byte_offset, byte_length))
+    return pileup_index
+
+
+def pileup_byte_range(index_path, contig_id, contig_start, contig_end):
+    """ The frames covering [contig_start, contig_end] are adjacent in the pileup, so one byte range spans them all """
+    frames = [(offset, length) for start, end, offset, length in load_pileup_index(index_path).get(contig_id, []) if start <= contig_end and end >= contig_start]
+    if not frames:
+        return None
+    first_offset = min(offset for offset, _ in frames)
+    return (first_offset, max(offset + length for offset, length in frames) - first_offset)
+
+
+def read_pileup_rows(snps_pileup_path, snps_index_path, contig_id, contig_start, contig_end):
+    """ Yield snps_pileup_schema tuples for the sites of contig_id within [contig_start, contig_end] """
+    if snps_pileup_path.endswith(".bin"):
+        with BinaryPileup(snps_pileup_path) as pileup:
+            yield from pileup.rows(contig_id, contig_start, contig_end)
+        return
+    if snps_index_path:
+        byte_range = pileup_byte_range(snps_index_path, contig_id, contig_start, contig_end)
+        if byte_range is None:
+            return
+        # Only the frames of the chunk are read and decompressed, in-process, and trimmed to the exact range here
+        offset, length = byte_range
+        with open(snps_pileup_path, "rb") as stream:
+            stream.seek(offset)
+            frames = stream.read(length)
+        for row in select_from_tsv(io.StringIO(decompressed_frame(snps_pileup_path, frames)), schema=snps_pileup_schema, result_structure=tuple):
+            if row[0] == contig_id and contig_start <= row[1] <= contig_end:
+                yield row
+        return
+    awk_command = f"awk \'$1 == \"{contig_id}\" && $2 >= {contig_start} && $2 <= {contig_end}\'"
+    with InputStream(snps_pileup_path, awk_command) as stream:
+        yield from select_from_tsv(stream, schema=snps_pileup_schema, result_structure=tuple)
+
+
+def read_all_pileup_rows(snps_pileup_path):
+    """ Yield every snps_pileup_schema tuple of one sample pileup, in the order midas_run_snps wrote them """
+    if snps_pileup_path.endswith(".bin"):
+        with BinaryPileup(snps_pileup_path) as pileup:
+            yield from pileup.all_rows()
+        return
+    with InputStream(snps_pileup_path) as stream:
+        yield from select_from_tsv(stream, selected_columns=snps_pileup_schema, result_structure=tuple)
+
+
+def tag_rows(rows, sample_index, contig_rank):
+    """ Tag each row with its merge key (contig rank, position) and its sample;  the keys must strictly increase """
+    last_key = None
+    for row in rows:
+        assert row[0] in contig_rank, f"tag_rows::sample {sample_index} pileup has unknown contig {row[0]}"
+        key = (contig_rank[row[0]], row[1])
+        assert last_key is None or key > last_key, f"tag_rows::sample {sample_index} pileup is not sorted in the merge order at {row[0]}:{row[1]}"
+        last_key = key
+        yield key, row, sample_index
+
+
+def pileup_contig_order(snps_pileup_path, snps_index_path, genome_contigs):
+    """ The contig ids of one sample pileup in the order midas_run_snps wrote them, off the contig table of the
+    binary pileup or the sidecar index of the TSV.  TSV pileups without an index were written before the BAM
+    header order, by versions of midas_run_snps that sorted the contigs by id. """
+    if snps_pileup_path.endswith(".bin"):
+        with BinaryPileup(snps_pileup_path) as pileup:
+            return pileup.contigs()
+    if snps_index_path:
+        return list(load_pileup_index(snps_index_path).keys())
+    return sorted(genome_contigs)
+
+
+def merged_contig_rank(species_id, contig_orders, genome_contigs):
+    """ Rank the contigs so that the contig order of every sample pileup is increasing, the genome order breaking ties.
+    Samples whose shared contigs come in different relative orders cannot be stream merged. """
+    genome_rank = {contig_id: rank for rank, contig_id in enumerate(genome_contigs)}
+    contigs = set(genome_contigs)
+    successors = defaultdict(set)
+    for contig_order in contig_orders:
+        contigs.update(contig_order)
+        for prev_contig, next_contig in zip(contig_order, contig_order[1:]):
+            successors[prev_contig].add(next_contig)
+    predecessors_count = defaultdict(int)
+    for next_contigs in successors.values():
+        for next_contig in next_contigs:
+            predecessors_count[next_contig] += 1
+
+    tie_break = lambda contig_id: (genome_rank.get(contig_id, len(genome_rank)), contig_id)
+    ready = [(tie_break(contig_id), contig_id) for contig_id in contigs if predecessors_count[contig_id] == 0]
+    heapq.heapify(ready)
+    contig_rank = {}
+    while ready:
+        _, contig_id = heapq.heappop(ready)
+        contig_rank[contig_id] = len(contig_rank)
+        for next_contig in successors[contig_id]:
+            predecessors_count[next_contig] -= 1
+            if predecessors_count[next_contig] == 0:
+                heapq.heappush(ready, (tie_break(next_contig), next_contig))
+    assert len(contig_rank) == len(contigs), f"merged_contig_rank::{species_id} sample pileups hold their contigs in different orders;  rerun midas_run_snps on the older samples"
+    return contig_rank
+
+
+def read_pileup_arrays(snps_pileup_path, snps_index_path, contig_id, contig_start, contig_end):
+    """ Return the ref_pos, ref_allele and (n, 4) acgt arrays of the sites of contig_id within [contig_start, contig_end] """
+    if snps_pileup_path.endswith(".bin"):
+        with BinaryPileup(snps_pileup_path) as pileup:
+            ref_pos, ref_allele, acgt = pileup.fetch(contig_id, contig_start, contig_end)
+            return np.array(ref_pos, dtype=np.int64), np.array(ref_allele), np.array(acgt)
+    rows = list(read_pileup_rows(snps_pileup_path, snps_index_path, contig_id, contig_start, contig_end))
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8), np.zeros((0, 4), dtype=np.uint32)
+    _, ref_pos, ref_allele, _, A, C, G, T = zip(*rows)
+    return np.array(ref_pos, dtype=np.int64), np.frombuffer("".join(ref_allele).encode(), dtype=np.uint8), np.array((A, C, G, T), dtype=np.uint32).T
+
+
+def new_accumulator(contig_id, contig_start, contig_end, total_samples_count):
+    """ Dense accumulator for the sites [contig_start, contig_end] of one contig, indexed by position offset:
+    the A, C, G, T read counts of every <site, sample> pair passing the per sample site filters. """
+    number_of_sites = contig_end - contig_start + 1
+    return {
+        "contig_id": contig_id,
+        "contig_start": contig_start,
+        "ref_allele": np.zeros(number_of_sites, dtype=np.uint8),
+        "sample_acgt": np.zeros((number_of_sites, total_samples_count, 4), dtype=np.uint32),
+        "sample_passed": np.zeros((number_of_sites, total_samples_count), dtype=bool),
+    }
 
 
 def accumulate(accumulator, proc_args):
     """ Accumulate read_counts and sample_counts for a chunk of sites for one sample,
     at the same time remember <site, sample>'s A, C, G, T read counts."""
 
-    contig_id, contig_start, contig_end, sample_index, snps_pileup_path, total_samples_count, genome_coverage = proc_args
+    contig_id, contig_start, contig_end, sample_index, snps_pileup_path, snps_index_path, genome_coverage = proc_args
     tsprint(f"    CZ2::pool_one_chunk_across_samples::{contig_id}-{contig_start}-{sample_index}::start accumulate")
 
     global global_args
     args = global_args
 
-    # Output column indices
-    c_A, c_C, c_G, c_T, c_count_samples, c_scA, c_scC, c_scG, c_scT = range(9)
+    ref_pos, ref_allele, acgt = read_pileup_arrays(snps_pileup_path, snps_index_path, contig_id, contig_start, contig_end)
 
-    # Alternative way is to read once to memory
-    awk_command = f"awk \'$1 == \"{contig_id}\" && $2 >= {contig_start} && $2 <= {contig_end}\'"
-    with InputStream(snps_pileup_path, awk_command) as stream:
-        for row in select_from_tsv(stream, schema=snps_pileup_schema, result_structure=dict):
-            # Unpack frequently accessed columns
-            ref_id, ref_pos, ref_allele = row["ref_id"], row["ref_pos"], row["ref_allele"]
-            A, C, G, T, depth = row["count_a"], row["count_c"], row["count_g"], row["count_t"], row["depth"]
-
-            # Per sample site filters:
-            # if the given <site.i, sample.j> fails the within-sample site filter,
-            # then sample.j should not be used for the calculation of site.i pooled statistics.
-            site_ratio = depth / genome_coverage
-            if depth < args.site_depth:
-                continue
-            if site_ratio > args.site_ratio:
-                continue
-
-            # Compute derived columns
-            site_id = f"{ref_id}|{ref_pos}|{ref_allele}"
-
-            # sample counts for A, C, G, T
-            sc_ACGT = [0, 0, 0, 0]
-            for i, nt_count in enumerate((A, C, G, T)):
-                if nt_count > 0: # presence or absence
-                    sc_ACGT[i] = 1
-
-            # Aggragate
-            acc = accumulator.get(site_id)
-            if acc:
-                acc[c_A] += A
-                acc[c_C] += C
-                acc[c_G] += G
-                acc[c_T] += T
-                acc[c_count_samples] += 1
-                acc[c_scA] += sc_ACGT[0]
-                acc[c_scC] += sc_ACGT[1]
-                acc[c_scG] += sc_ACGT[2]
-                acc[c_scT] += sc_ACGT[3]
-            else:
-                # initialize each sample_index column with 0,0,0,0, particularly
-                # for <site, sample> pair either absent or fail the site filters
-                acc = [A, C, G, T, 1, sc_ACGT[0], sc_ACGT[1], sc_ACGT[2], sc_ACGT[3]] + ([acgt_string(0, 0, 0, 0)] * total_samples_count)
-                accumulator[site_id] = acc
-
-            # This just remember the value from each sample.
-            # Under sparse mode, site with zero read counts are not kept.
-            acgt_str = acgt_string(A, C, G, T)
-            assert acc[9 + sample_index] == '0,0,0,0' and acgt_str != '0,0,0,0', f"accumulate error::{site_id}:{acc}:{sample_index}"
-            acc[9 + sample_index] = acgt_str
+    # Per sample site filters:
+    # if the given <site.i, sample.j> fails the within-sample site filter,
+    # then sample.j should not be used for the calculation of site.i pooled statistics.
+    depth = acgt.sum(axis=1, dtype=np.int64)
+    passed = (depth >= args.site_depth) & (depth / genome_coverage <= args.site_ratio)
+
+    offsets = ref_pos[passed] - accumulator["contig_start"]
+    accumulator["ref_allele"][offsets] = ref_allele[passed]
+    accumulator["sample_acgt"][offsets, sample_index] = acgt[passed]
+    accumulator["sample_passed"][offsets, sample_index] = True
 
     tsprint(f"    CZ2::pool_one_chunk_across_samples::{contig_id}-{contig_start}-{sample_index}::finish accumulate")
 
 
-def compute_and_write_pooled_snps(accumulator, total_samples_count, species_id, chunk_id, gene_feature_file, gene_seq_file):
-    """ For each site, compute the pooled-major-alleles, site_depth, and vector of sample_depths and sample_minor_allele_freq"""
+def accumulate_site(accumulator, row, sample_index, genome_coverage, args):
+    """ Add one <site, sample> pileup row to the accumulator """
 
-    global global_args
-    args = global_args
+    _, ref_pos, ref_allele, depth, A, C, G, T = row
 
-    global species_sliced_pileup_path
-    snps_info_fp, snps_freq_fp, snps_depth_fp = species_sliced_pileup_path[species_id][chunk_id]
+    # Same per sample site filters as accumulate
+    if depth < args.site_depth:
+        return
+    if depth / genome_coverage > args.site_ratio:
+        return
+
+    offset = ref_pos - accumulator["contig_start"]
+    accumulator["ref_allele"][offset] = ord(ref_allele)
+    accumulator["sample_acgt"][offset, sample_index] = (A, C, G, T)
+    accumulator["sample_passed"][offset, sample_index] = True
 
-    # TODO: how to pass on these two dictionaries, instead in parse it over and over again in each chunk ...?
+
+@lru_cache(maxsize=4)
+def load_annotations(annotation_files):
+    """ Gene features, their search boundaries and gene sequences, as used by annotate_sites;  or the prebuilt site track.
+    Parsed once per species in each worker process:  consecutive chunks of a species share the result. """
+    gene_feature_file, packed_genome, site_annotation_file = annotation_files
+    if site_annotation_file:
+        return load_site_annotations(site_annotation_file)
     features_by_contig = read_gene_features(gene_feature_file)
-    gene_boundaries = generate_boundaries(features_by_contig)
-    gene_seqs = read_gene_sequence(gene_seq_file)
+    return generate_boundaries(features_by_contig, PackedGenome(packed_genome))
+
+
+def compute_pooled_snps(accumulator, total_samples_count, annotations):
+    """ For each site, compute the pooled-major-alleles, site_depth, and vector of sample_depths and sample_minor_allele_freq"""
 
+    global global_args
+    args = global_args
 
-    info_dict = {}
+    gene_boundaries = annotations
+    ref_id = accumulator["contig_id"]
+    sample_acgt = accumulator["sample_acgt"]
+    sample_passed = accumulator["sample_passed"]
+
+    # Pooled read counts and sample counts, over the samples passing the site filters
+    count_samples = sample_passed.sum(axis=1)
+    read_counts = sample_acgt.sum(axis=1, dtype=np.int64)
+    sample_counts = (sample_acgt > 0).sum(axis=1)
+
+    # Skip site with low prevalence for core sites and vice versa for rare sites
+    prevalence = count_samples / total_samples_count
+    keep = count_samples > 0
+    if args.site_type == "common":
+        keep &= prevalence >= args.site_prev
+    if args.site_type == "rare":
+        keep &= prevalence <= args.site_prev
+
+    # compute the pooled major allele based on the pooled-read-counts (abundance) or pooled-sample-counts (prevalence)
+    sites = np.flatnonzero(keep)
+    if args.snp_pooled_method == "abundance":
+        pooled_counts = read_counts[sites]
+        site_depth = pooled_counts.sum(axis=1)
+    else:
+        pooled_counts = sample_counts[sites]
+        site_depth = count_samples[sites]
+    major_index, minor_index, number_alleles = call_alleles(pooled_counts, site_depth, args.snp_maf)
+
+    # Keep sites with desired snp_type
+    if 'any' not in args.snp_type:
+        wanted = np.isin(number_alleles, [SNP_TYPES.index(snp_type) + 1 for snp_type in args.snp_type])
+        sites, major_index, minor_index, number_alleles = sites[wanted], major_index[wanted], minor_index[wanted], number_alleles[wanted]
+
+    # Extract the read counts of pooled major alleles for samples
+    # only accounts for reads matching either major or minor allele
+    acgt = sample_acgt[sites].astype(np.int64)
+    major_counts = np.take_along_axis(acgt, major_index[:, None, None], axis=2)[:, :, 0]
+    minor_counts = np.take_along_axis(acgt, minor_index[:, None, None], axis=2)[:, :, 0]
+    fixed = (major_index == minor_index)[:, None]
+    sample_depths = np.where(fixed, major_counts, major_counts + minor_counts)
+    # frequency of minor allele frequency
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sample_mafs = np.where(sample_depths == 0, -1.0, np.where(fixed, 0.0, minor_counts / sample_depths))
+
+    list_of_info = []
     list_of_freqs = []
     list_of_depths = []
+    ref_positions = (sites + accumulator["contig_start"]).tolist()
+    ref_alleles = accumulator["ref_allele"][sites].tobytes().decode()
+    # Annotate all the sites of the chunk at once
+    locus_types, gene_ids, site_types, amino_acids = annotate_sites(gene_boundaries.get(ref_id), sites + accumulator["contig_start"])
+    for i, ref_pos in enumerate(ref_positions):
+        site_id = f"{ref_id}|{ref_pos}|{ref_alleles[i]}"
+        site = sites[i]
+        list_of_info.append([site_id, "ACGT"[major_index[i]], "ACGT"[minor_index[i]], int(count_samples[site]), SNP_TYPES[number_alleles[i] - 1]] + \
+                            read_counts[site].tolist() + sample_counts[site].tolist() + [locus_types[i], gene_ids[i], site_types[i], amino_acids[i]])
+        list_of_freqs.append([site_id] + sample_mafs[i].tolist())
+        list_of_depths.append([site_id] + sample_depths[i].tolist())
 
-    for site_id, site_info in accumulator.items():
-        rcA, rcC, rcG, rcT, count_samples, scA, scC, scG, scT = site_info[:9]
+    return list_of_info, list_of_freqs, list_of_depths
 
-        # Skip site with low prevalence for core sites and vice versa for rare sites
-        prevalence = count_samples / total_samples_count
-        if args.site_type == "common" and prevalence < args.site_prev:
-            continue
-        if args.site_type == "rare" and prevalence > args.site_prev:
-            continue
 
-        # compute the pooled major allele based on the pooled-read-counts (abundance) or pooled-sample-counts (prevalence)
-        if args.snp_pooled_method == "abundance":
-            site_depth = sum((rcA, rcC, rcG, rcT))
-            tuple_of_alleles = (('A', rcA), ('C', rcC), ('G', rcG), ('T', rcT))
-        else:
-            site_depth = count_samples
-            tuple_of_alleles = (('A', scA), ('C', scC), ('G', scG), ('T', scT))
+def write_pooled_snps(pooled_snps, out_info, out_freq, out_depth):
+    """ Append the pooled SNPs rows to already opened snps_info, snps_freqs and snps_depth streams """
+    list_of_info, list_of_freqs, list_of_depths = pooled_snps
 
-        major_allele, minor_allele, snp_type = call_alleles(tuple_of_alleles, site_depth, args.snp_maf)
-        major_index = 'ACGT'.index(major_allele)
-        minor_index = 'ACGT'.index(minor_allele)
+    for vals in list_of_info:
+        out_info.write("\t".join(map(format_data, vals)) + "\n")
 
-        # Keep sites with desired snp_type
-        if ('any' not in args.snp_type and snp_type not in args.snp_type):
-            continue
+    for line in list_of_freqs:
+        out_freq.write("\t".join(map(format_data, line)) + "\n")
 
-        # Extract the read counts of pooled major alleles for samples
-        sample_depths = [] # only accounts for reads matching either major or minor allele
-        sample_mafs = [] # frequency of minor allele frequency
-        for sample_index in range(9, len(site_info)):
-            # for each <site, sample> pair
-            rc_ACGT = [int(rc) for rc in site_info[sample_index].split(",")]
+    for line in list_of_depths:
+        out_depth.write("\t".join(map(str, line)) + "\n")
 
-            sample_depth = rc_ACGT[major_index] if major_index == minor_index else rc_ACGT[major_index] + rc_ACGT[minor_index]
-            maf_by_sample = -1.0 if sample_depth == 0 else (0.0 if major_index == minor_index else rc_ACGT[minor_index] / sample_depth)
 
-            sample_depths.append(sample_depth)
-            sample_mafs.append(maf_by_sample)
+def pool_one_chunk_across_samples(packed_args):
+    """ For genome sites from one chunk, which may pack several short contigs, scan across all the sample,
+    compute pooled SNPs and return them as one block each of snps_info, snps_freqs and snps_depth rows """
 
-        # Annotate one site
-        ref_id, ref_pos, ref_allele = site_id.rsplit("|", 2)
-        ref_pos = int(ref_pos) # ref_pos is 1-based
-        if ref_id not in gene_boundaries:
-            annots = ("IGR",) ## short contigs may not carry any gene
-        else:
-            curr_contig = gene_boundaries[ref_id]
-            curr_feature = features_by_contig[ref_id]
-            # TODO: if the binary search is the bottle neck of the performance, then benchmark first and then try batch binery search
-            #tsprint(f"    CZ2::compute_and_write_pooled_snps::{ref_id}-{ref_pos}::start annotate_site")
-            annots = annotate_site(ref_id, ref_pos, curr_contig, curr_feature, gene_seqs)
-            #tsprint(f"    CZ2::compute_and_write_pooled_snps::{ref_id}-{ref_pos}::finish annotate_site {annots[0]}") # running time depends on the locus_type
-
-        locus_type = annots[0]
-        gene_id = annots[1] if len(annots) > 1 else None
-        site_type = annots[2] if len(annots) > 2 else None
-        amino_acids = annots[3] if len(annots) > 2 else None
-
-
-        info_dict[site_id] = {
-            "site_id": site_id,
-            "major_allele": major_allele,
-            "minor_allele": minor_allele,
-            "count_samples": count_samples,
-            "snp_type": snp_type,
-            "rcA": rcA, "rcC": rcC, "rcG": rcG, "rcT": rcT,
-             "scA": scA, "scC": scC, "scG": scG, "scT":scT,
-             "locus_type": locus_type,
-             "gene_id": gene_id,
-             "site_type": site_type,
-             "amino_acids": amino_acids
-        }
-        list_of_freqs.append([site_id] + sample_mafs)
-        list_of_depths.append([site_id] + sample_depths)
+    global species_samples_dict
+    global species_sliced_pileup_path
 
+    species_id, chunk_id, contig_ranges, total_samples_count, annotation_files = packed_args
 
-    with OutputStream(snps_info_fp) as out_info:
-        for vals in info_dict.values():
-            out_info.write("\t".join(map(format_data, vals)) + "\n")
+    list_of_snps_pileup_path = species_samples_dict["samples_snps_pileup"][species_id]
+    list_of_snps_index_path = species_samples_dict["samples_snps_index"][species_id]
+    list_of_sample_depths = species_samples_dict["samples_depth"][species_id]
 
-    with OutputStream(snps_freq_fp) as out_freq:
-        for line in list_of_freqs:
-            out_freq.write("\t".join(map(format_data, line)) + "\n")
+    annotations = load_annotations(annotation_files)
+    out_info, out_freq, out_depth = io.StringIO(), io.StringIO(), io.StringIO()
+    for contig_id, contig_start, contig_end in contig_ranges:
+        tsprint(f"    CZ::pool_one_chunk_across_samples::{species_id}-{chunk_id}::start accumulate {contig_id}")
+        accumulator = new_accumulator(contig_id, contig_start, contig_end, total_samples_count)
+        for sample_index in range(total_samples_count):
+            proc_args = (contig_id, contig_start, contig_end, sample_index, list_of_snps_pileup_path[sample_index], list_of_snps_index_path[sample_index], list_of_sample_depths[sample_index])
+            accumulate(accumulator, proc_args)
+        tsprint(f"    CZ::pool_one_chunk_across_samples::{species_id}-{chunk_id}::finish accumulate {contig_id}")
 
-    with OutputStream(snps_depth_fp) as out_depth:
-        for line in list_of_depths:
-            out_depth.write("\t".join(map(str, line)) + "\n")
+        pooled_snps = compute_pooled_snps(accumulator, total_samples_count, annotations)
+        write_pooled_snps(pooled_snps, out_info, out_freq, out_depth)
 
-    return True
+    return tuple(compressed_frame(out_fp, out.getvalue()) for out_fp, out in zip(species_sliced_pileup_path[species_id], (out_info, out_freq, out_depth)))
 
 
-def pool_one_chunk_across_samples(packed_args):
-    """ For genome sites from one chunk, scan across all the sample, compute pooled SNPs and write to file """
+def species_genome_indexes(contigs_files, num_procs):
+    """ The .fai index of the representative genome of each species in dict_of_species """
+    global dict_of_species
+    species_ids = [species.id for species in dict_of_species.values()]
+    indexes = multiprocessing_hashmap(read_fasta_index, [contigs_files[species_id] for species_id in species_ids], num_procs)
+    return {species_id: indexes[contigs_files[species_id]] for species_id in species_ids}
+
+
+def design_streams(contigs_files, annotation_files):
+    """ One sample-major task per species """
 
-    global semaphore_for_species
-    global species_sliced_pileup_path
     global species_samples_dict
+    global dict_of_species
+    global global_args
+
+    species_samples_dict = defaultdict(dict)
 
-    species_id, chunk_id, contig_id, contig_start, contig_end, total_samples_count, gene_feature_file, gene_seq_file = packed_args
+    genome_indexes = species_genome_indexes(contigs_files, global_args.num_cores)
+
+    argument_list = []
+    for species in dict_of_species.values():
+        species_id = species.id
+        contigs = genome_indexes[species_id]
+
+        samples_snps_pileup = [sample_pileup_path(sample, species_id) for sample in list(species.samples)]
+        samples_snps_index = [sample_pileup_index_path(sample, species_id) for sample in list(species.samples)]
+        # The merge key follows the contig order the sample pileups were written in, which depends on the midas_run_snps version
+        contig_orders = [pileup_contig_order(snps_pileup_path, snps_index_path, contigs.keys()) for snps_pileup_path, snps_index_path in zip(samples_snps_pileup, samples_snps_index)]
+
+        species_samples_dict["samples_depth"][species_id] = species.samples_depth
+        species_samples_dict["samples_snps_pileup"][species_id] = samples_snps_pileup
+        species_samples_dict["contig_rank"][species_id] = merged_contig_rank(species_id, contig_orders, list(contigs.keys()))
+        species_samples_dict["contig_length"][species_id] = {contig_id: contig_index[0] for contig_id, contig_index in contigs.items()}
+
+        argument_list.append((species_id, annotation_files[species_id]))
+    return argument_list
+
+
+def pool_species_by_stream(packed_args):
+    """ Read each sample pileup of the species exactly once, k-way merged by site, and write the pooled SNPs.
+    Every sample pileup stays open for the whole species, an fd or an mmap each, which --stream_max_samples bounds. """
+
+    global global_args
+    global species_samples_dict
+    global pool_of_samples
+    global dict_of_species
+
+    args = global_args
+    species_id, annotation_files = packed_args
+    tsprint(f"  CZ::pool_species_by_stream::{species_id}::start")
 
     list_of_snps_pileup_path = species_samples_dict["samples_snps_pileup"][species_id]
     list_of_sample_depths = species_samples_dict["samples_depth"][species_id]
+    contig_rank = species_samples_dict["contig_rank"][species_id]
+    contig_length = species_samples_dict["contig_length"][species_id]
+    total_samples_count = len(list_of_snps_pileup_path)
+    samples_names = dict_of_species[species_id].fetch_samples_names()
 
-    try:
-        tsprint(f"    CZ::pool_one_chunk_across_samples::{species_id}-{chunk_id}::start accumulate")
-        accumulator = dict()
-        for sample_index in range(total_samples_count):
-            proc_args = (contig_id, contig_start, contig_end, sample_index, list_of_snps_pileup_path[sample_index], total_samples_count, list_of_sample_depths[sample_index])
-            accumulate(accumulator, proc_args)
-        tsprint(f"    CZ::pool_one_chunk_across_samples::{species_id}-{chunk_id}::finish accumulate")
+    annotations = load_annotations(annotation_files)
 
-        tsprint(f"    CZ::pool_one_chunk_across_samples::{species_id}-{chunk_id}::start compute_and_write_pooled_snps")
-        compute_and_write_pooled_snps(accumulator, total_samples_count, species_id, chunk_id, gene_feature_file, gene_seq_file)
-        tsprint(f"    CZ::pool_one_chunk_across_samples::{species_id}-{chunk_id}::finish compute_and_write_pooled_snps")
-    finally:
-        semaphore_for_species[species_id].release() # no deadlock
+    # Every pileup is sorted by (contig, position), which tag_rows checks, so is the merged stream.
+    sample_streams = [tag_rows(read_all_pileup_rows(snps_pileup_path), sample_index, contig_rank) for sample_index, snps_pileup_path in enumerate(list_of_snps_pileup_path)]
+    merged_rows = heapq.merge(*sample_streams, key=itemgetter(0))
 
+    with OutputStream(pool_of_samples.get_target_layout("snps_info", species_id)) as out_info, \
+         OutputStream(pool_of_samples.get_target_layout("snps_freq", species_id)) as out_freq, \
+         OutputStream(pool_of_samples.get_target_layout("snps_depth", species_id)) as out_depth:
 
-def process_chunk_of_sites(packed_args):
+        out_info.write("\t".join(list(snps_info_schema.keys())) + "\n")
+        out_freq.write("site_id\t" + "\t".join(samples_names) + "\n")
+        out_depth.write("site_id\t" + "\t".join(samples_names) + "\n")
 
-    global semaphore_for_species
-    global species_sliced_pileup_path
-    global species_samples_dict
+        # Pooled statistics are flushed one window of chunk_size sites at a time, clipped to the end of the contig
+        accumulator = None
+        current_window = None
+        for _, row, sample_index in merged_rows:
+            window = (row[0], (row[1] - 1) // args.chunk_size)
+            if window != current_window:
+                if accumulator is not None:
+                    write_pooled_snps(compute_pooled_snps(accumulator, total_samples_count, annotations), out_info, out_freq, out_depth)
+                window_start = window[1] * args.chunk_size + 1
+                window_end = min(window_start + args.chunk_size - 1, contig_length[row[0]])
+                accumulator = new_accumulator(row[0], window_start, window_end, total_samples_count)
+                current_window = window
+            accumulate_site(accumulator, row, sample_index, list_of_sample_depths[sample_index], args)
+        if accumulator is not None:
+            write_pooled_snps(compute_pooled_snps(accumulator, total_samples_count, annotations), out_info, out_freq, out_depth)
+
+    tsprint(f"  CZ::pool_species_by_stream::{species_id}::finish")
+    return "worked"
 
-    if packed_args[1] == -1:
-        # Merge chunks_of_sites' pileup results per species
-        species_id = packed_args[0]
-        number_of_chunks = len(species_sliced_pileup_path[species_id])
 
-        tsprint(f"  CZ::process_chunk_of_sites::{species_id}--1::wait merge_chunks_by_species")
-        for _ in range(number_of_chunks):
-            semaphore_for_species[species_id].acquire()
-        tsprint(f"  CZ::process_chunk_of_sites::{species_id}--1::start merge_chunks_by_species")
-        merge_chunks_by_species(species_id)
-        tsprint(f"  CZ::process_chunk_of_sites::{species_id}--1::finish merge_chunks_by_species")
-        return "worked"
+def process_chunk_of_sites(packed_args):
 
     species_id, chunk_id = packed_args[:2]
     tsprint(f"  CZ::process_chunk_of_sites::{species_id}-{chunk_id}::start pool_one_chunk_across_samples")
-    pool_one_chunk_across_samples(packed_args)
+    pooled_snps_blocks = pool_one_chunk_across_samples(packed_args)
     tsprint(f"  CZ::process_chunk_of_sites::{species_id}-{chunk_id}::finish pool_one_chunk_across_samples")
 
-    return "worked"
+    return pooled_snps_blocks
 
 
 def midas_merge_snps(args):
@@ -694,7 +952,6 @@ def midas_merge_snps(args):
 
         pool_of_samples.create_dirs(["outdir", "tempdir"], args.debug)
         pool_of_samples.create_species_subdirs(species_ids_of_interest, "outdir", args.debug)
-        pool_of_samples.create_species_subdirs(species_ids_of_interest, "tempdir", args.debug)
 
         pool_of_samples.write_summary_files(dict_of_species, "snps")
 
@@ -703,36 +960,59 @@ def midas_merge_snps(args):
 
         tsprint(f"CZ::fetch_iggdb_files::start")
         contigs_files = midas_iggdb.fetch_files("prokka_genome", species_ids_of_interest) #contigs
+        # The .fai and the packed genome come from the database build, so the genomes are neither scanned nor packed here
+        midas_iggdb.fetch_files("genome_index", species_ids_of_interest)
+        midas_iggdb.fetch_files("packed_genome", species_ids_of_interest)
         gene_features_files = midas_iggdb.fetch_files("gene_feature", species_ids_of_interest)
         gene_seqs_files = midas_iggdb.fetch_files("gene_seq", species_ids_of_interest)
+        site_annotation_files = midas_iggdb.fetch_files("site_annotations", species_ids_of_interest) if args.prebuilt_site_annotations else {}
         tsprint(f"CZ::fetch_iggdb_files::finish")
 
+        # The packed genomes serve the codon lookups;  genomes without one are packed concurrently
+        packed_genomes = multiprocessing_hashmap(packed_genome_file, [contigs_files[species_id] for species_id in species_ids_of_interest], args.num_cores)
+        annotation_files = {species_id: (gene_features_files[species_id], packed_genomes[contigs_files[species_id]], site_annotation_files.get(species_id)) for species_id in species_ids_of_interest}
+
         # TODO move this part to database build
         def check_annotation_setup(species_id):
             features_file = gene_features_files[species_id]
             gene_seq_file = gene_seqs_files[species_id]
-            genome_file = contigs_files[species_id]
+            genome = PackedGenome(packed_genomes[contigs_files[species_id]])
 
             features = read_gene_features(features_file)
             gene_seqs = read_gene_sequence(gene_seq_file)
 
             assert check_feature_counts(features, gene_seqs), f"Gene feature counts disagree with Prokka gene ffn file for species {species_id}"
-            assert check_gene_sequences(genome_file, features, gene_seqs, species_id), f"Prokka gene sequences disagree with gene ranges computation for species {species_id}"
+            assert check_gene_sequences(genome, features, gene_seqs), f"Prokka gene sequences disagree with gene ranges computation for species {species_id}"
 
             return True
 
         assert all(multithreading_map(check_annotation_setup, species_ids_of_interest, num_threads=10))
 
 
-        # Compute pooled SNPs by the unit of chunks_of_sites
-        tsprint(f"CZ::design_chunks::start")
-        argument_list = design_chunks(contigs_files, gene_features_files, gene_seqs_files, args.chunk_size)
-        tsprint(f"CZ::design_chunks::finish")
+        merge_engine = args.merge_engine
+        max_samples_count = max(len(species.samples) for species in dict_of_species.values())
+        if merge_engine == "stream" and max_samples_count > args.stream_max_samples:
+            tsprint(f"CZ::merge_engine::{max_samples_count} samples exceed --stream_max_samples {args.stream_max_samples}, falling back to the chunk engine")
+            merge_engine = "chunk"
 
+        if merge_engine == "stream":
+            # Compute pooled SNPs by streaming every sample pileup once per species
+            tsprint(f"CZ::design_streams::start")
+            argument_list = design_streams(contigs_files, annotation_files)
+            tsprint(f"CZ::design_streams::finish")
 
-        tsprint(f"CZ::multiprocessing_map::start")
-        proc_flags = multiprocessing_map(process_chunk_of_sites, argument_list, args.num_cores)
-        tsprint(f"CZ::multiprocessing_map::finish")
+            tsprint(f"CZ::multiprocessing_map::start")
+            proc_flags = multiprocessing_map(pool_species_by_stream, argument_list, args.num_cores)
+            tsprint(f"CZ::multiprocessing_map::finish")
+        else:
+            # Compute pooled SNPs by the unit of chunks_of_sites
+            tsprint(f"CZ::design_chunks::start")
+            task_graph = design_chunks(contigs_files, annotation_files, args.chunk_size)
+            tsprint(f"CZ::design_chunks::finish")
+
+            tsprint(f"CZ::multiprocessing_dag::start")
+            proc_flags = collect_chunks_of_sites(multiprocessing_dag(task_graph, args.num_cores))
+            tsprint(f"CZ::multiprocessing_dag::finish")
 
         assert all(s == "worked" for s in proc_flags)
 
@@ -1,19 +1,20 @@
 #!/usr/bin/env python3
 import json
 import os
-import multiprocessing
 
 from collections import defaultdict
+from functools import partial
+from bisect import bisect_right
 import numpy as np
-import Bio.SeqIO
 from pysam import AlignmentFile  # pylint: disable=no-name-in-module
 
 from iggtools.common.argparser import add_subcommand
-from iggtools.common.utils import tsprint, InputStream, OutputStream, select_from_tsv, command, multiprocessing_map, multithreading_map, num_physical_cores, cat_files
-from iggtools.common.bowtie2 import build_bowtie2_db, bowtie2_align, samtools_index, bowtie2_index_exists, _keep_read
+from iggtools.common.utils import tsprint, InputStream, OutputStream, select_from_tsv, TaskGraph, multiprocessing_dag, OrderedChunks, num_physical_cores, CHUNK_COST_RATIO_LIMIT, compressed_frame, decompressed_frame
+from iggtools.common.bowtie2 import build_bowtie2_db, bowtie2_align, samtools_index, bowtie2_index_exists, _keep_read, scan_gene, scan_references, bam_mapped_reads, cached_bamfile, open_bamfile_handles
 from iggtools.models.uhgg import MIDAS_IGGDB
 from iggtools.params.schemas import genes_summary_schema, genes_coverage_schema, format_data
 from iggtools.models.sample import Sample
+from iggtools.common.fasta import read_fasta
 
 
 DEFAULT_ALN_COV = 0.75
@@ -121,7 +122,11 @@ def register_args(main_func):
                            type=int,
                            metavar="INT",
                            default=DEFAULT_CHUNK_SIZE,
-                           help=f"Number of genomic sites for the temporary chunk file  ({DEFAULT_CHUNK_SIZE})")
+                           help=f"Number of genes per chunk at the mean depth of the sample;  deeper genes get smaller chunks ({DEFAULT_CHUNK_SIZE})")
+    subparser.add_argument('--whole_bam_scan',
+                           action='store_true',
+                           default=False,
+                           help=f"Scan the pangenome BAM once, in parallel ranges of consecutive genes, instead of looking up each gene in the BAM index")
     subparser.add_argument('--max_reads',
                            dest='max_reads',
                            type=int,
@@ -143,10 +148,11 @@ def keep_read(aln):
 
 
 def design_chunks(species_ids_of_interest, centroids_files):
-    """ Chunks_of_genes and each chunk is indexed by (species_id, chunk_id) """
+    """ Chunks_of_genes and each chunk is indexed by (species_id, chunk_id).
+    Return the TaskGraph of the chunks, plus one merge task per species that depends on all its chunks.
+    Genes are grouped by estimated cost, so that chunks of deeply covered genes hold fewer genes. """
 
     global sample
-    global semaphore_for_species
     global species_sliced_genes_path
     global species_gene_length
     global global_args
@@ -154,76 +160,197 @@ def design_chunks(species_ids_of_interest, centroids_files):
     chunk_size = global_args.chunk_size
 
     # Read-only global variables
-    semaphore_for_species = dict()
-    # For each species, list-of-headerless_sliced_output_path is indexed by chunk_id
-    species_sliced_genes_path = defaultdict(list)
+    species_sliced_genes_path = dict()
     species_sliced_genes_path["input_bamfile"] = sample.get_target_layout("genes_pangenomes_bam")
 
+    # For each species, the dict of gene_length is indexed by chunk_id
     species_gene_length = defaultdict(dict)
 
-    arguments_list = []
+    # Estimated cost of a gene:  one coverage row, plus the reads to scan, from the BAM index
+    with AlignmentFile(species_sliced_genes_path["input_bamfile"]) as bamfile:
+        mapped_reads = {gene_id: reads for gene_id, (reads, _) in bam_mapped_reads(bamfile).items()}
+        reference_rank = {gene_id: rank for rank, gene_id in enumerate(bamfile.references)}
+    mean_gene_cost = 1 + sum(mapped_reads.values()) / max(len(mapped_reads), 1)
+    chunk_cost = chunk_size * mean_gene_cost
+
+    graph = TaskGraph()
     for species_id in species_ids_of_interest:
         tsprint(f"design_chunks::{species_id}::start")
 
-        gene_count = 0
         chunk_id = 0
+        curr_chunk_cost = 0
+        species_cost = 0
         curr_chunk_genes_dict = defaultdict()
-        with InputStream(centroids_files[species_id]) as file:
+        with InputStream(centroids_files[species_id], binary=True) as file:
             # TODO: we should generate the centroids_info.txt
             # while the gene_length should be merged with genes_info for next round of database build
-            for centroid in Bio.SeqIO.parse(file, 'fasta'):
+            centroids_length = read_centroids_length(file)
 
-                if not chunk_id*chunk_size <= gene_count < (chunk_id+1)*chunk_size:
+            # Group the centroids in the BAM header order, so each chunk reads one contiguous stretch of the sorted BAM
+            for centroid_id in sorted(centroids_length.keys(), key=lambda cid: reference_rank.get(cid, len(reference_rank))):
+                gene_cost = 1 + mapped_reads.get(centroid_id, 0)
+
+                if curr_chunk_genes_dict and (curr_chunk_cost + gene_cost > chunk_cost or len(curr_chunk_genes_dict) >= chunk_size * CHUNK_COST_RATIO_LIMIT):
                     # For each chunk, we need the dict to keep track of the gene_length separately
-                    headerless_gene_coverage_path = sample.get_target_layout("chunk_coverage", species_id, chunk_id)
-                    arguments_list.append((species_id, chunk_id))
-                    species_sliced_genes_path[species_id].append(headerless_gene_coverage_path)
+                    graph.add((species_id, chunk_id), process_chunk_of_genes, (species_id, chunk_id), cost=curr_chunk_cost, group=species_id)
                     species_gene_length[species_id][chunk_id] = curr_chunk_genes_dict
 
                     chunk_id += 1
+                    curr_chunk_cost = 0
                     curr_chunk_genes_dict = defaultdict()
 
-                curr_chunk_genes_dict[centroid.id] = len(centroid.seq)
-                gene_count += 1
+                curr_chunk_genes_dict[centroid_id] = centroids_length[centroid_id]
+                curr_chunk_cost += gene_cost
+                species_cost += gene_cost
 
-            headerless_gene_coverage_path = sample.get_target_layout("chunk_coverage", species_id, chunk_id)
-            arguments_list.append((species_id, chunk_id))
-            species_sliced_genes_path[species_id].append(headerless_gene_coverage_path)
+            graph.add((species_id, chunk_id), process_chunk_of_genes, (species_id, chunk_id), cost=curr_chunk_cost, group=species_id)
             species_gene_length[species_id][chunk_id] = curr_chunk_genes_dict
             chunk_id += 1
 
+        # Submit the merge task, which the scheduler holds back until all chunks of the species are collected,
+        # and then sends out ahead of the remaining chunks so the species' blocks leave the parent early
+        graph.add((species_id, -1), process_chunk_of_genes, partial(species_merge_args, species_id), depends_on=[(species_id, ci) for ci in range(chunk_id)], cost=species_cost, group=species_id)
 
-        # Submit merge tasks for all chunks per species
-        arguments_list.append((species_id, -1))
-        species_sliced_genes_path[species_id].append(sample.get_target_layout("genes_coverage", species_id))
+        tsprint(f"design_chunks::{species_id}::finish chunksnum.{chunk_id}")
 
-        semaphore_for_species[species_id] = multiprocessing.Semaphore(chunk_id)
-        for _ in range(chunk_id):
-            semaphore_for_species[species_id].acquire()
+    return graph
 
-        tsprint(f"design_chunks::{species_id}::finish chunksnum.{chunk_id}")
 
-    return arguments_list
+def read_centroids_length(stream):
+    return dict(read_fasta(stream, lengths_only=True))
 
 
-def process_chunk_of_genes(packed_args):
-    """ Compute coverage of pangenome for given species_id and write results to disk """
+def design_bam_ranges(species_ids_of_interest, centroids_files):
+    """ Ranges of consecutive references of the pangenome BAM, each indexed by (None, range_id) and scanned in one sequential pass.
+    Return the TaskGraph of the ranges, plus one task per species that writes its genes coverage once the ranges holding its genes are scanned. """
 
-    global semaphore_for_species
+    global sample
     global species_sliced_genes_path
+    global species_gene_length
+    global species_gene_rids
+    global bam_ranges
+    global global_args
+
+    chunk_size = global_args.chunk_size
+
+    # Read-only global variables
+    species_sliced_genes_path = dict()
+    species_sliced_genes_path["input_bamfile"] = sample.get_target_layout("genes_pangenomes_bam")
+
+    # The species is written as one chunk:  the dict of gene_length, in BAM header order, is indexed by chunk_id 0
+    species_gene_length = defaultdict(dict)
+    # For each species, the reference ids of its genes in the BAM, or the spare last slot for genes absent from the header
+    species_gene_rids = dict()
+
+    with AlignmentFile(species_sliced_genes_path["input_bamfile"]) as bamfile:
+        references = bamfile.references
+        mapped_reads = bam_mapped_reads(bamfile)
+    reference_rank = {gene_id: rank for rank, gene_id in enumerate(references)}
+    reference_cost = [1 + mapped_reads.get(gene_id, (0, 0))[0] for gene_id in references]
+    chunk_cost = chunk_size * sum(reference_cost) / max(len(references), 1)
+
+    # Same cost budget as design_chunks, but over the BAM references instead of the genes of one species
+    bam_ranges = []
+    first_rid = 0
+    range_cost = 0
+    for rid, cost in enumerate(reference_cost):
+        if rid > first_rid and (range_cost + cost > chunk_cost or rid - first_rid >= chunk_size * CHUNK_COST_RATIO_LIMIT):
+            bam_ranges.append((first_rid, rid, range_cost))
+            first_rid = rid
+            range_cost = 0
+        range_cost += cost
+    if first_rid < len(references):
+        bam_ranges.append((first_rid, len(references), range_cost))
+
+    graph = TaskGraph()
+    for range_id, (first_rid, last_rid, range_cost) in enumerate(bam_ranges):
+        graph.add((None, range_id), process_bam_range, (range_id, first_rid, last_rid), cost=range_cost)
+    range_starts = [first_rid for first_rid, _, _ in bam_ranges]
+
+    for species_id in species_ids_of_interest:
+        with InputStream(centroids_files[species_id], binary=True) as file:
+            centroids_length = read_centroids_length(file)
+        gene_ids = sorted(centroids_length.keys(), key=lambda cid: reference_rank.get(cid, len(reference_rank)))
+        species_gene_length[species_id][0] = {gene_id: centroids_length[gene_id] for gene_id in gene_ids}
+        species_gene_rids[species_id] = np.array([reference_rank.get(gene_id, len(references)) for gene_id in gene_ids], dtype=np.int64)
+
+        scanned_rids = species_gene_rids[species_id][species_gene_rids[species_id] < len(references)]
+        depends_on = sorted(set((None, bisect_right(range_starts, rid) - 1) for rid in scanned_rids.tolist()))
+        species_cost = sum(bam_ranges[range_id][2] for _, range_id in depends_on)
+        graph.add((species_id, -1), process_chunk_of_genes, partial(species_scan_args, species_id), depends_on=depends_on, cost=species_cost)
+
+        tsprint(f"design_bam_ranges::{species_id}::genes.{len(gene_ids)} ranges.{len(depends_on)}")
+
+    return graph
+
+
+def species_scan_args(species_id):
+    """ Arguments of the task writing species_id, sliced in the parent out of the scanned reference arrays """
+    global bam_coverage
+    global species_gene_rids
+    rids = species_gene_rids.pop(species_id)
+    return (species_id, -1, None) + tuple(column[rids] for column in bam_coverage)
+
+
+def process_bam_range(packed_args):
+    """ Scan one range of BAM references for their aligned_reads, mapped_reads and aligned bases """
+
+    global species_sliced_genes_path
+
+    range_id, first_rid, last_rid = packed_args
+    tsprint(f"  CZ::process_bam_range::{range_id}::start scan_references {first_rid}-{last_rid}")
+    bamfile = cached_bamfile(species_sliced_genes_path["input_bamfile"])
+    ret = scan_references(bamfile, first_rid, last_rid, keep_read)
+    tsprint(f"  CZ::process_bam_range::{range_id}::finish scan_references")
+    return ret
+
+
+def collect_bam_ranges(task_results):
+    """ Fill the per reference arrays from the scanned ranges, for the species tasks.
+    Return the chunk statistics plus one merge record per species. """
+
+    global bam_ranges
+    global bam_coverage
+
+    # One spare zero slot at the end, for the genes absent from the BAM header
+    num_references = bam_ranges[-1][1] if bam_ranges else 0
+    bam_coverage = tuple(np.zeros(num_references + 1, dtype=np.int64) for _ in range(3))
+
+    chunks_gene_coverage = []
+    for (species_id, range_id), result in task_results:
+        if species_id is None:
+            first_rid, last_rid, _ = bam_ranges[range_id]
+            for column, values in zip(bam_coverage, result):
+                column[first_rid:last_rid] = values
+            continue
+        chunks_gene_coverage.extend(result)
+
+    return chunks_gene_coverage
 
-    if packed_args[1] == -1:
-        species_id = packed_args[0]
-        number_of_chunks = len(species_sliced_genes_path[species_id]) - 1
-        tsprint(f"  CZ::process_chunk_of_genes::{species_id}--1::wait merge_chunks_per_species")
-        for _ in range(number_of_chunks):
-            semaphore_for_species[species_id].acquire()
+
+def species_merge_args(species_id):
+    """ Arguments of the merge task of species_id, built in the parent once all its chunks are collected """
+    global species_coverage_blocks
+    global species_marker_depth
+    return (species_id, -1, species_coverage_blocks.pop(species_id), species_marker_depth.pop(species_id))
+
+
+def process_chunk_of_genes(packed_args):
+    """ Compute coverage of pangenome for given species_id and return the results to the parent """
+
+    species_id, chunk_id = packed_args[:2]
+    if chunk_id == -1 and packed_args[2] is None:
+        tsprint(f"  CZ::process_chunk_of_genes::{species_id}--1::start compute_coverage_per_species")
+        ret = compute_coverage_per_species(packed_args)
+        tsprint(f"  CZ::process_chunk_of_genes::{species_id}--1::finish compute_coverage_per_species")
+        return ret
+
+    if chunk_id == -1:
         tsprint(f"  CZ::process_chunk_of_genes::{species_id}--1::start merge_chunks_per_species")
-        ret = merge_chunks_per_species(species_id)
+        ret = merge_chunks_per_species(species_id, packed_args[2], packed_args[3])
         tsprint(f"  CZ::process_chunk_of_genes::{species_id}--1::finish merge_chunks_per_species")
         return ret
 
-    species_id, chunk_id = packed_args[:2]
     tsprint(f"  CZ::process_chunk_of_genes::{species_id}-{chunk_id}::start compute_coverage_per_chunk")
     ret = compute_coverage_per_chunk(packed_args)
     tsprint(f"  CZ::process_chunk_of_genes::{species_id}-{chunk_id}::finish compute_coverage_per_chunk")
@@ -231,144 +358,156 @@ def process_chunk_of_genes(packed_args):
 
 
 def compute_coverage_per_chunk(packed_args):
-    """ Count number of bp mapped to each pan-gene. """
+    """ Count number of bp mapped to each pan-gene.  Return the chunk statistics and its coverage rows as one compressed frame. """
 
-    global semaphore_for_species
+    global species_sliced_genes_path
+    global species_gene_length
 
-    try:
-        global species_sliced_genes_path
-        global species_gene_length
+    species_id, chunk_id = packed_args
+    pangenome_bamfile = species_sliced_genes_path["input_bamfile"]
 
-        species_id, chunk_id = packed_args
-        pangenome_bamfile = species_sliced_genes_path["input_bamfile"]
+    gene_length_dict = species_gene_length[species_id][chunk_id]
 
-        headerless_gene_coverage_path = species_sliced_genes_path[species_id][chunk_id]
-        gene_length_dict = species_gene_length[species_id][chunk_id]
+    # Reuse this worker's handle of the BAM, opened once by the pool initializer
+    bamfile = cached_bamfile(pangenome_bamfile)
+    # Genes are kept in the BAM header order from design_chunks
+    genes_scanned = ((gene_id, gene_length) + scan_gene(bamfile, gene_id, gene_length, keep_read) for gene_id, gene_length in gene_length_dict.items())
+    return coverage_of_genes(species_id, chunk_id, genes_scanned)
 
-        # Statistics needed to be accmulated within each chunk
-        chunk_of_gene_ids = sorted(list(gene_length_dict.keys()))
-        chunk_genome_size = 0
-        chunk_num_covered_genes = 0
-        chunk_nz_gene_depth = 0
-        chunk_aligned_reads = 0
-        chunk_mapped_reads = 0
 
-        with OutputStream(headerless_gene_coverage_path) as stream:
-            with AlignmentFile(pangenome_bamfile) as bamfile:
-                for gene_id in chunk_of_gene_ids:
-                    # Basic compute unit for each gene
-                    gene_length = gene_length_dict[gene_id]
-                    aligned_reads = bamfile.count(gene_id)
-                    mapped_reads = bamfile.count(gene_id, read_callback=keep_read)
-                    gene_depth = sum((len(aln.query_alignment_sequence) / gene_length for aln in bamfile.fetch(gene_id)))
+def compute_coverage_per_species(packed_args):
+    """ Coverage of all the genes of species_id from the scanned reference arrays, written out with copy_number """
 
-                    chunk_genome_size += 1
-                    if gene_depth == 0: # Sparse by default.
-                        continue
+    global species_gene_length
 
-                    chunk_num_covered_genes += 1
-                    chunk_nz_gene_depth += gene_depth
-                    chunk_aligned_reads += aligned_reads
-                    chunk_mapped_reads += mapped_reads
+    species_id, _, _, aligned_reads, mapped_reads, aligned_bases = packed_args
+    gene_length_dict = species_gene_length[species_id][0]
 
-                    vals = [gene_id, gene_length, aligned_reads, mapped_reads, gene_depth, 0.0]
-                    stream.write("\t".join(map(format_data, vals)) + "\n")
+    genes_scanned = ((gene_id, gene_length, ar, mr, ab / gene_length) for (gene_id, gene_length), ar, mr, ab in \
+                     zip(gene_length_dict.items(), aligned_reads.tolist(), mapped_reads.tolist(), aligned_bases.tolist()))
+    chunk_stats, coverage_block = coverage_of_genes(species_id, 0, genes_scanned)
+    return [chunk_stats, merge_chunks_per_species(species_id, [coverage_block], chunk_stats["chunk_marker_depth"])]
 
-        current_chunk_size = len(chunk_of_gene_ids)
-        tsprint(f"    CZ::process_chunk_of_genes::{species_id}-{chunk_id}::finish compute_coverage_per_chunk nz.{chunk_num_covered_genes}-{current_chunk_size}")
 
-        return {
-            "species_id": species_id,
-            "chunk_id": chunk_id,
-            "chunk_genome_size": chunk_genome_size,
-            "chunk_num_covered_genes": chunk_num_covered_genes,
-            "chunk_nz_gene_depth": chunk_nz_gene_depth,
-            "chunk_aligned_reads": chunk_aligned_reads,
-            "chunk_mapped_reads": chunk_mapped_reads
-        }
+def coverage_of_genes(species_id, chunk_id, genes_scanned):
+    """ Return the chunk statistics and the coverage rows as one compressed frame, from the
+    (gene_id, gene_length, aligned_reads, mapped_reads, gene_depth) of each gene of the chunk """
 
-    finally:
-        semaphore_for_species[species_id].release()
+    global sample
+    global species_marker_genes
+
+    marker_genes = species_marker_genes[species_id]
+
+    # Statistics needed to be accmulated within each chunk
+    chunk_genome_size = 0
+    chunk_num_covered_genes = 0
+    chunk_nz_gene_depth = 0
+    chunk_aligned_reads = 0
+    chunk_mapped_reads = 0
+    chunk_marker_depth = {}
+
+    lines = []
+    for gene_id, gene_length, aligned_reads, mapped_reads, gene_depth in genes_scanned:
+        chunk_genome_size += 1
+        if gene_depth == 0: # Sparse by default.
+            continue
 
+        chunk_num_covered_genes += 1
+        chunk_nz_gene_depth += gene_depth
+        chunk_aligned_reads += aligned_reads
+        chunk_mapped_reads += mapped_reads
+        if gene_id in marker_genes:
+            chunk_marker_depth[gene_id] = gene_depth
 
-def get_marker_coverage_from_chunk(my_args):
-    chunk_file, awk_command, marker_genes_depth = my_args
+        vals = [gene_id, gene_length, aligned_reads, mapped_reads, gene_depth, 0.0]
+        lines.append("\t".join(map(format_data, vals)) + "\n")
 
-    with InputStream(chunk_file, awk_command) as stream:
-        for row in select_from_tsv(stream, schema=genes_coverage_schema, result_structure=dict):
-            marker_genes_depth[row["gene_id"]] += row["total_depth"]
+    tsprint(f"    CZ::process_chunk_of_genes::{species_id}-{chunk_id}::finish coverage_of_genes nz.{chunk_num_covered_genes}-{chunk_genome_size}")
 
+    chunk_stats = {
+        "species_id": species_id,
+        "chunk_id": chunk_id,
+        "chunk_genome_size": chunk_genome_size,
+        "chunk_num_covered_genes": chunk_num_covered_genes,
+        "chunk_nz_gene_depth": chunk_nz_gene_depth,
+        "chunk_aligned_reads": chunk_aligned_reads,
+        "chunk_mapped_reads": chunk_mapped_reads,
+        "chunk_marker_depth": chunk_marker_depth
+    }
+    return chunk_stats, compressed_frame(sample.get_target_layout("genes_coverage", species_id), "".join(lines))
 
-def rewrite_chunk_coverage_file(my_args):
 
-    chunk_coverage_path, median_marker_depth = my_args
+def collect_chunks_of_genes(task_results):
+    """ Gather the coverage blocks of each species in chunk order as they arrive from the workers, for its merge task.
+    Return the chunk statistics plus one merge record per species. """
 
-    c_copies = list(genes_coverage_schema.keys()).index("copy_number")
-    c_depth = list(genes_coverage_schema.keys()).index("total_depth")
+    global species_gene_length
+    global species_coverage_blocks
+    global species_marker_depth
+
+    species_coverage_blocks = defaultdict(list)
+    # The depths of the covered marker centroids, as reported by the chunks of each species
+    species_marker_depth = defaultdict(dict)
+    collectors = {species_id: OrderedChunks(len(genes_of_chunks), partial(append_chunk_coverage, species_coverage_blocks[species_id])) \
+                  for species_id, genes_of_chunks in species_gene_length.items()}
+
+    chunks_gene_coverage = []
+    for (species_id, chunk_id), result in task_results:
+        if chunk_id == -1:
+            chunks_gene_coverage.append(result)
+            continue
+        chunk_stats, coverage_block = result
+        chunks_gene_coverage.append(chunk_stats)
+        species_marker_depth[species_id].update(chunk_stats["chunk_marker_depth"])
+        collectors[species_id].add(chunk_id, coverage_block)
 
-    add_cn_to_write = []
-    with InputStream(chunk_coverage_path) as stream:
-        for line in stream:
-            vals = line.rstrip("\n").split("\t")
-            # Infer gene copy counts
-            vals[c_copies] = float(vals[c_depth]) / median_marker_depth
-            add_cn_to_write.append(vals)
+    return chunks_gene_coverage
 
-    with OutputStream(chunk_coverage_path) as stream:
-        for vals in add_cn_to_write:
-            stream.write("\t".join(map(format_data, vals)) + "\n")
 
+def append_chunk_coverage(coverage_blocks, _chunk_id, coverage_block):
+    coverage_blocks.append(coverage_block)
 
-def merge_chunks_per_species(species_id):
-    """ Compute coverage of pangenome for given species_id and write results to disk """
 
-    global semaphore_for_species
-    global species_sliced_genes_path
-    global global_args
-    global marker_centroids_files # we can deal with marker_centroids_files global or not later
-
-    all_chunks = species_sliced_genes_path[species_id][:-1]
-    species_gene_coverage_path = species_sliced_genes_path[species_id][-1]
-
-    # Extract marker gene reads coverage from all the non-zero covered genes.
-    tsprint(f"      CZ2::merge_chunks_per_species::{species_id}::start get_marker_coverage_from_chunk")
-    with InputStream(marker_centroids_files[species_id]) as stream:
-        centroids_of_marker = dict(select_from_tsv(stream, selected_columns=["marker_id", "centroid_99"]))
-    mc_genes = list(centroids_of_marker.values())
-    # TODO note: when centroid_70, multiple marker genes may correspond to one centroid_70 (T OR F)?
-    # then that centroin_70 would not be single copy anymore.
-
-    # Construct awk command for match marker_genes
-    pat_str = " || ".join([f"$1==\"{g}\"" for g in mc_genes])
-    awk_command = "awk \'%s\'" % pat_str
-
-    marker_genes_depth = dict(zip(mc_genes, [0.0]*len(mc_genes)))
-    args = []
-    for chunk_file in all_chunks:
-        args.append((chunk_file, awk_command, marker_genes_depth))
-    multithreading_map(get_marker_coverage_from_chunk, args, 4)
-    tsprint(f"      CZ2::merge_chunks_per_species::{species_id}::finish get_marker_coverage_from_chunk")
-
-    # Overwrite the chunk_gene_coverage file with updated copy_number
-    tsprint(f"      CZ2::merge_chunks_per_species::{species_id}::start rewrite_chunk_coverage_file")
+def load_marker_genes(species_ids_of_interest):
+    """ Read the marker centroids of each species, for the chunks to report their depths """
+
+    global marker_centroids_files
+    global species_marker_genes
+
+    species_marker_genes = dict()
+    for species_id in species_ids_of_interest:
+        with InputStream(marker_centroids_files[species_id]) as stream:
+            centroids_of_marker = dict(select_from_tsv(stream, selected_columns=["marker_id", "centroid_99"]))
+        # TODO note: when centroid_70, multiple marker genes may correspond to one centroid_70 (T OR F)?
+        # then that centroin_70 would not be single copy anymore.
+        species_marker_genes[species_id] = set(centroids_of_marker.values())
+
+
+def merge_chunks_per_species(species_id, coverage_blocks, marker_depth):
+    """ Write the genes_coverage of species_id in one pass over its chunks, with copy_number from the median marker depth """
+
+    global species_marker_genes
+    global sample
+
+    species_gene_coverage_path = sample.get_target_layout("genes_coverage", species_id)
+
+    # Marker centroids without any coverage count as zero depth
+    marker_genes_depth = dict.fromkeys(species_marker_genes[species_id], 0.0)
+    marker_genes_depth.update(marker_depth)
     median_marker_depth = np.median(list(marker_genes_depth.values()))
-    if median_marker_depth > 0:
-        args = []
-        for chunk_file in all_chunks:
-            args.append((chunk_file, median_marker_depth))
-        multithreading_map(rewrite_chunk_coverage_file, args, 4)
-    tsprint(f"      CZ2::merge_chunks_per_species::{species_id}::finish rewrite_chunk_coverage_file")
-
-    # Merge chunks' results to files genes_coverage
+
+    c_copies = list(genes_coverage_schema.keys()).index("copy_number")
+    c_depth = list(genes_coverage_schema.keys()).index("total_depth")
+
     with OutputStream(species_gene_coverage_path) as stream:
         stream.write('\t'.join(genes_coverage_schema.keys()) + '\n')
-    cat_files(all_chunks, species_gene_coverage_path, 20)
-    # TODO: multithreading try to write to same file?
-
-    if not global_args.debug:
-        tsprint(f"Deleting temporary sliced coverage files for {species_id}.")
-        for s_file in all_chunks:
-            command(f"rm -rf {s_file}", quiet=True)
+        for block in coverage_blocks:
+            for line in decompressed_frame(species_gene_coverage_path, block).splitlines():
+                vals = line.split("\t")
+                if median_marker_depth > 0:
+                    # Infer gene copy counts
+                    vals[c_copies] = float(vals[c_depth]) / median_marker_depth
+                stream.write("\t".join(map(format_data, vals)) + "\n")
 
     return {"species_id": species_id, "chunk_id": -1, "median_marker_depth": median_marker_depth}
 
@@ -464,6 +603,7 @@ def midas_run_genes(args):
 
         tsprint(centroids_files)
         tsprint(marker_centroids_files)
+        load_marker_genes(species_ids_of_interest)
 
 
         # Build Bowtie indexes for species in the restricted species profile
@@ -473,7 +613,6 @@ def midas_run_genes(args):
 
         # Align reads to pangenome database
         tsprint(f"CZ::bowtie2_align::start")
-        sample.create_species_subdirs(species_ids_of_interest, "temp", args.debug)
         pangenome_bamfile = sample.get_target_layout("genes_pangenomes_bam")
         bowtie2_align(bt2_db_dir, bt2_db_name, pangenome_bamfile, args)
         samtools_index(pangenome_bamfile, args.debug, args.num_cores)
@@ -481,14 +620,21 @@ def midas_run_genes(args):
 
 
         # Compute coverage of genes in pangenome database
-        tsprint(f"CZ::design_chunks::start")
-        arguments_list = design_chunks(species_ids_of_interest, centroids_files)
-        tsprint(f"CZ::design_chunks::finish")
+        if args.whole_bam_scan:
+            tsprint(f"CZ::design_bam_ranges::start")
+            task_graph = design_bam_ranges(species_ids_of_interest, centroids_files)
+            collect_results = collect_bam_ranges
+            tsprint(f"CZ::design_bam_ranges::finish")
+        else:
+            tsprint(f"CZ::design_chunks::start")
+            task_graph = design_chunks(species_ids_of_interest, centroids_files)
+            collect_results = collect_chunks_of_genes
+            tsprint(f"CZ::design_chunks::finish")
 
 
-        tsprint(f"CZ::multiprocessing_map::start")
-        chunks_gene_coverage = multiprocessing_map(process_chunk_of_genes, arguments_list, args.num_cores)
-        tsprint(f"CZ::multiprocessing_map::finish")
+        tsprint(f"CZ::multiprocessing_dag::start")
+        chunks_gene_coverage = collect_results(multiprocessing_dag(task_graph, args.num_cores, open_bamfile_handles, (pangenome_bamfile,)))
+        tsprint(f"CZ::multiprocessing_dag::finish")
 
 
         tsprint(f"CZ::write_species_coverage_summary::start")
@@ -1,19 +1,20 @@
 #!/usr/bin/env python3
 import json
 import os
-import multiprocessing
 
 from collections import defaultdict
-from math import ceil
+from functools import partial
+import numpy as np
 from pysam import AlignmentFile  # pylint: disable=no-name-in-module
-import Bio.SeqIO
 
 from iggtools.common.argparser import add_subcommand
-from iggtools.common.utils import tsprint, num_physical_cores, InputStream, OutputStream, multiprocessing_map, command, cat_files, select_from_tsv
+from iggtools.common.utils import tsprint, num_physical_cores, pack_contig_chunks, InputStream, OutputStream, TaskGraph, multiprocessing_dag, multiprocessing_hashmap, OrderedChunks, compressed_frame, select_from_tsv
 from iggtools.models.uhgg import MIDAS_IGGDB
-from iggtools.common.bowtie2 import build_bowtie2_db, bowtie2_align, samtools_index, bowtie2_index_exists, _keep_read
-from iggtools.params.schemas import snps_profile_schema, snps_pileup_schema, format_data
+from iggtools.common.bowtie2 import build_bowtie2_db, bowtie2_align, samtools_index, bowtie2_index_exists, _keep_read, scan_contig_chunk, bam_mapped_reads, mean_aligned_length, cached_bamfile, open_bamfile_handles
+from iggtools.params.schemas import snps_profile_schema, snps_pileup_schema, snps_pileup_index_schema, format_data
 from iggtools.models.sample import Sample
+from iggtools.common.pileup import pileup_block, BinaryPileupWriter
+from iggtools.common.twobit import PackedGenome, packed_genome_file
 
 
 DEFAULT_MARKER_DEPTH = 5.0
@@ -24,6 +25,7 @@ DEFAULT_ALN_BASEQ = 30
 DEFAULT_ALN_COV = 0.75
 DEFAULT_ALN_TRIM = 0
 DEFAULT_CHUNK_SIZE = 50000
+DEFAULT_PILEUP_FORMAT = "tsv"
 
 
 def register_args(main_func):
@@ -139,7 +141,13 @@ def register_args(main_func):
                            type=int,
                            metavar="INT",
                            default=DEFAULT_CHUNK_SIZE,
-                           help=f"Number of genomic sites for the temporary chunk file  ({DEFAULT_CHUNK_SIZE})")
+                           help=f"Number of genomic sites per chunk at the mean depth of the sample;  deeper contigs get smaller chunks ({DEFAULT_CHUNK_SIZE})")
+    subparser.add_argument('--pileup_format',
+                           dest='pileup_format',
+                           type=str,
+                           default=DEFAULT_PILEUP_FORMAT,
+                           choices=['tsv', 'binary', 'both'],
+                           help=f"Write the per-species pileup as lz4 compressed TSV, as memory-mappable columnar binary, or both ({DEFAULT_PILEUP_FORMAT})")
     subparser.add_argument('--max_reads',
                            dest='max_reads',
                            type=int,
@@ -160,102 +168,69 @@ def keep_read(aln):
     return _keep_read(aln, args.aln_mapid, args.aln_readq, args.aln_mapq, args.aln_cov)
 
 
-def scan_contigs(contig_file, species_id):
-    """ Scan the genome file to get contig_id and contig_seq as ref_seq """
-    contigs = {}
-    with InputStream(contig_file) as file:
-        for rec in Bio.SeqIO.parse(file, 'fasta'):
-            contigs[rec.id] = {
-                "species_id": species_id,
-                "contig_id": rec.id,
-                "contig_len": len(rec.seq),
-                "contig_seq": str(rec.seq),
-            }
-    return contigs
-
-
 def design_chunks(species_ids_of_interest, contigs_files):
-    """ Chunks_of_continuous_genomic_sites and each chunk is indexed by (species_id, chunk_id) """
+    """ Chunks_of_continuous_genomic_sites and each chunk is indexed by (species_id, chunk_id).
+    Return the TaskGraph of the chunks, plus one task per species that finishes its files after its last chunk.
+    Chunks are cut by estimated cost, so that deeply covered contigs are split finer than chunk_size sites,
+    and consecutive short contigs are packed into one chunk.  Contigs are walked in the BAM header order,
+    so each chunk reads one contiguous stretch of the coordinate sorted BAM. """
 
     global sample
-    global semaphore_for_species
     global species_sliced_snps_path
+    global species_sliced_snps_range
+    global species_genomes
     global global_args
 
     chunk_size = global_args.chunk_size
 
     # Read-only global variables
-    semaphore_for_species = dict()
-    # For each species, list-of-headerless_sliced_output_path is indexed by chunk_id
-    species_sliced_snps_path = defaultdict(list)
+    species_sliced_snps_path = dict()
     species_sliced_snps_path["input_bamfile"] = sample.get_target_layout("snps_repgenomes_bam")
-
-    # TODO: this part can be done in parallel
-    arguments_list = []
+    # For each species, the chunk's list-of-(contig_id, 1-based start, end) is indexed by chunk_id
+    species_sliced_snps_range = defaultdict(list)
+    # For each species, the packed representative genome:  the workers read their chunks' bases off it, instead of the chunk arguments
+    species_genomes = dict()
+
+    # Estimated cost of a site:  one pileup row, plus the aligned read bases to count, from the BAM index
+    with AlignmentFile(species_sliced_snps_path["input_bamfile"]) as bamfile:
+        mapped_reads = bam_mapped_reads(bamfile)
+        read_length = mean_aligned_length(bamfile)
+        reference_rank = {contig_id: rank for rank, contig_id in enumerate(bamfile.references)}
+    contig_site_cost = {contig_id: 1 + read_length * reads / length for contig_id, (reads, length) in mapped_reads.items() if length > 0}
+    total_length = sum(length for _, length in mapped_reads.values())
+    mean_site_cost = 1 + read_length * sum(reads for reads, _ in mapped_reads.values()) / total_length if total_length else 1.0
+
+    # Contig lengths come off the index of each packed genome, packed concurrently across species if needed
+    packed_genomes = multiprocessing_hashmap(packed_genome_file, [contigs_files[species_id] for species_id in species_ids_of_interest], global_args.num_cores)
+
+    graph = TaskGraph()
     for species_id in species_ids_of_interest:
         tsprint(f"design_chunks::{species_id}::start")
 
-        # Read in contigs information for one species.
-        contigs = scan_contigs(contigs_files[species_id], species_id)
+        species_genomes[species_id] = PackedGenome(packed_genomes[contigs_files[species_id]])
+        contigs = species_genomes[species_id].lengths
 
-        chunk_id = 0
-        for contig_id in sorted(list(contigs.keys())): # why need to sort?
-            contig = contigs[contig_id]
-            contig_length = contig["contig_len"]
-
-            if contig_length <= chunk_size:
-                headerless_sliced_path = sample.get_target_layout("chunk_pileup", species_id, chunk_id)
-                species_sliced_snps_path[species_id].append(headerless_sliced_path)
-
-                # TODO: instead contig as the last argument, just pass the contig_seq.
-                slice_args = (species_id, chunk_id, contig_id, 0, contig_length, contig, True)
-                arguments_list.append(slice_args)
-                chunk_id += 1
-            else:
-                number_of_chunks = ceil(contig_length/chunk_size) - 1
-                for ni, ci in enumerate(range(0, contig_length, chunk_size)):
-                    headerless_sliced_path = sample.get_target_layout("chunk_pileup", species_id, chunk_id)
-                    species_sliced_snps_path[species_id].append(headerless_sliced_path)
-
-                    if ni == number_of_chunks:
-                        slice_args = (species_id, chunk_id, contig_id, ci, contig_length, contig, True)
-                    else:
-                        slice_args = (species_id, chunk_id, contig_id, ci, ci+chunk_size, contig, False)
-                    arguments_list.append(slice_args)
-                    chunk_id += 1
-
-
-        # Submit the merge jobs
-        arguments_list.append((species_id, -1))
-        species_sliced_snps_path[species_id].append(sample.get_target_layout("snps_pileup", species_id))
-
-        # Create a semaphore with number_of_chunks of elements
-        semaphore_for_species[species_id] = multiprocessing.Semaphore(chunk_id)
-        for _ in range(chunk_id):
-            semaphore_for_species[species_id].acquire() # Semaphore objects should only be shared between processes through inheritance
+        contigs_to_chunk = [(contig_id, contigs[contig_id], contig_site_cost.get(contig_id, 1.0)) \
+                            for contig_id in sorted(contigs.keys(), key=lambda cid: reference_rank.get(cid, len(reference_rank)))]
 
-        tsprint(f"design_chunks::{species_id}::finish chunksnum.{chunk_id}")
+        chunk_id = 0
+        for contig_slices in pack_contig_chunks(contigs_to_chunk, chunk_size, mean_site_cost):
+            species_sliced_snps_range[species_id].append([(contig_id, ci + 1, contig_end) for contig_id, ci, contig_end, _ in contig_slices])
 
-    return arguments_list
+            slice_args = (species_id, chunk_id, [(contig_id, ci, contig_end) for contig_id, ci, contig_end, _ in contig_slices])
+            graph.add((species_id, chunk_id), process_chunk_of_sites, slice_args, cost=sum(cost for _, _, _, cost in contig_slices), group=species_id)
+            chunk_id += 1
 
+        # The parent holds the open species files, so this task runs there (weight 0) once all chunks are written
+        graph.add((species_id, -1), finish_species_pileup, species_id, depends_on=[(species_id, ci) for ci in range(chunk_id)], weight=0, group=species_id)
 
-def process_chunk_of_sites(packed_args):
-    """ Pileup for given species_id and write results to disk """
+        tsprint(f"design_chunks::{species_id}::finish chunksnum.{chunk_id}")
 
-    global semaphore_for_species
-    global species_sliced_snps_path
+    return graph
 
-    if packed_args[1] == -1:
-        species_id = packed_args[0]
-        number_of_chunks = len(species_sliced_snps_path[species_id]) - 1
 
-        tsprint(f"  CZ::process_chunk_of_sites::{species_id}--1::wait merge_chunks_per_species")
-        for _ in range(number_of_chunks):
-            semaphore_for_species[species_id].acquire()
-        tsprint(f"  CZ::process_chunk_of_sites::{species_id}--1::start merge_chunks_per_species")
-        ret = merge_chunks_per_species(species_id)
-        tsprint(f"  CZ::process_chunk_of_sites::{species_id}--1::finish merge_chunks_per_species")
-        return ret
+def process_chunk_of_sites(packed_args):
+    """ Pileup for given species_id and return the results to the parent """
 
     species_id, chunk_id = packed_args[:2]
     tsprint(f"  CZ::process_chunk_of_sites::{species_id}-{chunk_id}::start compute_pileup_per_chunk")
@@ -266,99 +241,161 @@ def process_chunk_of_sites(packed_args):
 
 
 def compute_pileup_per_chunk(packed_args):
-    """ Pileup for one chunk of sites """
+    """ Pileup for one chunk of sites, which may pack several short contigs;  return the per contig
+    aln_stats, tsv and binary pileup blocks of the chunk """
 
-    global semaphore_for_species
-
-    try:
-        global species_sliced_snps_path
-        global global_args
+    global species_sliced_snps_path
 
-        # [contig_start, contig_end)
-        species_id, chunk_id, contig_id, contig_start, contig_end, contig, count_flag = packed_args
-        repgenome_bamfile = species_sliced_snps_path["input_bamfile"]
+    species_id, chunk_id, contig_slices = packed_args
+    repgenome_bamfile = species_sliced_snps_path["input_bamfile"]
 
-        headerless_sliced_path = species_sliced_snps_path[species_id][chunk_id]
+    chunk_aln_stats, tsv_blocks, bin_blocks = [], [], []
+    # Reuse this worker's handle of the BAM, opened once by the pool initializer
+    bamfile = cached_bamfile(repgenome_bamfile)
+    for contig_id, contig_start, contig_end in contig_slices:
+        aln_stats, tsv_block, bin_block = compute_pileup_per_contig(bamfile, species_id, contig_id, contig_start, contig_end)
+        chunk_aln_stats.append(aln_stats)
+        tsv_blocks.append(tsv_block)
+        bin_blocks.append(bin_block)
 
-        zero_rows_allowed = not global_args.sparse
-        current_chunk_size = contig_end - contig_start
+    nz_sites = sum(aln_stats["contig_covered_bases"] for aln_stats in chunk_aln_stats)
+    current_chunk_size = sum(aln_stats["chunk_length"] for aln_stats in chunk_aln_stats)
+    tsprint(f"    CZ::process_chunk_of_sites::{species_id}-{chunk_id}::finish compute_pileup_per_chunk contigs.{len(contig_slices)} nz.{nz_sites}-{current_chunk_size}")
+    return chunk_aln_stats, tsv_blocks, bin_blocks
 
-        with AlignmentFile(repgenome_bamfile) as bamfile:
-            counts = bamfile.count_coverage(contig_id, contig_start, contig_end,
-                                            quality_threshold=global_args.aln_baseq, # min_quality_threshold a base has to reach to be counted.
-                                            read_callback=keep_read) # select a call-back to ignore reads when counting
 
-        if count_flag:
-            # Designed chunk boundaries can cut reads into two chunks. To avoid overcount of boundary reads,
-            # we only compute the aligned_reads per contig once
-            with AlignmentFile(repgenome_bamfile) as bamfile:
-                aligned_reads = bamfile.count(contig_id)
-                mapped_reads = bamfile.count(contig_id, read_callback=keep_read)
-        else:
-            aligned_reads = 0
-            mapped_reads = 0
-
-        # aln_stats need to be passed from child process back to parents
-        aln_stats = {
-            "species_id": species_id,
-            "contig_id": contig_id,
-            "chunk_length": current_chunk_size,
-            "aligned_reads": aligned_reads,
-            "mapped_reads": mapped_reads,
-            "contig_total_depth": 0,
-            "contig_covered_bases": 0
-        }
-
-        with OutputStream(headerless_sliced_path) as stream:
-            for within_chunk_index in range(0, current_chunk_size):
-                depth = sum([counts[nt][within_chunk_index] for nt in range(4)])
-                count_a = counts[0][within_chunk_index]
-                count_c = counts[1][within_chunk_index]
-                count_g = counts[2][within_chunk_index]
-                count_t = counts[3][within_chunk_index]
-
-                ref_pos = within_chunk_index + contig_start
-                ref_allele = contig["contig_seq"][ref_pos]
-                row = (contig_id, ref_pos + 1, ref_allele, depth, count_a, count_c, count_g, count_t)
-
-                aln_stats["contig_total_depth"] += depth
-                if depth > 0:
-                    aln_stats["contig_covered_bases"] += 1
-                if depth > 0 or zero_rows_allowed:
-                    stream.write("\t".join(map(format_data, row)) + "\n")
-            assert within_chunk_index+contig_start == contig_end-1, f"compute_pileup_per_chunk::index mismatch error for {contig_id}."
-
-        nz_sites = aln_stats["contig_covered_bases"]
-        tsprint(f"    CZ::process_chunk_of_sites::{species_id}-{chunk_id}::finish compute_pileup_per_chunk nz.{nz_sites}-{current_chunk_size}")
-        return aln_stats
-    finally:
-        semaphore_for_species[species_id].release() # no deadlock
-
-
-def merge_chunks_per_species(species_id):
-    """ merge the pileup results from chunks into one file per species """
+def compute_pileup_per_contig(bamfile, species_id, contig_id, contig_start, contig_end):
+    """ Pileup for the sites [contig_start, contig_end) of one contig """
 
-    global species_sliced_snps_path
-    global semaphore_for_species
     global global_args
+    global sample
+    global species_genomes
+
+    zero_rows_allowed = not global_args.sparse
+    current_chunk_size = contig_end - contig_start
+
+    # One pass over the chunk's reads gives the ACGT counts and the read counts together.
+    # Reads cut by chunk boundaries are only counted by the chunk where they start.
+    acgt, aligned_reads, mapped_reads = scan_contig_chunk(bamfile, contig_id, contig_start, contig_end, keep_read,
+                                                          global_args.aln_baseq) # min_quality_threshold a base has to reach to be counted.
+
+    # Vectorized over the whole chunk: one (4, chunk_length) array of A, C, G, T counts
+    assert acgt.shape == (4, current_chunk_size), f"compute_pileup_per_chunk::index mismatch error for {contig_id}."
+    depth = acgt.sum(axis=0)
+    nz_mask = depth > 0
+
+    # aln_stats need to be passed from child process back to parents
+    aln_stats = {
+        "species_id": species_id,
+        "contig_id": contig_id,
+        "chunk_length": current_chunk_size,
+        "aligned_reads": aligned_reads,
+        "mapped_reads": mapped_reads,
+        "contig_total_depth": int(depth.sum()),
+        "contig_covered_bases": int(np.count_nonzero(nz_mask))
+    }
+
+    # The pileup rows travel back to the parent as one compressed frame, instead of through a temp file
+    tsv_block = None
+    bin_block = None
+    sites = np.arange(current_chunk_size) if zero_rows_allowed else np.flatnonzero(nz_mask)
+    ref_bases = species_genomes[species_id].fetch(contig_id, contig_start, contig_end)
+    if global_args.pileup_format != "binary":
+        tsv_block = compressed_frame(sample.get_target_layout("snps_pileup", species_id), format_pileup_rows(contig_id, contig_start, ref_bases.tobytes().decode(), sites, depth, acgt))
+    if global_args.pileup_format != "tsv":
+        ref_allele = ref_bases[sites]
+        bin_block = pileup_block(contig_id, sites + contig_start + 1, ref_allele, acgt[:, sites].T)
+
+    return aln_stats, tsv_block, bin_block
+
+
+def format_pileup_rows(contig_id, contig_start, chunk_seq, sites, depth, acgt):
+    """ Format the selected within-chunk sites as one block of snps_pileup_schema rows;  chunk_seq starts at contig_start """
+    # tolist() hands back python ints, so the rows are byte-identical to format_data(int)
+    lines = []
+    for i, d, (a, c, g, t) in zip(sites.tolist(), depth[sites].tolist(), acgt[:, sites].T.tolist()):
+        lines.append(f"{contig_id}\t{contig_start + i + 1}\t{chunk_seq[i]}\t{d}\t{a}\t{c}\t{g}\t{t}\n")
+    return "".join(lines)
+
+
+def collect_chunks_of_sites(task_results):
+    """ Append the chunks to the per-species pileup files in chunk order, as they arrive from the workers.
+    Return the aln_stats of all chunks in design order. """
+
+    global species_sliced_snps_range
+    global species_pileup_writers
+
+    species_pileup_writers = dict()
+    collectors = {species_id: OrderedChunks(len(chunk_ranges), partial(append_chunk_pileup, species_id)) \
+                  for species_id, chunk_ranges in species_sliced_snps_range.items()}
+
+    chunks_aln_stats = defaultdict(dict)
+    for (species_id, chunk_id), result in task_results:
+        if chunk_id == -1:
+            continue
+        chunk_aln_stats, tsv_blocks, bin_blocks = result
+        chunks_aln_stats[species_id][chunk_id] = chunk_aln_stats
+        collectors[species_id].add(chunk_id, (tsv_blocks, bin_blocks))
+
+    return [aln_stats for species_id in collectors for chunk_id in range(collectors[species_id].number_of_chunks) \
+            for aln_stats in chunks_aln_stats[species_id][chunk_id]]
+
 
-    files_of_chunks = species_sliced_snps_path[species_id][:-1]
-    species_snps_pileup_file = species_sliced_snps_path[species_id][-1]
+def append_chunk_pileup(species_id, chunk_id, pileup_blocks):
+    """ Append one chunk's pileup blocks to the files of species_id, which are opened with the first chunk """
 
-    with OutputStream(species_snps_pileup_file) as stream:
-        stream.write('\t'.join(snps_pileup_schema.keys()) + '\n')
-    cat_files(files_of_chunks, species_snps_pileup_file, 20)
+    global species_pileup_writers
+    global global_args
+    global sample
 
-    if not global_args.debug:
-        tsprint(f"Deleting temporary sliced pileup files for {species_id}.")
-        for s_file in files_of_chunks:
-            command(f"rm -rf {s_file}", quiet=True)
+    tsv_blocks, bin_blocks = pileup_blocks
+    if chunk_id == 0:
+        writers = {"block_offsets": []}
+        if global_args.pileup_format != "binary":
+            species_snps_pileup_file = sample.get_target_layout("snps_pileup", species_id)
+            writers["tsv"] = open(species_snps_pileup_file, "wb")
+            writers["tsv"].write(compressed_frame(species_snps_pileup_file, '\t'.join(snps_pileup_schema.keys()) + '\n'))
+        if global_args.pileup_format != "tsv":
+            writers["bin"] = BinaryPileupWriter(sample.get_target_layout("snps_pileup_bin", species_id))
+        species_pileup_writers[species_id] = writers
+
+    # One block per contig of the chunk
+    writers = species_pileup_writers[species_id]
+    for tsv_block, bin_block in zip(tsv_blocks, bin_blocks):
+        if "tsv" in writers:
+            writers["block_offsets"].append((writers["tsv"].tell(), len(tsv_block)))
+            writers["tsv"].write(tsv_block)
+        if "bin" in writers:
+            writers["bin"].add(bin_block)
+
+
+def finish_species_pileup(species_id):
+    """ Close the pileup files of species_id and write the index of its tsv pileup """
+
+    global species_sliced_snps_range
+    global species_pileup_writers
+    global sample
 
-    # return a status flag
-    # the path should be computable somewhere else
+    tsprint(f"  CZ::finish_species_pileup::{species_id}::start")
+    writers = species_pileup_writers.pop(species_id)
+    if "tsv" in writers:
+        writers["tsv"].close()
+        contig_ranges = [contig_range for chunk_ranges in species_sliced_snps_range[species_id] for contig_range in chunk_ranges]
+        write_pileup_index(writers["block_offsets"], contig_ranges, sample.get_target_layout("snps_pileup_index", species_id))
+    if "bin" in writers:
+        writers["bin"].close()
+    tsprint(f"  CZ::finish_species_pileup::{species_id}::finish")
     return True
 
 
+def write_pileup_index(block_offsets, contig_ranges, index_file):
+    """ Each contig of a chunk is one lz4 frame, so its byte range in the merged pileup can be decompressed on its own """
+    with OutputStream(index_file) as stream:
+        stream.write("\t".join(snps_pileup_index_schema.keys()) + "\n")
+        for (offset, length), (contig_id, contig_start, contig_end) in zip(block_offsets, contig_ranges):
+            stream.write("\t".join(map(format_data, (contig_id, contig_start, contig_end, offset, length))) + "\n")
+
+
 def write_species_pileup_summary(chunks_pileup_summary, outfile):
     """ Collect species pileup aln stats from all chunks and write to file """
 
@@ -366,9 +403,6 @@ def write_species_pileup_summary(chunks_pileup_summary, outfile):
     prev_species_id = None
 
     for record in chunks_pileup_summary:
-        if record is True:
-            continue
-
         species_id = record["species_id"]
         if species_id not in species_pileup_summary:
             species_pileup_summary[species_id] = {
@@ -456,6 +490,9 @@ def midas_run_snps(args):
         tsprint(f"CZ::fetch_iggdb_files::start")
         midas_iggdb = MIDAS_IGGDB(args.midas_iggdb if args.midas_iggdb else sample.get_target_layout("midas_iggdb_dir"), args.num_cores)
         contigs_files = midas_iggdb.fetch_files("prokka_genome", species_ids_of_interest) #contigs
+        # The .fai and the packed genome come from the database build, so the genomes are neither scanned nor packed here
+        midas_iggdb.fetch_files("genome_index", species_ids_of_interest)
+        midas_iggdb.fetch_files("packed_genome", species_ids_of_interest)
         tsprint(f"CZ::fetch_iggdb_files::finish")
         tsprint(contigs_files)
 
@@ -469,7 +506,6 @@ def midas_run_snps(args):
 
         # Map reads to the existing bowtie2 indexes
         tsprint(f"CZ::bowtie2_align::start")
-        sample.create_species_subdirs(species_ids_of_interest, "temp", args.debug)
         repgenome_bamfile = sample.get_target_layout("snps_repgenomes_bam")
         bowtie2_align(bt2_db_dir, bt2_db_name, repgenome_bamfile, args)
         samtools_index(repgenome_bamfile, args.debug, args.num_cores)
@@ -477,14 +513,14 @@ def midas_run_snps(args):
 
 
         tsprint(f"CZ::design_chunks::start")
-        arguments_list = design_chunks(species_ids_of_interest, contigs_files)
+        task_graph = design_chunks(species_ids_of_interest, contigs_files)
         tsprint(f"CZ::design_chunks::finish")
 
 
-        # Use mpileup to call SNPs
-        tsprint(f"CZ::multiprocessing_map::start")
-        chunks_pileup_summary = multiprocessing_map(process_chunk_of_sites, arguments_list, args.num_cores)
-        tsprint(f"CZ::multiprocessing_map::finish")
+        # Use mpileup to call SNPs;  chunk results are written to the species files as they arrive
+        tsprint(f"CZ::multiprocessing_dag::start")
+        chunks_pileup_summary = collect_chunks_of_sites(multiprocessing_dag(task_graph, args.num_cores, open_bamfile_handles, (repgenome_bamfile,)))
+        tsprint(f"CZ::multiprocessing_dag::finish")
 
 
         tsprint(f"CZ::write_species_pileup_summary::start")
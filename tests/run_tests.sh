@@ -19,6 +19,11 @@ merge_midas_outdir="merged_midas_output_${num_cores}"
 logs_dir="logs"
 mkdir -p ${logs_dir}
 
+# Same rows in either file, whatever the order;  lz4 files are decompressed first
+compare_tables() {
+    diff <(lz4 -dcf $1 | sort) <(lz4 -dcf $2 | sort)
+}
+
 samples_fp="samples.txt"
 pool_fp="samples_list.tsv"
 
@@ -64,4 +69,38 @@ echo "test midas_run_snps with prebuilt bowtie indexes"
 cat ${samples_fp} | xargs -Ixx bash -c "python -m iggtools midas_run_species --sample_name xx -1 reads/xx_R1.fastq.gz --num_cores ${num_cores} --debug ${midas_outdir}_w_bowtie2 &> ${logs_dir}/xx_species_${num_cores}_w_bowtie2.log"
 cat ${samples_fp} | xargs -Ixx bash -c "python -m iggtools midas_run_snps --sample_name xx -1 reads/xx_R1.fastq.gz --num_cores ${num_cores} --debug --marker_depth 1.0 --prebuilt_bowtie2_indexes ${merge_midas_outdir}/bt2_indexes/repgenomes --prebuilt_bowtie2_species ${merge_midas_outdir}/bt2_indexes/repgenomes.species ${midas_outdir}_w_bowtie2 &> ${logs_dir}/xx_snps_${num_cores}_w_bowtie2.log"
 
+
+echo "test midas_run_snps with binary and both pileup formats"
+for pileup_format in binary both; do
+    cat ${samples_fp} | xargs -Ixx bash -c "python -m iggtools midas_run_species --sample_name xx -1 reads/xx_R1.fastq.gz --num_cores ${num_cores} --debug ${midas_outdir}_${pileup_format} &> ${logs_dir}/xx_species_${num_cores}_${pileup_format}.log"
+    cat ${samples_fp} | xargs -Ixx bash -c "python -m iggtools midas_run_snps --sample_name xx -1 reads/xx_R1.fastq.gz --num_cores ${num_cores} --debug --marker_depth 1.0 --pileup_format ${pileup_format} ${midas_outdir}_${pileup_format} &> ${logs_dir}/xx_snps_${num_cores}_${pileup_format}.log"
+done
+for pileup in ${midas_outdir}/*/snps/*.snps.tsv.lz4; do
+    compare_tables ${pileup} ${pileup/${midas_outdir}/${midas_outdir}_both}
+done
+
+
+echo "test midas_run_genes with whole bam scan"
+cat ${samples_fp} | xargs -Ixx bash -c "python -m iggtools midas_run_species --sample_name xx -1 reads/xx_R1.fastq.gz --num_cores ${num_cores} --debug ${midas_outdir}_whole_bam &> ${logs_dir}/xx_species_${num_cores}_whole_bam.log"
+cat ${samples_fp} | xargs -Ixx bash -c "python -m iggtools midas_run_genes --sample_name xx -1 reads/xx_R1.fastq.gz --num_cores ${num_cores} --debug --marker_depth 1.0 --whole_bam_scan ${midas_outdir}_whole_bam &> ${logs_dir}/xx_genes_${num_cores}_whole_bam.log"
+for genes_coverage in ${midas_outdir}/*/genes/*.genes.tsv.lz4; do
+    compare_tables ${genes_coverage} ${genes_coverage/${midas_outdir}/${midas_outdir}_whole_bam}
+done
+
+
+echo "test midas_merge_snps stream engine, on tsv and binary pileups, and prebuilt site annotations"
+echo -e "sample_name\tmidas_outdir" > ${pool_fp}.binary
+cat ${samples_fp} | awk -v OFS='\t' -v dir=${midas_outdir}_binary '{print $1, dir}' >> ${pool_fp}.binary
+python -m iggtools midas_merge_snps --samples_list ${pool_fp} --num_cores ${num_cores} --merge_engine stream ${merge_midas_outdir}_stream &> ${logs_dir}/merge_snps_${num_cores}_stream.log
+python -m iggtools midas_merge_snps --samples_list ${pool_fp}.binary --num_cores ${num_cores} ${merge_midas_outdir}_binary &> ${logs_dir}/merge_snps_${num_cores}_binary.log
+python -m iggtools midas_merge_snps --samples_list ${pool_fp}.binary --num_cores ${num_cores} --merge_engine stream ${merge_midas_outdir}_binary_stream &> ${logs_dir}/merge_snps_${num_cores}_binary_stream.log
+python -m iggtools midas_merge_snps --samples_list ${pool_fp} --num_cores ${num_cores} --prebuilt_site_annotations ${merge_midas_outdir}_site_annotations &> ${logs_dir}/merge_snps_${num_cores}_site_annotations.log
+
+echo "test midas_merge_snps engines, pileup formats and site annotations agree"
+for snps_table in ${merge_midas_outdir}/snps/*/*.snps_{info,freqs,depth}.tsv; do
+    for variant in stream binary binary_stream site_annotations; do
+        compare_tables ${snps_table} ${snps_table/${merge_midas_outdir}/${merge_midas_outdir}_${variant}}
+    done
+done
+
 echo "DONE"